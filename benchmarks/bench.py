@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+#OSTN02 for Python benchmarks
+#============================
+
+#Reproducible timings of import, single point and bulk transforms.
+#
+#  python benchmarks/bench.py                       print results
+#  python benchmarks/bench.py --save base.json      store them as a baseline
+#  python benchmarks/bench.py --compare base.json   flag regressions
+#
+#Random points use fixed seeds, so every run measures the same work.
+
+import os
+import sys
+import json
+import time
+import timeit
+import platform
+import argparse
+import subprocess
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+#Suffixes of metrics where bigger is better; everything else is a time,
+#a size or an error where smaller is better
+HIGHER_IS_BETTER = ('points_per_s',)
+
+def _python(code):
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    return subprocess.check_output([sys.executable, '-c', code], env=env).decode().strip()
+
+def bench_import(repeats):
+    """Median cold import time of ostn02python.OSTN02, each in a fresh
+    interpreter, and the time for the first transform (which loads the grid)."""
+    code = ("import time; t=time.perf_counter(); import ostn02python.OSTN02 as m; "
+            "t1=time.perf_counter(); m.OSGB36_to_ETRS89(614300, 159900); "
+            "print(t1-t, time.perf_counter()-t1)")
+    runs = [[float(v) for v in _python(code).split()] for i in range(repeats)]
+    return {'import_s': float(np.median([r[0] for r in runs])),
+            'first_transform_s': float(np.median([r[1] for r in runs]))}
+
+_PEAK_RSS = """
+def peak_rss_mb():
+    #VmHWM is reset by exec, unlike ru_maxrss which keeps the parent's peak
+    try:
+        for line in open('/proc/self/status'):
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    import resource, sys
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+"""
+
+def bench_rss():
+    """Peak resident size in MB before and after the grid is loaded."""
+    code = _PEAK_RSS + ("import ostn02python.OSTN02 as m\n"
+                        "before = peak_rss_mb()\n"
+                        "m.preload()\n"
+                        "print(before, peak_rss_mb())\n")
+    (before, after) = [float(v) for v in _python(code).split()]
+    return {'peak_rss_before_load_mb': before, 'peak_rss_after_load_mb': after}
+
+def bench_latency(number):
+    """Median microseconds per call of the scalar functions."""
+    setup = ("from ostn02python.OSTN02 import ETRS89_to_OSGB36, OSGB36_to_ETRS89, preload; "
+             "from ostn02python.OSGB import ll_to_grid, grid_to_ll; "
+             "from ostn02python.transform import OSGB36GridRefToETRS89; preload()")
+    calls = {
+        'ETRS89_to_OSGB36'      : 'ETRS89_to_OSGB36(614199.522, 159979.837, 44.622)',
+        'OSGB36_to_ETRS89'      : 'OSGB36_to_ETRS89(614300, 159900)',
+        'll_to_grid'            : 'll_to_grid(51.297880, 1.072628)',
+        'grid_to_ll'            : 'grid_to_ll(614199.522, 159979.837)',
+        'OSGB36GridRefToETRS89' : 'OSGB36GridRefToETRS89("TR143599")',
+    }
+    out = {}
+    for name, stmt in sorted(calls.items()):
+        times = timeit.repeat(stmt, setup, repeat=5, number=number)
+        out[name + '_us'] = min(times) / number * 1e6
+    return out
+
+def random_covered_points(n, seed=0):
+    """n random OSGB36 points inside OSTN02 coverage, the same every time."""
+    from ostn02python.batch import _find_OSTN02_shifts_array
+    rng = np.random.default_rng(seed)
+    xs, ys = [], []
+    count = 0
+    while count < n:
+        x = rng.uniform(0, 700000, n)
+        y = rng.uniform(0, 1250000, n)
+        #Keep points where the shifts are defined both at the point and
+        #where the inverse lands
+        (dx, dy, dz, ok) = _find_OSTN02_shifts_array(x, y)
+        ok &= _find_OSTN02_shifts_array(x - dx, y - dy)[3]
+        xs.append(x[ok])
+        ys.append(y[ok])
+        count += ok.sum()
+    return (np.concatenate(xs)[:n], np.concatenate(ys)[:n])
+
+def bench_throughput(points):
+    """Points per second for the array functions on random covered points."""
+    from ostn02python.batch import (ETRS89_to_OSGB36_array, OSGB36_to_ETRS89_array,
+                                    ll_to_grid_array, grid_to_ll_array)
+    (x, y) = random_covered_points(points)
+    (lat, lon) = grid_to_ll_array(x, y)
+    runs = {
+        'ETRS89_to_OSGB36_array' : lambda: ETRS89_to_OSGB36_array(x, y),
+        'OSGB36_to_ETRS89_array' : lambda: OSGB36_to_ETRS89_array(x, y),
+        'll_to_grid_array'       : lambda: ll_to_grid_array(lat, lon),
+        'grid_to_ll_array'       : lambda: grid_to_ll_array(x, y),
+    }
+    out = {}
+    for name, run in sorted(runs.items()):
+        best = min(_time(run) for i in range(3))
+        out[name + '_points_per_s'] = points / best
+    return out
+
+def _time(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+def random_tracks(count, fixes, seed=0):
+    """count GPS-like tracks of fixes points each, the same every time:
+    fixes once a second from a vehicle at 5-30 m/s whose heading wanders,
+    with 3 m of noise, kept where the whole track is inside coverage.
+    Returns a list of (x, y) array pairs."""
+    from ostn02python.batch import is_covered_array
+    rng = np.random.default_rng(seed)
+    tracks = []
+    while len(tracks) < count:
+        (x, y) = (rng.uniform(200000, 600000), rng.uniform(100000, 900000))
+        speed = rng.uniform(5, 30)
+        heading = rng.uniform(0, 2*np.pi) + np.cumsum(rng.normal(0, 0.05, fixes))
+        xs = x + np.cumsum(speed*np.cos(heading)) + rng.normal(0, 3, fixes)
+        ys = y + np.cumsum(speed*np.sin(heading)) + rng.normal(0, 3, fixes)
+        #With a margin for where the inverse lands
+        if is_covered_array(xs - 200, ys - 200).all() and is_covered_array(xs + 200, ys + 200).all():
+            tracks.append((xs, ys))
+    return tracks
+
+def bench_track(points):
+    """Points per second for the scalar functions and a TrackTransformer
+    over the same GPS-like tracks, and the grid lookups per point it needs."""
+    from ostn02python.OSTN02 import ETRS89_to_OSGB36, OSGB36_to_ETRS89
+    from ostn02python.track import TrackTransformer
+    tracks = [list(zip(x.tolist(), y.tolist())) for (x, y) in random_tracks(points // 5000, 5000)]
+    count = sum(len(t) for t in tracks)
+    out = {}
+    for (name, func) in (('ETRS89_to_OSGB36', ETRS89_to_OSGB36), ('OSGB36_to_ETRS89', OSGB36_to_ETRS89)):
+        best = min(_time(lambda: [func(x, y) for t in tracks for (x, y) in t]) for i in range(3))
+        out[name + '_scalar_track_points_per_s'] = count / best
+        def run():
+            transformers = [TrackTransformer() for t in tracks]
+            for (transformer, t) in zip(transformers, tracks):
+                for r in transformer.transform(t, name):
+                    pass
+            return transformers
+        best = min(_time(run) for i in range(3))
+        out[name + '_track_points_per_s'] = count / best
+        out[name + '_track_lookups'] = sum(t.lookups for t in run()) / float(count)
+    return out
+
+def bench_inverse_lookups(points):
+    """How many grid lookups the OSGB36_to_ETRS89 inverse takes per point."""
+    from ostn02python.batch import OSGB36_to_ETRS89_report_array
+    (x, y) = random_covered_points(points, seed=1)
+    (result, lookups, residual) = OSGB36_to_ETRS89_report_array(x, y)
+    counts = np.bincount(lookups)
+    return {'inverse_lookups': dict((str(i), int(c)) for i, c in enumerate(counts) if c),
+            'inverse_mean_lookups': float(lookups.mean()),
+            'inverse_max_residual_m': float(residual.max())}
+
+def run(quick=False):
+    from ostn02python import OSTN02
+    OSTN02.preload()
+    points = 100000 if quick else 1000000
+    results = {}
+    results.update(bench_import(3 if quick else 7))
+    results.update(bench_rss())
+    results.update(bench_latency(2000 if quick else 20000))
+    results.update(bench_throughput(points))
+    results.update(bench_inverse_lookups(points))
+    results.update(bench_track(points // 10))
+    return {'environment': {'python': platform.python_version(),
+                            'numpy': np.__version__,
+                            'machine': platform.machine(),
+                            'platform': platform.platform(),
+                            'points': points},
+            'results': results}
+
+def compare(baseline, current, threshold):
+    """Return (name, baseline, current, change) for every numeric metric that
+    is worse than the baseline by more than threshold (a fraction)."""
+    regressions = []
+    for name, old in sorted(baseline['results'].items()):
+        new = current['results'].get(name)
+        if not isinstance(old, (int, float)) or not isinstance(new, (int, float)) or not old:
+            continue
+        change = (new - old) / float(old)
+        worse = -change if name.endswith(HIGHER_IS_BETTER) else change
+        if worse > threshold:
+            regressions.append((name, old, new, change))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark ostn02python.")
+    parser.add_argument('--quick', action='store_true', help="fewer points and repeats")
+    parser.add_argument('--save', metavar='FILE', help="write the results as a JSON baseline")
+    parser.add_argument('--compare', metavar='FILE', help="compare with a saved baseline")
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help="fractional slowdown counted as a regression (default 0.10)")
+    args = parser.parse_args(argv)
+
+    current = run(args.quick)
+    print(json.dumps(current, indent=2, sort_keys=True))
+    if args.save:
+        with open(args.save, 'w') as fo:
+            json.dump(current, fo, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as fi:
+            baseline = json.load(fi)
+        regressions = compare(baseline, current, args.threshold)
+        for (name, old, new, change) in regressions:
+            print("REGRESSION {0}: {1:.6g} -> {2:.6g} ({3:+.1%})".format(name, old, new, change))
+        if regressions:
+            return 1
+        print("No regressions beyond {0:.0%}".format(args.threshold))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -12,6 +12,8 @@
 
 import math
 
+from ostn02python import instrument
+
 RAD = math.pi / 180
 DAR = 180 / math.pi
 
@@ -35,114 +37,37 @@ E0 =  400000   # Easting for origin
 N0 = -100000   # Northing for origin
 F0 = 0.9996012717 # Convergence factor
 
+#The projection itself lives in projection.py, which needs the constants above
+from ostn02python import projection
+
 def ll_to_grid(lat,lon,alt=0.0,shape = 'WGS84'):
 
+	if instrument.enabled:
+		return instrument.timed('projection', _ll_to_grid, lat, lon, alt, shape)
+	return _ll_to_grid(lat, lon, alt, shape)
+
+def _ll_to_grid(lat,lon,alt=0.0,shape = 'WGS84'):
+
 	#my $shape = defined $ellipsoid_shapes{$_[-1]} ? pop : 'OSGB36'; # last argument (or omitted)
 	#if ($lat =~ $ISO_LL_Pattern ) {
 	#	($lat, $lon, $alt) = parse_ISO_ll($lat);
 	#}
 
-	(a,b) = ellipsoid_shapes[shape]
-	
-	e2 = (a**2.-b**2.)/a**2.
-	n = (a-b)/(a+b)
-	
-	phi = RAD * lat
-	lam = RAD * lon
-
-	sp2  = math.sin(phi)**2.
-	nu   = a * F0 * (1. - e2 * sp2 ) ** -0.5
-	rho  = a * F0 * (1. - e2) * (1. - e2 * sp2 ) ** -1.5
-	eta2 = nu/rho - 1.
-	
-	M = _compute_M(phi, b, n)
+	return projection.projection_for(shape).to_grid(lat, lon)
 
-	cp = math.cos(phi)
-	sp = math.sin(phi)
-	tp = math.tan(phi)
-	tp2 = tp*tp
-	tp4 = tp2*tp2
-
-	I	= M + N0
-	II   = nu/2.  * sp * cp
-	III  = nu/24. * sp * cp**3. * (5.-tp2+9.*eta2)
-	IIIA = nu/720.* sp * cp**5. *(61.-58.*tp2+tp4)
-
-	IV   = nu*cp
-	V	= nu/6.   * cp**3. * (nu/rho-tp2)
-	VI   = nu/120. * cp**5. * (5.-18.*tp2+tp4+14.*eta2-58.*tp2*eta2)
-
-	l = lam - LAM0
-	north = I  + II*l**2. + III*l**4. + IIIA*l**6.;
-	east  = E0 + IV*l	+   V*l**3. +   VI*l**5.;
-
-	# round to 3dp (mm)
-	#($east, $north) = map { sprintf "%.3f", $_ } ($east, $north);
+def grid_to_ll(E,N,shape='WGS84'):
 
-	return (east,north)
+	if instrument.enabled:
+		return instrument.timed('projection', _grid_to_ll, E, N, shape)
+	return _grid_to_ll(E, N, shape)
 
-def grid_to_ll(E,N,shape='WGS84'):
+def _grid_to_ll(E,N,shape='WGS84'):
 
 	#if ( $E =~ $GR_Pattern || $E =~ $Long_GR_Pattern || $E =~ $LR_Pattern ) {
 	#	($E, $N) = parse_grid($E);
 	#}
 
-	(a,b) = ellipsoid_shapes[shape]
-
-	e2 = (a**2.-b**2.)/a**2.
-	n = (a-b)/(a+b)
-
-	dN = N - N0
-
-	phi = PHI0 + dN/(a * F0)
-
-	M = _compute_M(phi, b, n);
-	while (dN-M >= 0.001):
-	   phi = phi + (dN-M)/(a * F0)
-	   M = _compute_M(phi, b, n)
-
-	sp2  = math.sin(phi)**2.;
-	nu   = a * F0 *			 (1. - e2 * sp2 ) ** -0.5
-	rho  = a * F0 * (1. - e2) * (1. - e2 * sp2 ) ** -1.5
-	eta2 = nu/rho - 1.
-
-	tp = math.tan(phi)
-	tp2 = tp*tp
-	tp4 = tp2*tp2
-
-	VII  = tp /   (2.*rho*nu)
-	VIII = tp /  (24.*rho*nu**3.) *  (5. +  3.*tp2 + eta2 - 9.*tp2*eta2)
-	IX   = tp / (720.*rho*nu**5.) * (61. + 90.*tp2 + 45.*tp4)
-
-	sp = 1.0 / math.cos(phi) 
-	tp6 = tp4*tp2
-
-	X	= sp/nu
-	XI   = sp/(   6.*nu**3.)*(nu/rho + 2.*tp2)
-	XII  = sp/( 120.*nu**5.)*(	  5. + 28.*tp2 +   24.*tp4)
-	XIIA = sp/(5040.*nu**7.)*(	61. + 662.*tp2 + 1320.*tp4 + 720.*tp6)
-
-	e = E - E0
-
-	phi = phi		- VII*e**2. + VIII*e**4. -   IX*e**6.
-	lam = LAM0 + X*e -  XI*e**3. +  XII*e**5. - XIIA*e**7.
-
-	phi = phi * DAR
-	lam = lam * DAR
-
-	return (phi, lam)
-	#return format_ll_ISO($phi,$lam);
-
-
-def _compute_M(phi, b, n):
-	p_plus  = phi + PHI0
-	p_minus = phi - PHI0
-	return b * F0 * (
-		   (1 + n * (1 + 5./4*n*(1 + n)))*p_minus
-		 - 3*n*(1+n*(1+7./8*n))  * math.sin(p_minus) * math.cos(p_plus)
-		 + (15./8*n * (n*(1+n))) * math.sin(2*p_minus) * math.cos(2*p_plus)
-		 - 35./24*n**3			 * math.sin(3*p_minus) * math.cos(3*p_plus)
-		   )
+	return projection.projection_for(shape).to_ll(E, N)
 
 Big_off = {#East then north
 				 'G' : ( -1, 2 ),
@@ -483,8 +408,8 @@ def grid_to_os_streetview_tile(grid):
 	if not etile and not ntile: corner = "SW"
 
 	#Mid level offset
-	eMidOffset = int(e % 100000) / 10000
-	nMidOffset = int(n % 100000) / 10000
+	eMidOffset = int(e % 100000) // 10000
+	nMidOffset = int(n % 100000) // 10000
 	e -= eMidOffset * 10000
 	n -= nMidOffset * 10000
 
@@ -2,7 +2,14 @@
 # encoding: utf-8
 
 import os
-import bz2, six
+import six
+import threading
+
+from ostn02python.grid import (load_grid, open_tiled_grid, default_tiled_path,
+                              GRID_WIDTH, GRID_HEIGHT)
+from ostn02python.cellcache import CellCache, DEFAULT_CELL_CACHE_BYTES
+from ostn02python import instrument
+from ostn02python import helmert
 
 #OSTN02 for Python
 #=================
@@ -21,35 +28,197 @@ MIN_Y_SHIFT = -81.603
 MIN_Z_SHIFT =  43.982
 
 def ostn():
-    filename = os.path.join(os.path.dirname(__file__), 'ostn02data.txt.bz2')
-    fi = bz2.BZ2File(filename)
-    lines = fi.readlines()
-    out = {}
-    for line in lines:
-        line = line.rstrip(b'\r\n').decode("ascii")
-        #six.print_(line)
-        ne = line[:6]
-        offset = (int(line[6:10],16),int(line[10:14],16),int(line[14:18],16))
-        out[ne] = offset
-    return out
-
-ostn_data = ostn() # load all the data from below
-ostn_shift_for= {}
-
-
-def ETRS89_to_OSGB36(x,y,z=0.0):
+    #Uses the tiled grid from grid.compile_tiled_grid() if OSTN02_TILED_GRID
+    #names one, then the memory mapped cache from grid.compile_grid_cache()
+    #when it is present and up to date, otherwise decompresses the bz2 text
+    if os.environ.get('OSTN02_TILED_GRID'):
+        grid = open_tiled_grid()
+        if grid is not None:
+            return grid
+    return load_grid()
+
+#The grid takes a few seconds to decompress, so it is only loaded the first
+#time a shift is needed (or when preload() is called explicitly)
+_ostn_data = None
+_ostn_lock = threading.Lock()
+
+def _get_ostn_data():
+    global _ostn_data
+    data = _ostn_data
+    if data is None:
+        with _ostn_lock:
+            if _ostn_data is None:
+                _ostn_data = ostn()
+            data = _ostn_data
+    return data
+
+def preload():
+    """Load the OSTN02 grid now rather than on the first transform.
+    Safe to call from several threads; the grid is only loaded once."""
+    _get_ostn_data()
+
+def set_grid(grid):
+    """Use grid (a grid.ShiftGrid) for all further transforms in this process."""
+    global _ostn_data
+    with _ostn_lock:
+        _ostn_data = grid
+        cell_cache.clear()
+
+def use_region(bbox, path=None):
+    """Serve only the area within bbox, (min_x, min_y, max_x, max_y) in
+    metres, from the tiled grid at path (see grid.compile_tiled_grid).
+    Tiles are loaded as points fall in them and points outside bbox are
+    treated as outside OSTN02 coverage, so memory use follows the area
+    served rather than all of Great Britain. bbox None allows everywhere."""
+    grid = open_tiled_grid(path, bbox=bbox)
+    if grid is None:
+        raise Exception("No usable OSTN02 tiled grid at {0}".format(path or default_tiled_path()))
+    set_grid(grid)
+    return grid
+
+#Bilinear coefficients of recently used cells, see _cell_coefficients
+cell_cache = CellCache(DEFAULT_CELL_CACHE_BYTES)
+
+def configure_cell_cache(max_bytes):
+    """Set the memory budget of the cell coefficient cache (0 disables it)."""
+    cell_cache.resize(max_bytes)
+
+def cell_cache_stats():
+    """Hit, miss and eviction counts and size of the cell coefficient cache."""
+    return cell_cache.stats()
+
+def __getattr__(name):
+    #Keep the old module level ostn_data attribute working (Python 3.7+)
+    if name == "ostn_data":
+        return _get_ostn_data()
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+
+
+#accuracy='cm' is the OSTN02 transform; accuracy='m' is the Helmert
+#transformation in helmert.py, which never loads the grid and is within
+#helmert.MAX_HORIZONTAL_ERROR and MAX_HEIGHT_ERROR of it. 'm' saves memory
+#and the grid load, not time per call: with the grid loaded it is slower
+ACCURACY_TIERS = ('cm', 'm')
+
+def _check_accuracy(accuracy):
+    if accuracy not in ACCURACY_TIERS:
+        raise ValueError("accuracy must be one of {0}".format(", ".join(ACCURACY_TIERS)))
+
+def ETRS89_to_OSGB36(x,y,z=0.0,accuracy='cm'):
+
+    if accuracy != 'cm':
+        _check_accuracy(accuracy)
+        if instrument.enabled:
+            return instrument.timed('helmert', _helmert_ETRS89_to_OSGB36, x, y, z)
+        return _helmert_ETRS89_to_OSGB36(x, y, z)
+    if instrument.enabled:
+        return instrument.timed('shift', _ETRS89_to_OSGB36, x, y, z)
+    return _ETRS89_to_OSGB36(x, y, z)
+
+def _helmert_ETRS89_to_OSGB36(x, y, z=0.0):
+    return _round_to_nearest_mm(*helmert.ETRS89_to_OSGB36(x, y, z))
+
+def _ETRS89_to_OSGB36(x,y,z=0.0):
 
     if ( 0 <= x and x <= MAX_EASTING and 0 <= y and y <= MAX_NORTHING ):
         (dx, dy, dz) = _find_OSTN02_shifts_at(x,y)
         (x, y, z) = _round_to_nearest_mm(x+dx, y+dy, z-dz) # note $z sign differs
     
     else:
+        if instrument.enabled:
+            instrument.count('out_of_coverage')
         raise Exception('OSTN02 is not defined at '+str(x)+', '+str(y)+')')
 
 
     return (x, y, z)
 
-def OSGB36_to_ETRS89 (x0, y0, z0 = 0.0):
+def OSGB36_to_ETRS89 (x0, y0, z0 = 0.0, accuracy = 'cm'):
+
+    if accuracy != 'cm':
+        _check_accuracy(accuracy)
+        if instrument.enabled:
+            return instrument.timed('helmert', _helmert_OSGB36_to_ETRS89, x0, y0, z0)
+        return _helmert_OSGB36_to_ETRS89(x0, y0, z0)
+    if instrument.enabled:
+        return instrument.timed('inverse', _OSGB36_to_ETRS89, x0, y0, z0)
+    return _OSGB36_to_ETRS89(x0, y0, z0)
+
+def _helmert_OSGB36_to_ETRS89(x0, y0, z0 = 0.0):
+    return _round_to_nearest_mm(*helmert.OSGB36_to_ETRS89(x0, y0, z0))
+
+def _OSGB36_to_ETRS89 (x0, y0, z0 = 0.0):
+
+    (dx, dy, dz, lookups, residual) = _find_inverse_shifts_at(x0, y0)
+    (x, y, z) = _round_to_nearest_mm(x0-dx, y0-dy, z0+dz)
+
+    return (x, y, z)
+
+def OSGB36_to_ETRS89_report(x0, y0, z0 = 0.0):
+    """As OSGB36_to_ETRS89 but returns ((x, y, z), lookups, residual).
+    lookups is the number of grid cells read and residual is how far (in
+    metres) the last iterate was from mapping back onto (x0, y0) before
+    the final Newton step was applied."""
+
+    (dx, dy, dz, lookups, residual) = _find_inverse_shifts_at(x0, y0)
+    return (_round_to_nearest_mm(x0-dx, y0-dy, z0+dz), lookups, residual)
+
+#Once the iterate is this close (in metres), one Newton step that stays in
+#the same cell lands well under a micrometre from the exact inverse
+INVERSE_TOLERANCE = 0.05
+MAX_INVERSE_LOOKUPS = 8
+
+def _find_inverse_shifts_at(x0, y0, find_cell=None):
+    #Solve (x, y) + shift(x, y) = (x0, y0). The shift at (x0, y0) gets within
+    #a few cm, then Newton's method using the Jacobian of the bilinear cell
+    #finishes the job, normally with just one more lookup.
+
+    (dx, dy, dz) = _find_OSTN02_shifts_at(x0, y0, find_cell)
+    (x, y) = (x0-dx, y0-dy)
+
+    lookups = 1
+    while lookups < MAX_INVERSE_LOOKUPS:
+        lookups += 1
+        (se, sn, sg, se_x, se_y, sn_x, sn_y, sg_x, sg_y) = _find_OSTN02_shifts_and_slopes_at(x, y, find_cell)
+        fx = x + se - x0
+        fy = y + sn - y0
+        det = (1+se_x)*(1+sn_y) - se_y*sn_x
+        step_x = ((1+sn_y)*fx - se_y*fy)/det
+        step_y = ((1+se_x)*fy - sn_x*fx)/det
+        (last_x, last_y) = (x, y)
+        (x, y) = (x - step_x, y - step_y)
+
+        #The linearisation is only exact to second order inside one cell
+        if (abs(fx) < INVERSE_TOLERANCE and abs(fy) < INVERSE_TOLERANCE
+                and int(x/1000.) == int(last_x/1000.) and int(y/1000.) == int(last_y/1000.)):
+            dz = sg - sg_x*step_x - sg_y*step_y
+            if instrument.enabled:
+                instrument.count('inverse_lookups', lookups)
+            return (x0-x, y0-y, dz, lookups, max(abs(fx), abs(fy)))
+
+    raise Exception("[OSTN02 inverse did not converge at ("+str(x0)+","+str(y0)+")]")
+
+def is_covered(x, y):
+    """True if OSTN02 shifts are defined at (x, y), i.e. ETRS89_to_OSGB36
+    will not fail there. A constant time lookup in the grid's coverage mask.
+    OSGB36_to_ETRS89 needs the shifts where its inverse lands too, a few
+    tens of metres away, so can still fail right at the edge of coverage."""
+    if not (0 <= x <= MAX_EASTING and 0 <= y <= MAX_NORTHING):
+        return False
+    e_index = int(x/1000.)
+    n_index = int(y/1000.)
+    if e_index >= GRID_WIDTH-1 or n_index >= GRID_HEIGHT-1:
+        return False
+    i0 = n_index * GRID_WIDTH + e_index
+    return (_get_ostn_data().coverage[i0 >> 3] >> (i0 & 7)) & 1 == 1
+
+def _not_defined(x, y):
+    if instrument.enabled:
+        instrument.count('out_of_coverage')
+    return Exception("[OSTN02 not defined at ("+str(x)+","+str(y)+")]")
+
+def _OSGB36_to_ETRS89_fixed_point(x0, y0, z0 = 0.0):
+    #The original fixed point iteration, kept as the reference the Newton
+    #inverse is checked against
     epsilon = 0.00001
     (dx, dy, dz) = _find_OSTN02_shifts_at(x0,y0)
     (x,  y,  z ) = (x0-dx, y0-dy, z0+dz)
@@ -74,19 +243,43 @@ def _round_to_nearest_mm(x,  y,  z):
     return (x, y, z)
 
 
-def _find_OSTN02_shifts_at(x,y):
+def _cell_coefficients(i0, grid=None):
+    #Bilinear coefficients of the cell with south west corner i0, in metres.
+    #For each of east, north and height the shift at (t, u) within the cell
+    #is c0 + c1*t + c2*u + c3*(t*u).
+
+    if grid is None:
+        grid = _get_ostn_data()
+    if grid.tile_km:
+        grid.require(i0)
+    i1 = i0 + 1
+    i2 = i0 + GRID_WIDTH
+    i3 = i2 + 1
+
+    out = []
+    for plane, shift in ((grid.east, MIN_X_SHIFT), (grid.north, MIN_Y_SHIFT), (grid.height, MIN_Z_SHIFT)):
+        (s0, s1, s2, s3) = (plane[i0], plane[i1], plane[i2], plane[i3])
+        out.append(s0/1000.0 + shift)
+        out.append((s1-s0)/1000.0)
+        out.append((s2-s0)/1000.0)
+        out.append((s3-s2-s1+s0)/1000.0)
+    return tuple(out)
+
+def _find_OSTN02_cell(x,y):
+    #Coefficients of the 1km cell containing (x, y) and the position (t, u)
+    #within it
 
     e_index = int(x/1000.)
     n_index = int(y/1000.)
 
-    s0_ref = _get_ostn_ref(e_index+0, n_index+0)
-    #print s0_ref
-    s1_ref = _get_ostn_ref(e_index+1, n_index+0)
-    s2_ref = _get_ostn_ref(e_index+0, n_index+1)
-    s3_ref = _get_ostn_ref(e_index+1, n_index+1)
+    #Corners are s0 at (e,n), s1 one to the east, s2 one north, s3 north east
+    if not (0 <= e_index < GRID_WIDTH-1 and 0 <= n_index < GRID_HEIGHT-1):
+        raise _not_defined(x, y)
+    i0 = n_index * GRID_WIDTH + e_index
 
-    if s0_ref is None or s1_ref is None or s2_ref is None or s3_ref is None:
-        raise Exception("[OSTN02 not defined at ("+str(x)+","+str(y)+")]")
+    #One bit per cell, set when all four corners have data
+    if not (_get_ostn_data().coverage[i0 >> 3] >> (i0 & 7)) & 1:
+        raise _not_defined(x, y)
 
     x0 = e_index * 1000
     y0 = n_index * 1000
@@ -97,31 +290,46 @@ def _find_OSTN02_shifts_at(x,y):
     t = dx/1000
     u = dy/1000
 
-    f0 = (1-t)*(1-u)
-    f1 =    t *(1-u)
-    f2 = (1-t)*   u
-    f3 =    t *   u
+    return (cell_cache.get(i0, _cell_coefficients), t, u)
+
+def _find_OSTN02_shifts_at(x, y, find_cell=None):
+    #find_cell replaces _find_OSTN02_cell, e.g. with a Transformer's
 
-    se = f0*s0_ref[0] + f1*s1_ref[0] + f2*s2_ref[0] + f3*s3_ref[0]
-    sn = f0*s0_ref[1] + f1*s1_ref[1] + f2*s2_ref[1] + f3*s3_ref[1]
-    sg = f0*s0_ref[2] + f1*s1_ref[2] + f2*s2_ref[2] + f3*s3_ref[2]
+    (c, t, u) = (find_cell or _find_OSTN02_cell)(x, y)
+    tu = t*u
+
+    se = c[0] + c[1]*t + c[2]*u + c[3]*tu
+    sn = c[4] + c[5]*t + c[6]*u + c[7]*tu
+    sg = c[8] + c[9]*t + c[10]*u + c[11]*tu
 
     #if se*sn*sg==0.:
     #    print("[OSTN02 defined as zeros at ($x, $y), coordinates unchanged]")
 
     return (se, sn, sg)
 
-def _get_ostn_ref(x,y):
+def _find_OSTN02_shifts_and_slopes_at(x, y, find_cell=None):
+    #Shifts as _find_OSTN02_shifts_at, followed by their derivatives with
+    #respect to x and y (metres per metre) within the cell:
+    #(se, sn, sg, dse/dx, dse/dy, dsn/dx, dsn/dy, dsg/dx, dsg/dy)
 
-    key = "%03x%03x" % (y, x)
-    if key in ostn_shift_for:
-        return ostn_shift_for[key]
+    (c, t, u) = (find_cell or _find_OSTN02_cell)(x, y)
+    tu = t*u
 
-    if key in ostn_data:
-        data = ostn_data[key]
-        data2 = (data[0]/1000.0 + MIN_X_SHIFT,data[1]/1000.0 +MIN_Y_SHIFT,data[2]/1000.0 + MIN_Z_SHIFT)
-        ostn_shift_for[key] = data2
-        return data2
+    se = c[0] + c[1]*t + c[2]*u + c[3]*tu
+    sn = c[4] + c[5]*t + c[6]*u + c[7]*tu
+    sg = c[8] + c[9]*t + c[10]*u + c[11]*tu
 
+    se_x = (c[1] + c[3]*u)/1000.0
+    se_y = (c[2] + c[3]*t)/1000.0
+    sn_x = (c[5] + c[7]*u)/1000.0
+    sn_y = (c[6] + c[7]*t)/1000.0
+    sg_x = (c[9] + c[11]*u)/1000.0
+    sg_y = (c[10] + c[11]*t)/1000.0
 
+    return (se, sn, sg, se_x, se_y, sn_x, sn_y, sg_x, sg_y)
+
+def _get_ostn_ref(x,y):
 
+    data = _get_ostn_data().node(x, y)
+    if data is not None:
+        return (data[0]/1000.0 + MIN_X_SHIFT, data[1]/1000.0 + MIN_Y_SHIFT, data[2]/1000.0 + MIN_Z_SHIFT)
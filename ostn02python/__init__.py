@@ -1,2 +1,4 @@
+__version__ = '1.0.0'
+
 import ostn02python.OSGB #import parse_grid, grid_to_ll
 import ostn02python.OSTN02 #import OSGB36_to_ETRS89
\ No newline at end of file
@@ -0,0 +1,8 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import sys
+
+from ostn02python.cli import main
+
+sys.exit(main())
@@ -0,0 +1,441 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+#OSTN02 for Python
+#=================
+
+#Array versions of the OSTN02 and OSGB transforms. These take NumPy arrays (or
+#anything numpy.asarray accepts) and work on a whole batch of points at once.
+#The OSTN02 shifts are bit for bit the same as the scalar functions; the
+#projections agree with OSGB to well under a micrometre.
+#The OSTN02 transform is Crown Copyright (C) 2002
+#See COPYING for redistribution terms
+
+import numpy as np
+
+from ostn02python import instrument
+from ostn02python import helmert
+from ostn02python.grid import GRID_WIDTH, GRID_HEIGHT
+from ostn02python.projection import projection_for
+from ostn02python.OSTN02 import (_get_ostn_data, MAX_EASTING, MAX_NORTHING,
+                                 MIN_X_SHIFT, MIN_Y_SHIFT, MIN_Z_SHIFT,
+                                 INVERSE_TOLERANCE, MAX_INVERSE_LOOKUPS, _check_accuracy)
+
+def _as_float_arrays(x, y, z):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if z is None:
+        z = np.zeros(np.broadcast(x, y).shape)
+    else:
+        z = np.asarray(z, dtype=np.float64)
+    return np.broadcast_arrays(x, y, z)
+
+def _planes(grid):
+    #Zero copy views of the grid planes, whether arrays or mmapped memoryviews
+    return (np.frombuffer(grid.east, dtype=np.uint16),
+            np.frombuffer(grid.north, dtype=np.uint16),
+            np.frombuffer(grid.height, dtype=np.uint16),
+            np.frombuffer(grid.valid, dtype=np.uint8))
+
+def _instrumented(stage, func, *args):
+    instrument.count('array_points', np.size(args[0]))
+    return instrument.timed(stage, func, *args)
+
+def _not_defined(x, y, ok):
+    if instrument.enabled:
+        instrument.count('out_of_coverage', int(np.count_nonzero(~ok)))
+    i = np.flatnonzero(~ok)[0]
+    return Exception("[OSTN02 not defined at ("+str(x.flat[i])+","+str(y.flat[i])+")]")
+
+def _covered_cells(i0, grid=None):
+    #Coverage bit of each cell, see grid.coverage_mask
+    if grid is None:
+        grid = _get_ostn_data()
+    coverage = np.frombuffer(grid.coverage, dtype=np.uint8)
+    return ((coverage[i0 >> 3] >> (i0 & 7).astype(np.uint8)) & 1).astype(bool)
+
+def _find_OSTN02_cells_array(x, y, grid=None):
+    #Corner indices and (t, u) within the cell for each point, as
+    #_find_OSTN02_cell, plus ok which is False where OSTN02 is undefined.
+    #All of these take the grid to use, by default the process's grid.
+
+    #int() truncates towards zero, so trunc rather than floor
+    e_index = np.trunc(x/1000.)
+    n_index = np.trunc(y/1000.)
+    with np.errstate(invalid='ignore'):
+        ok = ((e_index >= 0) & (e_index < GRID_WIDTH-1)
+              & (n_index >= 0) & (n_index < GRID_HEIGHT-1))
+
+    e_safe = np.where(ok, e_index, 0).astype(np.intp)
+    n_safe = np.where(ok, n_index, 0).astype(np.intp)
+    i0 = n_safe * GRID_WIDTH + e_safe
+    ok &= _covered_cells(i0, grid)
+
+    #Same operations in the same order as the scalar code, so the results
+    #are bit for bit identical (infinite input gives NaN, with ok False)
+    with np.errstate(invalid='ignore'):
+        t = (x - e_index*1000)/1000
+        u = (y - n_index*1000)/1000
+
+    return (i0, t, u, ok)
+
+def _spread_bits(bits):
+    #_spread_bits(bits)[v] is v with a zero bit between each of its bits
+    table = np.zeros(1 << bits, dtype=np.uint32)
+    for bit in range(bits):
+        table |= ((np.arange(1 << bits, dtype=np.uint32) >> bit) & 1) << (2*bit)
+    return table
+
+#Enough bits for every cell row and column
+_MORTON_SPREAD = _spread_bits(max(GRID_WIDTH, GRID_HEIGHT).bit_length())
+
+def cell_order(x, y):
+    """Permutation putting points in Morton (Z) order of their 1 km OSTN02
+    cell, int(x/1000) and int(y/1000). Points in the same cell end up next
+    to each other and neighbouring cells stay close, so x[order], y[order]
+    touch the grid far more locally than points in arbitrary order."""
+    x = np.asarray(x, dtype=np.float64).ravel()
+    y = np.asarray(y, dtype=np.float64).ravel()
+    with np.errstate(invalid='ignore'):
+        e_index = np.clip(np.nan_to_num(np.trunc(x/1000.)), 0, GRID_WIDTH-1).astype(np.intp)
+        n_index = np.clip(np.nan_to_num(np.trunc(y/1000.)), 0, GRID_HEIGHT-1).astype(np.intp)
+    key = _MORTON_SPREAD[e_index] | (_MORTON_SPREAD[n_index] << 1)
+    #The order within a cell does not matter, so no need for a stable sort
+    return np.argsort(key)
+
+def _require_tiles(grid, i0):
+    #Load the tiles of a TiledGrid holding any corner of the cells i0
+    (n, e) = np.divmod(i0, GRID_WIDTH)
+    size = grid.tile_km
+    loaded = np.frombuffer(grid.loaded, dtype=np.uint8)
+    for row in (n // size, (n+1) // size):
+        for column in (e // size, (e+1) // size):
+            tiles = row*grid.tile_columns + column
+            missing = tiles[loaded[tiles] == 0]
+            if missing.size:
+                grid.load_tiles(np.unique(missing).tolist())
+
+#Fetch each run of points in one cell once when the runs average at least
+#this many points; below it a plain gather is as quick
+MIN_MEAN_RUN = 4
+
+def _cell_coefficients_array(i0, grid=None):
+    #_cell_coefficients for an array of cells, as a list of 12 arrays
+    if i0.size >= MIN_MEAN_RUN:
+        starts = np.flatnonzero(np.concatenate(([True], i0[1:] != i0[:-1])))
+        if starts.size * MIN_MEAN_RUN <= i0.size:
+            counts = np.diff(np.append(starts, i0.size))
+            return [np.repeat(c, counts) for c in _cell_coefficients_array(i0[starts], grid)]
+
+    if grid is None:
+        grid = _get_ostn_data()
+    if grid.tile_km:
+        _require_tiles(grid, i0)
+    east, north, height, valid = _planes(grid)
+    i1 = i0 + 1
+    i2 = i0 + GRID_WIDTH
+    i3 = i2 + 1
+
+    out = []
+    for plane, shift in ((east, MIN_X_SHIFT), (north, MIN_Y_SHIFT), (height, MIN_Z_SHIFT)):
+        #Differences of uint16 would wrap, so go to float first (exactly)
+        s0 = plane[i0].astype(np.float64)
+        s1 = plane[i1].astype(np.float64)
+        s2 = plane[i2].astype(np.float64)
+        s3 = plane[i3].astype(np.float64)
+        out.append(s0/1000.0 + shift)
+        out.append((s1-s0)/1000.0)
+        out.append((s2-s0)/1000.0)
+        out.append((s3-s2-s1+s0)/1000.0)
+    return out
+
+def _find_OSTN02_shifts_array(x, y, grid=None):
+    """Bilinear shifts at each point, as _find_OSTN02_shifts_at.
+
+    Returns (se, sn, sg, ok) where ok is False for points without OSTN02
+    coverage; the shifts at those points are meaningless.
+    """
+    (i0, t, u, ok) = _find_OSTN02_cells_array(x, y, grid)
+    c = _cell_coefficients_array(i0, grid)
+    tu = t*u
+
+    se = c[0] + c[1]*t + c[2]*u + c[3]*tu
+    sn = c[4] + c[5]*t + c[6]*u + c[7]*tu
+    sg = c[8] + c[9]*t + c[10]*u + c[11]*tu
+
+    return (se, sn, sg, ok)
+
+def _find_OSTN02_shifts_and_slopes_array(x, y, grid=None):
+    #As _find_OSTN02_shifts_and_slopes_at, with ok appended
+    (i0, t, u, ok) = _find_OSTN02_cells_array(x, y, grid)
+    c = _cell_coefficients_array(i0, grid)
+    tu = t*u
+
+    se = c[0] + c[1]*t + c[2]*u + c[3]*tu
+    sn = c[4] + c[5]*t + c[6]*u + c[7]*tu
+    sg = c[8] + c[9]*t + c[10]*u + c[11]*tu
+
+    se_x = (c[1] + c[3]*u)/1000.0
+    se_y = (c[2] + c[3]*t)/1000.0
+    sn_x = (c[5] + c[7]*u)/1000.0
+    sn_y = (c[6] + c[7]*t)/1000.0
+    sg_x = (c[9] + c[11]*u)/1000.0
+    sg_y = (c[10] + c[11]*t)/1000.0
+
+    return (se, sn, sg, se_x, se_y, sn_x, sn_y, sg_x, sg_y, ok)
+
+def _round_to_nearest_mm_array(x, y, z):
+    #round() on a float rounds half to even, as does np.rint
+    return (np.rint(x*1000.)/1000., np.rint(y*1000.)/1000., np.rint(z*1000.)/1000.)
+
+def is_covered_array(x, y):
+    """is_covered for arrays: a boolean array, True where OSTN02 shifts are
+    defined, from one lookup per point in the grid's coverage mask."""
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        in_range = (0 <= x) & (x <= MAX_EASTING) & (0 <= y) & (y <= MAX_NORTHING)
+    return in_range & _find_OSTN02_cells_array(x, y)[3]
+
+def _masked(values, ok):
+    #NaN wherever ok is False
+    for v in values:
+        v[~ok] = np.nan
+    return values
+
+def ETRS89_to_OSGB36_array(x, y, z=None, masked=False, accuracy='cm'):
+    """ETRS89_to_OSGB36 for arrays of eastings, northings and heights.
+    Returns a tuple of three arrays.
+
+    With masked=True nothing is raised for points outside OSTN02 coverage:
+    the result is ((x, y, z), ok) with NaN wherever ok is False.
+    accuracy is as for ETRS89_to_OSGB36; the 'm' tier never loads the grid
+    (it is slower per point once the grid is loaded), never raises and
+    with masked=True its ok is all True."""
+    if accuracy != 'cm':
+        return _helmert_array('ETRS89_to_OSGB36', accuracy, x, y, z, masked)
+    if instrument.enabled:
+        return _instrumented('shift_array', _ETRS89_to_OSGB36_array, x, y, z, masked)
+    return _ETRS89_to_OSGB36_array(x, y, z, masked)
+
+def _ETRS89_to_OSGB36_array(x, y, z=None, masked=False, grid=None):
+
+    if grid is None:
+        grid = _get_ostn_data()
+    x, y, z = _as_float_arrays(x, y, z)
+
+    with np.errstate(invalid='ignore'):
+        in_range = (0 <= x) & (x <= MAX_EASTING) & (0 <= y) & (y <= MAX_NORTHING)
+    if not in_range.all():
+        if instrument.enabled:
+            instrument.count('out_of_coverage', int(np.count_nonzero(~in_range)))
+        if not masked:
+            i = np.flatnonzero(~in_range)[0]
+            raise Exception('OSTN02 is not defined at '+str(x.flat[i])+', '+str(y.flat[i])+')')
+
+    (dx, dy, dz, ok) = _find_OSTN02_shifts_array(x, y, grid)
+    if masked:
+        ok &= in_range
+        return (_masked(_round_to_nearest_mm_array(x+dx, y+dy, z-dz), ok), ok)
+    if not ok.all():
+        raise _not_defined(x, y, ok)
+    return _round_to_nearest_mm_array(x+dx, y+dy, z-dz) # note z sign differs
+
+def OSGB36_to_ETRS89_array(x0, y0, z0=None, masked=False, accuracy='cm'):
+    """OSGB36_to_ETRS89 for arrays of eastings, northings and heights.
+    Returns a tuple of three arrays, or ((x, y, z), ok) with masked=True,
+    and takes accuracy, as ETRS89_to_OSGB36_array."""
+    if accuracy != 'cm':
+        return _helmert_array('OSGB36_to_ETRS89', accuracy, x0, y0, z0, masked)
+    if instrument.enabled:
+        return _instrumented('inverse_array', _OSGB36_to_ETRS89_array, x0, y0, z0, masked)
+    return _OSGB36_to_ETRS89_array(x0, y0, z0, masked)
+
+def _OSGB36_to_ETRS89_array(x0, y0, z0=None, masked=False, grid=None):
+
+    x0, y0, z0 = _as_float_arrays(x0, y0, z0)
+
+    (dx, dy, dz, lookups, residual, ok) = _find_inverse_shifts_array(x0, y0, masked=masked, grid=grid)
+    if masked:
+        return (_masked(_round_to_nearest_mm_array(x0-dx, y0-dy, z0+dz), ok), ok)
+    return _round_to_nearest_mm_array(x0-dx, y0-dy, z0+dz)
+
+def _helmert_array(transform, accuracy, x, y, z, masked):
+    #The metre tier of the two functions above
+    _check_accuracy(accuracy)
+    x, y, z = _as_float_arrays(x, y, z)
+    func = getattr(helmert, transform + '_array')
+    if instrument.enabled:
+        out = _instrumented('helmert_array', func, x, y, z)
+    else:
+        out = func(x, y, z)
+    out = _round_to_nearest_mm_array(*out)
+    if masked:
+        return (out, np.ones(x.shape, dtype=bool))
+    return out
+
+def OSGB36_to_ETRS89_report_array(x0, y0, z0=None):
+    """OSGB36_to_ETRS89_report for arrays. Returns ((x, y, z), lookups,
+    residual) where lookups and residual are arrays with one entry per point."""
+    x0, y0, z0 = _as_float_arrays(x0, y0, z0)
+
+    (dx, dy, dz, lookups, residual, ok) = _find_inverse_shifts_array(x0, y0)
+    return (_round_to_nearest_mm_array(x0-dx, y0-dy, z0+dz), lookups, residual)
+
+def _find_inverse_shifts_array(x0, y0, first=None, masked=False, grid=None):
+    #The Newton inverse of _find_inverse_shifts_at, iterating only the points
+    #that have not finished yet. first may give the (dx, dy, dz) shifts at
+    #(x0, y0) when the caller already has them. Returns (dx, dy, dz,
+    #lookups, residual, ok); unless masked, a point without coverage raises
+    #and ok is all True.
+    if grid is None:
+        grid = _get_ostn_data()
+    shape = x0.shape
+    x0 = x0.ravel()
+    y0 = y0.ravel()
+
+    if first is None:
+        (dx, dy, dz, ok) = _find_OSTN02_shifts_array(x0, y0, grid)
+        if not ok.all() and not masked:
+            raise _not_defined(x0, y0, ok)
+    else:
+        (dx, dy, dz) = [np.array(f, dtype=np.float64).ravel() for f in first]
+        ok = np.ones(x0.shape, dtype=bool)
+    (x, y) = (x0-dx, y0-dy)
+
+    lookups = np.ones(x0.shape, dtype=np.intp)
+    residual = np.zeros(x0.shape)
+    active = np.flatnonzero(ok)
+    (x, y) = (x[active], y[active])
+    n = 1
+    while active.size and n < MAX_INVERSE_LOOKUPS:
+        n += 1
+        lookups[active] = n
+        xa0, ya0 = x0[active], y0[active]
+        (se, sn, sg, se_x, se_y, sn_x, sn_y, sg_x, sg_y, found) = \
+            _find_OSTN02_shifts_and_slopes_array(x, y, grid)
+        if not found.all():
+            if not masked:
+                raise _not_defined(x, y, found)
+            #The iterate left coverage: give up on those points
+            ok[active[~found]] = False
+            if instrument.enabled:
+                instrument.count('out_of_coverage', int(np.count_nonzero(~found)))
+            (active, x, y, xa0, ya0) = (active[found], x[found], y[found], xa0[found], ya0[found])
+            (se, sn, sg, se_x, se_y, sn_x, sn_y, sg_x, sg_y) = [
+                v[found] for v in (se, sn, sg, se_x, se_y, sn_x, sn_y, sg_x, sg_y)]
+        fx = x + se - xa0
+        fy = y + sn - ya0
+        det = (1+se_x)*(1+sn_y) - se_y*sn_x
+        step_x = ((1+sn_y)*fx - se_y*fy)/det
+        step_y = ((1+se_x)*fy - sn_x*fx)/det
+        (last_x, last_y) = (x, y)
+        (x, y) = (x - step_x, y - step_y)
+
+        done = ((abs(fx) < INVERSE_TOLERANCE) & (abs(fy) < INVERSE_TOLERANCE)
+                & (np.trunc(x/1000.) == np.trunc(last_x/1000.))
+                & (np.trunc(y/1000.) == np.trunc(last_y/1000.)))
+        finished = active[done]
+        dx[finished] = xa0[done] - x[done]
+        dy[finished] = ya0[done] - y[done]
+        dz[finished] = (sg - sg_x*step_x - sg_y*step_y)[done]
+        residual[finished] = np.maximum(abs(fx), abs(fy))[done]
+
+        active = active[~done]
+        x, y = x[~done], y[~done]
+
+    if instrument.enabled:
+        instrument.count('inverse_lookups', int(lookups.sum()))
+    if active.size:
+        if not masked:
+            i = active[0]
+            raise Exception("[OSTN02 inverse did not converge at ("+str(x0[i])+","+str(y0[i])+")]")
+        ok[active] = False
+
+    return (dx.reshape(shape), dy.reshape(shape), dz.reshape(shape),
+            lookups.reshape(shape), residual.reshape(shape), ok.reshape(shape))
+
+def ll_to_grid_array(lat, lon, shape='WGS84'):
+    """ll_to_grid for arrays of latitudes and longitudes in degrees.
+    Returns (east, north) arrays."""
+    if instrument.enabled:
+        return _instrumented('projection_array', _ll_to_grid_array, lat, lon, shape)
+    return _ll_to_grid_array(lat, lon, shape)
+
+def _ll_to_grid_array(lat, lon, shape='WGS84'):
+    lat, lon = np.broadcast_arrays(np.asarray(lat, dtype=np.float64),
+                                   np.asarray(lon, dtype=np.float64))
+    return projection_for(shape).to_grid_array(lat, lon)
+
+def grid_to_ll_array(E, N, shape='WGS84'):
+    """grid_to_ll for arrays of eastings and northings.
+    Returns (lat, lon) arrays in degrees."""
+    if instrument.enabled:
+        return _instrumented('projection_array', _grid_to_ll_array, E, N, shape)
+    return _grid_to_ll_array(E, N, shape)
+
+def _grid_to_ll_array(E, N, shape='WGS84'):
+    E, N = np.broadcast_arrays(np.asarray(E, dtype=np.float64),
+                               np.asarray(N, dtype=np.float64))
+    return projection_for(shape).to_ll_array(E, N)
+
+#Transforms by name, with the number of values each gives per point
+TRANSFORMS = {
+    'ETRS89_to_OSGB36' : (ETRS89_to_OSGB36_array, 3),
+    'OSGB36_to_ETRS89' : (OSGB36_to_ETRS89_array, 3),
+    'll_to_grid'       : (ll_to_grid_array, 2),
+    'grid_to_ll'       : (grid_to_ll_array, 2),
+}
+
+#The TRANSFORMS which take masked=True
+MASKED_TRANSFORMS = ('ETRS89_to_OSGB36', 'OSGB36_to_ETRS89')
+
+def transform_with_mask(transform, *columns, ordered=False):
+    """Run one of TRANSFORMS over arrays without stopping at bad points.
+
+    Returns (outputs, ok): outputs is a tuple of arrays with NaN where a
+    point could not be transformed, and ok is the boolean mask of points
+    that were. With ordered=True the points are put in cell_order first
+    (the first two columns being the easting and northing) and the results
+    put back in input order, which is quicker for the OSTN02 transforms
+    when many points share cells.
+    """
+    (func, width) = TRANSFORMS[transform]
+    columns = np.broadcast_arrays(*[np.asarray(c, dtype=np.float64) for c in columns])
+    if ordered:
+        order = cell_order(columns[0], columns[1])
+        (outputs, ok) = transform_with_mask(transform, *[c.ravel()[order] for c in columns])
+        shape = columns[0].shape
+        return (tuple(_unsort(o, order).reshape(shape) for o in outputs),
+                _unsort(ok, order).reshape(shape))
+
+    if transform in MASKED_TRANSFORMS:
+        #These report coverage themselves, with no need to catch anything
+        (out, ok) = func(*columns, masked=True)
+        return (tuple(out), ok)
+
+    try:
+        out = func(*columns)
+        return (tuple(out), np.ones(columns[0].shape, dtype=bool))
+    except Exception:
+        pass
+
+    #Something failed: go one point at a time so only that row is lost
+    n = columns[0].size
+    out = [np.full(n, np.nan) for _ in range(width)]
+    ok = np.zeros(n, dtype=bool)
+    for i in range(n):
+        try:
+            values = func(*[c[i:i+1] for c in columns])
+        except Exception:
+            continue
+        for k in range(width):
+            out[k][i] = values[k][0]
+        ok[i] = True
+    return (tuple(out), ok)
+
+def _unsort(values, order):
+    #Inverse of values = original[order]
+    out = np.empty_like(values)
+    out[order] = values
+    return out
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+#OSTN02 for Python
+#=================
+
+#Bounded least recently used cache of per-cell bilinear coefficients.
+#The OSTN02 transform is Crown Copyright (C) 2002
+#See COPYING for redistribution terms
+
+import sys
+import threading
+from collections import OrderedDict
+
+#Approximate cost of one cached cell: a tuple of 12 floats, its int key and
+#the OrderedDict entry (hash table slot plus linked list node)
+CELL_ENTRY_BYTES = (sys.getsizeof(tuple(range(12))) + 12 * sys.getsizeof(1.0)
+                    + sys.getsizeof(10**6) + 100)
+
+DEFAULT_CELL_CACHE_BYTES = 4 * 1024 * 1024
+
+class CellCache(object):
+    """LRU map from cell index to coefficients, limited to max_bytes.
+
+    get() returns the cached value or calls compute(key) and stores the
+    result, evicting the least recently used cells once the budget is
+    reached. max_bytes of 0 disables caching. hits, misses and evictions
+    count what has happened since creation or the last clear().
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CELL_CACHE_BYTES):
+        self._lock = threading.Lock()
+        self._cells = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.resize(max_bytes)
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self.max_cells = max(0, int(max_bytes // CELL_ENTRY_BYTES))
+            self._evict()
+
+    def _evict(self):
+        cells = self._cells
+        while len(cells) > self.max_cells:
+            cells.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key, compute):
+        with self._lock:
+            value = self._cells.get(key)
+            if value is not None:
+                self._cells.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+        value = compute(key)
+        if self.max_cells:
+            with self._lock:
+                self._cells[key] = value
+                self._evict()
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._cells.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._cells)
+
+    def stats(self):
+        """Counters and current size as a dict."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'cells': len(self._cells),
+                    'bytes': len(self._cells) * CELL_ENTRY_BYTES,
+                    'max_bytes': self.max_bytes}
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+#OSTN02 for Python
+#=================
+
+#Streaming command line transformer, run as python -m ostn02python
+#Rows are read from CSV or newline delimited JSON, transformed a chunk at a
+#time with the array functions and written straight out again, so memory
+#use does not depend on the size of the input.
+#The OSTN02 transform is Crown Copyright (C) 2002
+#See COPYING for redistribution terms
+
+import sys
+import io
+import csv
+import json
+import argparse
+from itertools import islice
+
+import numpy as np
+
+from ostn02python.gridref import parse_gridref_array
+from ostn02python.batch import (ETRS89_to_OSGB36_array, OSGB36_to_ETRS89_array,
+                                ll_to_grid_array, grid_to_ll_array)
+
+#Coordinate systems a chain can pass through, with the default column names
+#used for each when they are not given on the command line
+STAGES = {
+    'gridref' : ('gridref',),
+    'osgb36'  : ('osgb36_e', 'osgb36_n'),
+    'etrs89'  : ('etrs89_e', 'etrs89_n'),
+    'latlon'  : ('lat', 'lon'),
+}
+
+DEFAULT_CHUNK_SIZE = 10000
+
+def _gridref_to_osgb36(refs, b, h):
+    #Malformed references are NaN with ok False, like any other bad row
+    (east, north, ok) = parse_gridref_array(refs)
+    return (east, north, h, ok)
+
+def _osgb36_to_etrs89(x, y, h):
+    ((x, y, h), ok) = OSGB36_to_ETRS89_array(x, y, h, masked=True)
+    return (x, y, h, ok)
+
+def _etrs89_to_osgb36(x, y, h):
+    ((x, y, h), ok) = ETRS89_to_OSGB36_array(x, y, h, masked=True)
+    return (x, y, h, ok)
+
+def _etrs89_to_latlon(x, y, h):
+    (lat, lon) = grid_to_ll_array(x, y)
+    return (lat, lon, h, np.isfinite(lat) & np.isfinite(lon))
+
+def _latlon_to_etrs89(lat, lon, h):
+    (x, y) = ll_to_grid_array(lat, lon)
+    return (x, y, h, np.isfinite(x) & np.isfinite(y))
+
+#Each step works on a chunk: (a, b, h) arrays in, (a, b, h, ok) arrays out,
+#ok being False for rows the step could not transform
+STEPS = {
+    ('gridref', 'osgb36') : _gridref_to_osgb36,
+    ('osgb36', 'etrs89')  : _osgb36_to_etrs89,
+    ('etrs89', 'osgb36')  : _etrs89_to_osgb36,
+    ('etrs89', 'latlon')  : _etrs89_to_latlon,
+    ('latlon', 'etrs89')  : _latlon_to_etrs89,
+}
+
+def parse_chain(text):
+    """Split "gridref,osgb36,etrs89,latlon" into stages, checking each step exists."""
+    chain = [stage.strip().lower() for stage in text.split(',') if stage.strip()]
+    if len(chain) < 2:
+        raise ValueError("A chain needs at least two stages")
+    for stage in chain:
+        if stage not in STAGES:
+            raise ValueError("Unknown stage {0!r}, expected one of {1}".format(stage, ", ".join(sorted(STAGES))))
+    for step in zip(chain, chain[1:]):
+        if step not in STEPS:
+            raise ValueError("No transform from {0} to {1}".format(*step))
+    return chain
+
+def _run_chain(chain, a, b, h):
+    ok = np.ones(len(h), dtype=bool)
+    for step in zip(chain, chain[1:]):
+        (a, b, h, step_ok) = STEPS[step](a, b, h)
+        ok &= step_ok
+    return (a, b, h, ok)
+
+def _floats(chunk, name):
+    #Column name of the rows as floats, NaN where missing or not a number
+    values = np.empty(len(chunk))
+    for i, row in enumerate(chunk):
+        try:
+            values[i] = float(row[name])
+        except (KeyError, TypeError, ValueError):
+            values[i] = np.nan
+    return values
+
+def _chunk_size(text):
+    #argparse type for --chunk-size
+    size = int(text)
+    if size < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, not {0}".format(size))
+    return size
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def transform_rows(rows, chain, columns=None, output=None, height=None,
+                   chunk_size=DEFAULT_CHUNK_SIZE, on_error='fail'):
+    """Generator applying a transform chain to an iterable of dict rows.
+
+    columns name the input fields for the first stage and output the fields
+    written for the last stage (defaults from STAGES). height optionally
+    names a field carried through the OSGB36/ETRS89 steps; its transformed
+    value is written back to the same field, and a row where it is missing
+    or not a number cannot be transformed. on_error is 'fail' to raise ValueError,
+    'blank' to set the outputs of a bad row to None or 'skip' to drop it.
+    Rows are yielded in input order. chunk_size rows are transformed at a
+    time and must be at least 1.
+    """
+    columns = tuple(columns or STAGES[chain[0]])
+    output = tuple(output or STAGES[chain[-1]])
+    if len(columns) != len(STAGES[chain[0]]):
+        raise ValueError("Stage {0} takes {1} column(s)".format(chain[0], len(STAGES[chain[0]])))
+    if len(output) != len(STAGES[chain[-1]]):
+        raise ValueError("Stage {0} gives {1} column(s)".format(chain[-1], len(STAGES[chain[-1]])))
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1, not {0}".format(chunk_size))
+
+    def inputs(chunk):
+        if chain[0] == 'gridref':
+            a = [str(row.get(columns[0]) or '') for row in chunk]
+            b = None
+        else:
+            a = _floats(chunk, columns[0])
+            b = _floats(chunk, columns[1])
+        if height:
+            h = _floats(chunk, height)
+        else:
+            h = np.zeros(len(chunk))
+        return (a, b, h)
+
+    def store(row, a, b, h):
+        row[output[0]] = float(a)
+        row[output[1]] = float(b)
+        if height:
+            row[height] = float(h)
+        return row
+
+    def blank(row):
+        for name in output:
+            row[name] = None
+        return row
+
+    fields = columns + ((height,) if height else ())
+
+    #Every step reports bad rows in its mask, so a chunk is always one
+    #array call per step however many of its rows fail
+    for chunk in _chunks(rows, chunk_size):
+        (a, b, h, ok) = _run_chain(chain, *inputs(chunk))
+        if height:
+            #A height that is missing or not a number makes a bad row too
+            ok &= np.isfinite(h)
+        if on_error == 'fail' and not ok.all():
+            row = chunk[np.flatnonzero(~ok)[0]]
+            raise ValueError("Cannot transform {0}".format(
+                ", ".join("{0}={1!r}".format(c, row.get(c)) for c in fields)))
+        for i, row in enumerate(chunk):
+            if ok[i]:
+                yield store(row, a[i], b[i], h[i])
+            elif on_error == 'blank':
+                yield blank(row)
+
+def read_csv(stream):
+    return csv.DictReader(stream)
+
+def read_ndjson(stream):
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+def write_csv(rows, stream):
+    writer = None
+    for row in rows:
+        if writer is None:
+            writer = csv.DictWriter(stream, fieldnames=list(row.keys()), lineterminator='\n')
+            writer.writeheader()
+        writer.writerow(row)
+
+def write_ndjson(rows, stream):
+    for row in rows:
+        stream.write(json.dumps(row))
+        stream.write('\n')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m ostn02python',
+        description="Stream CSV or NDJSON rows through a chain of coordinate transforms.")
+    parser.add_argument('input', nargs='?', default='-', help="input file, or - for stdin (default)")
+    parser.add_argument('-o', '--output-file', default='-', help="output file, or - for stdout (default)")
+    parser.add_argument('-f', '--format', choices=('csv', 'ndjson'),
+                        help="input and output format (default: from the file extension, else csv)")
+    parser.add_argument('-c', '--chain', default='gridref,osgb36,etrs89,latlon',
+                        help="comma separated stages out of " + ", ".join(sorted(STAGES)) +
+                             " (default: gridref,osgb36,etrs89,latlon)")
+    parser.add_argument('--columns', help="comma separated input column names for the first stage")
+    parser.add_argument('--output', help="comma separated column names for the last stage")
+    parser.add_argument('--height', help="column holding heights to carry through the transforms")
+    parser.add_argument('--chunk-size', type=_chunk_size, default=DEFAULT_CHUNK_SIZE,
+                        help="rows transformed at a time (default {0})".format(DEFAULT_CHUNK_SIZE))
+    parser.add_argument('--on-error', choices=('fail', 'blank', 'skip'), default='fail',
+                        help="what to do with rows that cannot be transformed (default fail)")
+    args = parser.parse_args(argv)
+
+    try:
+        chain = parse_chain(args.chain)
+    except ValueError as e:
+        parser.error(str(e))
+
+    fmt = args.format
+    if fmt is None:
+        fmt = 'ndjson' if args.input.endswith(('.ndjson', '.jsonl')) else 'csv'
+
+    if args.input == '-':
+        instream = io.TextIOWrapper(sys.stdin.buffer, newline='')
+    else:
+        instream = open(args.input, newline='')
+    if args.output_file == '-':
+        outstream = sys.stdout
+    else:
+        outstream = open(args.output_file, 'w', newline='')
+
+    try:
+        rows = read_ndjson(instream) if fmt == 'ndjson' else read_csv(instream)
+        rows = transform_rows(rows, chain,
+                              columns=args.columns.split(',') if args.columns else None,
+                              output=args.output.split(',') if args.output else None,
+                              height=args.height, chunk_size=args.chunk_size,
+                              on_error=args.on_error)
+        if fmt == 'ndjson':
+            write_ndjson(rows, outstream)
+        else:
+            write_csv(rows, outstream)
+    except ValueError as e:
+        parser.exit(1, "{0}: error: {1}\n".format(parser.prog, e))
+    finally:
+        if args.input != '-':
+            instream.close()
+        if args.output_file != '-':
+            outstream.close()
+    return 0
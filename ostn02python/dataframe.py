@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+#OSTN02 for Python
+#=================
+
+#The batch transforms on pandas and Arrow columns. Float64 columns without
+#missing values are handed to the NumPy kernels as views of their own
+#buffers; other columns are converted once, with missing values as NaN.
+#Results come back as new columns and a validity mask, with a bad row
+#costing only that row. Neither pandas nor pyarrow is needed to import
+#this module: they are imported when first used. Call register_accessor()
+#once to get df.ostn.to_etrs89(x="e", y="n") and friends.
+#The OSTN02 transform is Crown Copyright (C) 2002
+#See COPYING for redistribution terms
+
+import numpy as np
+
+from ostn02python.batch import transform_with_mask
+
+#Transforms by name: the batch transforms applied in turn and the default
+#names of the (east or lat, north or lon, height) columns they give
+CHAINS = {
+    'to_etrs89'   : (('OSGB36_to_ETRS89',), ('etrs89_e', 'etrs89_n', 'etrs89_h')),
+    'to_osgb36'   : (('ETRS89_to_OSGB36',), ('osgb36_e', 'osgb36_n', 'osgb36_h')),
+    'to_latlon'   : (('OSGB36_to_ETRS89', 'grid_to_ll'), ('lat', 'lon', 'etrs89_h')),
+    'from_latlon' : (('ll_to_grid', 'ETRS89_to_OSGB36'), ('osgb36_e', 'osgb36_n', 'osgb36_h')),
+}
+
+def transform_columns(transform, a, b, h=None):
+    """Run one of CHAINS over float arrays. Returns ((a, b, h), ok) as
+    batch.transform_with_mask, h being zero in and the transformed height
+    out when it is not given."""
+    if transform not in CHAINS:
+        raise ValueError("Unknown transform {0!r}, expected one of {1}".format(
+            transform, ", ".join(sorted(CHAINS))))
+    (a, b) = np.broadcast_arrays(np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64))
+    h = np.zeros(a.shape) if h is None else np.asarray(h, dtype=np.float64)
+    ok = np.ones(a.shape, dtype=bool)
+    for step in CHAINS[transform][0]:
+        if step in ('ll_to_grid', 'grid_to_ll'):
+            ((a, b), step_ok) = transform_with_mask(step, a, b)
+        else:
+            ((a, b, h), step_ok) = transform_with_mask(step, a, b, h)
+        ok &= step_ok
+    return ((a, b, h), ok)
+
+def _series_values(series):
+    #A float64 column without missing values is used in place
+    if series.dtype == np.float64:
+        return series.to_numpy(copy=False)
+    return series.to_numpy(dtype=np.float64, na_value=np.nan)
+
+def _arrow_values(array):
+    import pyarrow as pa
+    if isinstance(array, pa.ChunkedArray):
+        if array.num_chunks != 1:
+            #Chunks are contiguous only one at a time, so join them
+            return np.concatenate([_arrow_values(c) for c in array.chunks] or [np.zeros(0)])
+        array = array.chunk(0)
+    if pa.types.is_float64(array.type) and array.null_count == 0:
+        return array.to_numpy(zero_copy_only=True)
+    return array.cast(pa.float64()).to_numpy(zero_copy_only=False)
+
+class OSTNAccessor(object):
+    """The df.ostn accessor added by register_accessor(). Each method takes
+    the names of the input columns and returns (frame, ok): a new DataFrame
+    of the output columns, on the same index, and a boolean Series which
+    is False (with NaN outputs) for rows that could not be transformed.
+    names overrides the output column names given in CHAINS."""
+
+    def __init__(self, frame):
+        self._frame = frame
+
+    def _run(self, transform, a, b, h, names):
+        import pandas as pd
+        frame = self._frame
+        columns = [_series_values(frame[a]), _series_values(frame[b])]
+        columns.append(None if h is None else _series_values(frame[h]))
+        (outputs, ok) = transform_columns(transform, *columns)
+        names = tuple(names or CHAINS[transform][1])
+        out = pd.DataFrame(dict(zip(names, outputs)), index=frame.index, copy=False)
+        return (out, pd.Series(ok, index=frame.index, name='ok'))
+
+    def to_etrs89(self, x, y, z=None, names=None):
+        """OSGB36 eastings, northings and heights to ETRS89."""
+        return self._run('to_etrs89', x, y, z, names)
+
+    def to_osgb36(self, x, y, z=None, names=None):
+        """ETRS89 eastings, northings and heights to OSGB36."""
+        return self._run('to_osgb36', x, y, z, names)
+
+    def to_latlon(self, x, y, z=None, names=None):
+        """OSGB36 eastings, northings and heights to ETRS89 latitude,
+        longitude and height."""
+        return self._run('to_latlon', x, y, z, names)
+
+    def from_latlon(self, lat, lon, z=None, names=None):
+        """ETRS89 latitude, longitude and height to OSGB36."""
+        return self._run('from_latlon', lat, lon, z, names)
+
+def register_accessor(name='ostn'):
+    """Register OSTNAccessor as a pandas DataFrame accessor called name.
+    Registering the same name again does nothing."""
+    import pandas as pd
+    existing = pd.DataFrame.__dict__.get(name)
+    if getattr(existing, '_accessor', None) is OSTNAccessor:
+        return
+    pd.api.extensions.register_dataframe_accessor(name)(OSTNAccessor)
+
+def transform_arrow(transform, a, b, h=None):
+    """Run one of CHAINS over pyarrow Arrays or ChunkedArrays. Returns
+    ((a, b, h), ok): float64 Arrays which are null where the transform
+    failed, and ok as a BooleanArray."""
+    import pyarrow as pa
+    columns = [_arrow_values(a), _arrow_values(b), None if h is None else _arrow_values(h)]
+    (outputs, ok) = transform_columns(transform, *columns)
+    return (tuple(pa.array(o, mask=~ok) for o in outputs), pa.array(ok))
@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+#OSTN02 for Python
+#=================
+
+#Streaming GeoJSON transformer. A FeatureCollection is read one feature at
+#a time, the vertices of a run of features are flattened into arrays for
+#the batch transforms, and the features are written out again as they are
+#done, so memory use does not grow with the size of the document. Vertices
+#seen recently (shared edges between polygons, road junctions) are looked
+#up in a bounded cache rather than transformed again.
+#Run with python -m ostn02python.geojson
+#The OSTN02 transform is Crown Copyright (C) 2002
+#See COPYING for redistribution terms
+
+import os
+import sys
+import json
+import argparse
+from itertools import islice
+
+import numpy as np
+
+from ostn02python.batch import transform_with_mask
+
+#Output coordinate system: the batch transforms applied in turn, and the
+#crs member written on the output collection (None to leave it out, as
+#RFC 7946 GeoJSON is always lon/lat)
+TARGETS = {
+    'osgb36' : (('ll_to_grid', 'ETRS89_to_OSGB36'),
+                {'type': 'name', 'properties': {'name': 'urn:ogc:def:crs:EPSG::27700'}}),
+    'latlon' : (('OSGB36_to_ETRS89', 'grid_to_ll'), None),
+}
+
+DEFAULT_CHUNK_SIZE = 10000
+DEFAULT_WINDOW = 100000
+
+class OutsideOSTN02Error(ValueError):
+    """A feature has a vertex outside OSTN02 and on_error is 'fail'."""
+
+def _check_collection(members):
+    if members.get('type') != 'FeatureCollection':
+        raise ValueError("Expected a GeoJSON FeatureCollection but found type {0!r}".format(
+            members.get('type')))
+
+class FeatureReader(object):
+    """Reads a GeoJSON FeatureCollection from a text stream incrementally.
+
+    The members that come before "features" are in members once the reader
+    is made; iterating gives the features one at a time, after which any
+    members that followed the features array are in trailing. ValueError
+    is raised if the object is not a FeatureCollection: when the reader is
+    made, or after the features if "type" only comes after them.
+    """
+
+    def __init__(self, stream, buffer_size=65536):
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.members = {}
+        self.trailing = {}
+        self._decoder = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        self._state = 'start'
+        self._read_members(self.members)
+        if self._state != 'features' or 'type' in self.members:
+            _check_collection(self.members)
+
+    def _fill(self, size=None):
+        if self._pos > self.buffer_size:
+            self._buf = self._buf[self._pos:]
+            self._pos = 0
+        data = self.stream.read(size or self.buffer_size)
+        if not data:
+            self._eof = True
+        self._buf += data
+
+    def _peek(self):
+        #Next character after any whitespace, or '' at the end of the input
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in ' \t\r\n':
+                self._pos += 1
+            if self._pos < len(self._buf) or self._eof:
+                return self._buf[self._pos:self._pos+1]
+            self._fill()
+
+    def _expect(self, chars):
+        c = self._peek()
+        if not c or c not in chars:
+            raise ValueError("Expected {0!r} but found {1!r} in GeoJSON".format(chars, c))
+        self._pos += 1
+        return c
+
+    def _value(self):
+        self._peek()
+        size = self.buffer_size
+        while True:
+            try:
+                (value, end) = self._decoder.raw_decode(self._buf, self._pos)
+            except ValueError:
+                if self._eof:
+                    raise
+            else:
+                #A number at the end of the buffer may carry on in the next read
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return value
+            self._fill(size)
+            #Each retry parses the value from its start, so for a value
+            #larger than the buffer read as much again as is held each
+            #time: the buffer doubles and the total work stays linear
+            size = max(size, len(self._buf) - self._pos)
+
+    def _read_members(self, members):
+        #Members up to (and including the opening bracket of) the features
+        #array, or to the end of the object
+        if self._state == 'start':
+            self._expect('{')
+            if self._peek() == '}':
+                self._pos += 1
+                self._state = 'done'
+                return
+        while True:
+            key = self._value()
+            self._expect(':')
+            if key == 'features':
+                self._expect('[')
+                self._state = 'features'
+                return
+            members[key] = self._value()
+            if self._expect(',}') == '}':
+                self._state = 'done'
+                return
+
+    def __iter__(self):
+        if self._state != 'features':
+            return
+        if self._peek() == ']':
+            self._pos += 1
+        else:
+            while True:
+                yield self._value()
+                if self._expect(',]') == ']':
+                    break
+        if self._expect(',}') == ',':
+            self._state = 'members'
+            self._read_members(self.trailing)
+        self._state = 'done'
+        if 'type' not in self.members:
+            _check_collection(self.trailing)
+
+def write_feature_collection(members, features, stream, trailing=None):
+    """Write a FeatureCollection to a text stream, one feature per line,
+    taking features from any iterable (such as a generator)."""
+    stream.write('{')
+    for key, value in members.items():
+        stream.write('{0}: {1}, '.format(json.dumps(key), json.dumps(value)))
+    stream.write('"features": [')
+    first = True
+    for feature in features:
+        stream.write('\n' if first else ',\n')
+        stream.write(json.dumps(feature))
+        first = False
+    stream.write('\n]')
+    for key, value in (trailing or {}).items():
+        stream.write(', {0}: {1}'.format(json.dumps(key), json.dumps(value)))
+    stream.write('}\n')
+
+def _positions(geometry, out):
+    #Append every position (the innermost [x, y] or [x, y, z] lists) of a
+    #geometry to out, and drop bounding boxes, which would be wrong after
+    if not geometry:
+        return out
+    geometry.pop('bbox', None)
+    if geometry.get('type') == 'GeometryCollection':
+        for part in geometry.get('geometries', ()):
+            _positions(part, out)
+        return out
+    stack = [geometry.get('coordinates')]
+    while stack:
+        item = stack.pop()
+        if not item:
+            continue
+        if isinstance(item[0], (int, float)):
+            out.append(item)
+        else:
+            stack.extend(item)
+    return out
+
+class VertexCache(object):
+    """The results for the last window distinct vertices, so a vertex shared
+    by neighbouring features is only transformed once. The oldest vertex
+    is forgotten first."""
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        self.window = window
+        self._results = {}
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, keys):
+        #The result for each key, or None where it is not known
+        results = list(map(self._results.get, keys))
+        self.hits += len(results) - results.count(None)
+        return results
+
+    def update(self, results):
+        self.misses += len(results)
+        if self.window <= 0:
+            return
+        self._results.update(results)
+        excess = len(self._results) - self.window
+        if excess > 0:
+            for key in list(islice(self._results, excess)):
+                del self._results[key]
+
+def _transform_chunk(chunk, steps, cache):
+    #Transform the positions of a list of (feature, positions) in place.
+    #Returns a list with, for each feature, whether all of its positions
+    #were transformed.
+    positions = []
+    owners = []
+    for n, (feature, found) in enumerate(chunk):
+        positions.extend(found)
+        owners.extend([n] * len(found))
+
+    keys = list(map(tuple, positions))
+    results = cache.lookup(keys)
+    todo = {}
+    for key, result in zip(keys, results):
+        if result is None:
+            todo[key] = None
+    if todo:
+        #Every distinct new vertex goes through the batch transforms once
+        new = list(todo)
+        a = np.array([k[0] for k in new], dtype=np.float64)
+        b = np.array([k[1] for k in new], dtype=np.float64)
+        h = np.array([k[2] if len(k) > 2 else 0.0 for k in new], dtype=np.float64)
+        ok = np.ones(len(new), dtype=bool)
+        for step in steps:
+            if step == 'll_to_grid':
+                #GeoJSON positions are lon, lat; the functions take lat, lon
+                ((a, b), ok_step) = transform_with_mask(step, b, a)
+            elif step == 'grid_to_ll':
+                ((b, a), ok_step) = transform_with_mask(step, a, b)
+            else:
+                ((a, b, h), ok_step) = transform_with_mask(step, a, b, h)
+            ok &= ok_step
+        values = [(x, y, z) if good else False
+                for x, y, z, good in zip(a.tolist(), b.tolist(), h.tolist(), ok.tolist())]
+        todo = dict(zip(new, values))
+        cache.update(todo)
+        results = [todo[key] if result is None else result for key, result in zip(keys, results)]
+
+    done = [True] * len(chunk)
+    for position, owner, result in zip(positions, owners, results):
+        if result is False:
+            done[owner] = False
+        else:
+            position[:] = result[:len(position)]
+    return done
+
+def transform_features(features, to='osgb36', chunk_size=DEFAULT_CHUNK_SIZE,
+                       window=DEFAULT_WINDOW, on_error='fail', cache=None):
+    """Generator transforming the geometries of GeoJSON features.
+
+    to is 'osgb36' for ETRS89 lon/lat in and OSGB36 eastings and northings
+    out, or 'latlon' for the reverse. Features are gathered until they hold
+    chunk_size vertices and then transformed together. The results for the
+    last window distinct vertices are kept and reused. on_error is 'fail'
+    to raise OutsideOSTN02Error for a feature with a vertex outside OSTN02,
+    'blank' to set its
+    geometry to null or 'skip' to drop it. Positions with a third value
+    have it transformed as a height.
+    """
+    steps = TARGETS[to][0]
+    if cache is None:
+        cache = VertexCache(window)
+    chunk = []
+    vertices = 0
+    for feature in features:
+        feature.pop('bbox', None)
+        found = _positions(feature.get('geometry'), [])
+        chunk.append((feature, found))
+        vertices += len(found)
+        if vertices >= chunk_size:
+            for feature in _finish(chunk, steps, cache, on_error):
+                yield feature
+            chunk = []
+            vertices = 0
+    for feature in _finish(chunk, steps, cache, on_error):
+        yield feature
+
+def _finish(chunk, steps, cache, on_error):
+    if not chunk:
+        return
+    done = _transform_chunk(chunk, steps, cache)
+    for (feature, found), ok in zip(chunk, done):
+        if ok:
+            yield feature
+        elif on_error == 'fail':
+            raise OutsideOSTN02Error("OSTN02 is not defined at a vertex of feature {0}".format(
+                json.dumps(feature.get('id'))))
+        elif on_error == 'blank':
+            feature['geometry'] = None
+            yield feature
+
+def transform_collection(instream, outstream, to='osgb36', **kwargs):
+    """Stream a FeatureCollection from instream to outstream, transforming
+    its features with transform_features(..., **kwargs). A crs member is
+    written for OSGB36 output and dropped for lon/lat."""
+    reader = FeatureReader(instream)
+    members = dict(reader.members)
+    members.pop('crs', None)
+    members.pop('bbox', None)
+    crs = TARGETS[to][1]
+    if crs is not None:
+        members['crs'] = crs
+    write_feature_collection(members, transform_features(reader, to, **kwargs),
+                             outstream, reader.trailing)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m ostn02python.geojson',
+        description="Stream a GeoJSON FeatureCollection between ETRS89 lon/lat and OSGB36.")
+    parser.add_argument('input', nargs='?', default='-', help="input file, or - for stdin (default)")
+    parser.add_argument('-o', '--output-file', default='-', help="output file, or - for stdout (default)")
+    parser.add_argument('--to', choices=sorted(TARGETS), default='osgb36',
+                        help="osgb36 (from ETRS89 lon/lat, the default) or latlon (from OSGB36)")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="vertices transformed at a time (default {0})".format(DEFAULT_CHUNK_SIZE))
+    parser.add_argument('--window', type=int, default=DEFAULT_WINDOW,
+                        help="distinct vertices remembered for reuse (default {0})".format(DEFAULT_WINDOW))
+    parser.add_argument('--on-error', choices=('fail', 'blank', 'skip'), default='fail',
+                        help="what to do with features outside OSTN02 (default fail)")
+    args = parser.parse_args(argv)
+
+    instream = sys.stdin if args.input == '-' else open(args.input)
+    #A file is written under a temporary name and renamed into place once
+    #it is complete, so a failure part way leaves no truncated output
+    if args.output_file == '-':
+        outstream = sys.stdout
+    else:
+        tmp = "{0}.{1}.tmp".format(args.output_file, os.getpid())
+        outstream = open(tmp, 'w')
+    done = False
+    try:
+        transform_collection(instream, outstream, args.to, chunk_size=args.chunk_size,
+                             window=args.window, on_error=args.on_error)
+        done = True
+    except ValueError as e:
+        parser.exit(1, "{0}: error: {1}\n".format(parser.prog, e))
+    finally:
+        if args.input != '-':
+            instream.close()
+        if args.output_file != '-':
+            outstream.close()
+            if done:
+                os.replace(tmp, args.output_file)
+            else:
+                os.remove(tmp)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,452 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+#OSTN02 for Python
+#=================
+
+#Storage for the OSTN02 shift grid.
+#The OSTN02 transform is Crown Copyright (C) 2002
+#See COPYING for redistribution terms
+
+import os
+import sys
+import bz2
+import math
+import mmap
+import struct
+import threading
+import zlib
+from array import array
+
+#Grid nodes are every 1km from (0,0) to (700km,1250km) inclusive
+GRID_WIDTH  =  701
+GRID_HEIGHT = 1251
+GRID_SIZE   = GRID_WIDTH * GRID_HEIGHT
+
+DEFAULT_SOURCE = os.path.join(os.path.dirname(__file__), 'ostn02data.txt.bz2')
+
+#Compiled binary copy of the grid, see compile_grid_cache()
+#The location can be overridden with the OSTN02_GRID_CACHE environment variable
+DEFAULT_CACHE = os.path.join(os.path.dirname(__file__), 'ostn02data.bin')
+
+#Cache header: magic, format version, width, height, source file size,
+#source file crc32, payload crc32. Planes follow as little endian uint16
+#east, north and height then the uint8 validity mask.
+CACHE_MAGIC = b'OSTN02GR'
+CACHE_VERSION = 1
+CACHE_HEADER = struct.Struct('<8sIIIIII')
+CACHE_HEADER_SIZE = 64
+
+class ShiftGrid(object):
+    """The OSTN02 shifts held as three dense uint16 planes plus a validity mask.
+
+    Node (e_index, n_index) lives at position n_index * GRID_WIDTH + e_index
+    of each plane. Values are the raw integers from the OSTN02 data file, i.e.
+    millimetres above MIN_X_SHIFT, MIN_Y_SHIFT and MIN_Z_SHIFT. The valid
+    plane is 1 where the node has data and 0 where OSTN02 is undefined.
+    """
+
+    #Set by TiledGrid, whose cells must be passed to require() before their
+    #nodes are read
+    tile_km = None
+
+    def __init__(self, east, north, height, valid, coverage=None):
+        self.east = east
+        self.north = north
+        self.height = height
+        self.valid = valid
+        #Set when the planes are views of a memory mapped cache file
+        self.mmap = None
+        #A coverage mask to use instead of the one worked out from valid,
+        #e.g. one restricted to a region
+        self._coverage = coverage
+
+    @property
+    def coverage(self):
+        """Bit packed mask of the cells with data at all four corners, see
+        coverage_mask(). Worked out from valid the first time it is used."""
+        if self._coverage is None:
+            self._coverage = coverage_mask(self.valid)
+        return self._coverage
+
+    def covers(self, i0):
+        """True if the cell with south west corner node i0 has data at all
+        four corners, so shifts can be interpolated anywhere inside it."""
+        return (self.coverage[i0 >> 3] >> (i0 & 7)) & 1 == 1
+
+    @classmethod
+    def empty(cls):
+        return cls(array('H', [0]) * GRID_SIZE, array('H', [0]) * GRID_SIZE,
+                   array('H', [0]) * GRID_SIZE, bytearray(GRID_SIZE))
+
+    def index(self, e_index, n_index):
+        """Position of a node in the planes, or None if it is off the grid."""
+        if 0 <= e_index < GRID_WIDTH and 0 <= n_index < GRID_HEIGHT:
+            return n_index * GRID_WIDTH + e_index
+        return None
+
+    def node(self, e_index, n_index):
+        """Raw (east, north, height) integers at a node, or None if undefined."""
+        i = self.index(e_index, n_index)
+        if i is None or not self.valid[i]:
+            return None
+        return (self.east[i], self.north[i], self.height[i])
+
+    def __len__(self):
+        #Number of defined nodes
+        return bytes(self.valid).count(b'\x01')
+
+#Cells are numbered by their south west corner node, so there are
+#COVERAGE_BITS of them (the last column is never covered)
+COVERAGE_BITS = GRID_WIDTH * (GRID_HEIGHT-1)
+
+#Multiplying eight bytes, each 0 or 1, by this gathers their low bits into
+#the top byte, the first byte going to the lowest bit
+_GATHER_BITS = 0x0102040810204080
+
+def coverage_mask(valid):
+    """Pack the cells whose four corner nodes are all valid into a bytes
+    object of one bit per cell: cell i0 is bit i0 & 7 of byte i0 >> 3."""
+    valid = bytes(valid)
+    #AND the validity of each corner for all cells at once, as big integers
+    #holding one byte per node
+    cells = int.from_bytes((b'\x01' * (GRID_WIDTH-1) + b'\x00') * (GRID_HEIGHT-1), 'little')
+    for offset in (0, 1, GRID_WIDTH, GRID_WIDTH+1):
+        cells &= int.from_bytes(valid[offset:offset+COVERAGE_BITS], 'little')
+    words = array('Q')
+    words.frombytes(cells.to_bytes(COVERAGE_BITS + (-COVERAGE_BITS) % 8, 'little'))
+    if sys.byteorder != 'little':
+        words.byteswap()
+    return bytes([((w * _GATHER_BITS) >> 56) & 0xff for w in words])
+
+def read_ostn02_text(filename=DEFAULT_SOURCE):
+    """Parse the bz2 compressed OSTN02 text file into a ShiftGrid.
+
+    Each line is nnneee followed by three 4 digit hex shifts, where nnn and
+    eee are the hex northing and easting of the node in km.
+    """
+    grid = ShiftGrid.empty()
+    east, north, height, valid = grid.east, grid.north, grid.height, grid.valid
+    fi = bz2.BZ2File(filename)
+    try:
+        for line in fi:
+            i = int(line[0:3], 16) * GRID_WIDTH + int(line[3:6], 16)
+            east[i] = int(line[6:10], 16)
+            north[i] = int(line[10:14], 16)
+            height[i] = int(line[14:18], 16)
+            valid[i] = 1
+    finally:
+        fi.close()
+    return grid
+
+def default_cache_path():
+    return os.environ.get('OSTN02_GRID_CACHE', DEFAULT_CACHE)
+
+def _source_fingerprint(source):
+    with open(source, 'rb') as fi:
+        data = fi.read()
+    return len(data), zlib.crc32(data) & 0xffffffff
+
+def compile_grid_cache(path=None, source=DEFAULT_SOURCE):
+    """Convert the bz2 text grid into the uncompressed binary cache at path.
+
+    The file is written to a temporary name and renamed into place, so
+    processes opening the cache concurrently never see a partial file.
+    Returns the path written.
+    """
+    if path is None:
+        path = default_cache_path()
+    grid = read_ostn02_text(source)
+    planes = []
+    for plane in (grid.east, grid.north, grid.height):
+        if sys.byteorder != 'little':
+            plane = array('H', plane)
+            plane.byteswap()
+        planes.append(plane.tobytes())
+    planes.append(bytes(grid.valid))
+    payload = b''.join(planes)
+    size, crc = _source_fingerprint(source)
+    header = CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, GRID_WIDTH, GRID_HEIGHT,
+                               size, crc, zlib.crc32(payload) & 0xffffffff)
+    header = header.ljust(CACHE_HEADER_SIZE, b'\0')
+    tmp = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(tmp, 'wb') as fo:
+        fo.write(header)
+        fo.write(payload)
+    os.replace(tmp, path)
+    return path
+
+def open_grid_cache(path=None, source=DEFAULT_SOURCE):
+    """Memory map a cache written by compile_grid_cache as a ShiftGrid.
+
+    Returns None if the cache is missing, damaged or was built from a
+    different source file. The planes are read only views of the mapping,
+    so every process using the same file shares one copy in the page cache.
+    """
+    if path is None:
+        path = default_cache_path()
+    if sys.byteorder != 'little':
+        return None
+    try:
+        fi = open(path, 'rb')
+    except (IOError, OSError):
+        return None
+    try:
+        mm = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, mmap.error):
+        return None
+    finally:
+        fi.close()
+
+    plane_size = 2 * GRID_SIZE
+    if len(mm) != CACHE_HEADER_SIZE + 3 * plane_size + GRID_SIZE:
+        mm.close()
+        return None
+    magic, version, width, height, size, crc, payload_crc = \
+        CACHE_HEADER.unpack_from(mm, 0)
+    if (magic != CACHE_MAGIC or version != CACHE_VERSION
+            or width != GRID_WIDTH or height != GRID_HEIGHT
+            or (size, crc) != _source_fingerprint(source)):
+        mm.close()
+        return None
+
+    view = memoryview(mm)[CACHE_HEADER_SIZE:]
+    if zlib.crc32(view) & 0xffffffff != payload_crc:
+        view.release()
+        mm.close()
+        return None
+    grid = ShiftGrid(view[0:plane_size].cast('H'),
+                     view[plane_size:2*plane_size].cast('H'),
+                     view[2*plane_size:3*plane_size].cast('H'),
+                     view[3*plane_size:])
+    grid.mmap = mm
+    return grid
+
+def load_grid(cache=None, source=DEFAULT_SOURCE):
+    """The binary cache if it is usable, otherwise parse the bz2 source."""
+    grid = open_grid_cache(cache, source)
+    if grid is None:
+        grid = read_ostn02_text(source)
+    return grid
+
+#Tiled copy of the grid, see compile_tiled_grid(). Tiles are read and
+#inflated the first time a cell in them is needed, so a process serving one
+#region only holds that region's shifts in memory. The location can be set
+#with the OSTN02_TILED_GRID environment variable.
+DEFAULT_TILED = os.path.join(os.path.dirname(__file__), 'ostn02data.tiles')
+DEFAULT_TILE_KM = 50
+
+#Tiled header: magic, format version, width, height, tile size in km,
+#source file size, source file crc32. The coverage mask of the whole grid
+#follows, then an index of (offset, length, crc32) per tile, row by row
+#from the south west, then the zlib compressed tiles. Each tile holds its
+#nodes row by row as little endian uint16 east, north and height then the
+#uint8 validity mask; tiles without data have length 0.
+TILED_MAGIC = b'OSTN02TL'
+TILED_VERSION = 1
+TILED_HEADER = struct.Struct('<8sIIIIII')
+TILED_HEADER_SIZE = 64
+TILED_INDEX = struct.Struct('<III')
+COVERAGE_BYTES = (COVERAGE_BITS + 7) // 8
+
+def default_tiled_path():
+    return os.environ.get('OSTN02_TILED_GRID', DEFAULT_TILED)
+
+def _tile_counts(tile_km):
+    #Tiles across and up, so that every node is in exactly one tile
+    return (-(-GRID_WIDTH // tile_km), -(-GRID_HEIGHT // tile_km))
+
+def _tile_bounds(tile, tile_km):
+    #Node index ranges e0:e1, n0:n1 of a tile
+    (row, column) = divmod(tile, _tile_counts(tile_km)[0])
+    return (column*tile_km, min((column+1)*tile_km, GRID_WIDTH),
+            row*tile_km, min((row+1)*tile_km, GRID_HEIGHT))
+
+def compile_tiled_grid(path=None, source=DEFAULT_SOURCE, tile_km=DEFAULT_TILE_KM):
+    """Convert the bz2 text grid into the tiled format read by TiledGrid.
+    Written to a temporary name and renamed into place, as
+    compile_grid_cache(). Returns the path written."""
+    if path is None:
+        path = default_tiled_path()
+    grid = read_ostn02_text(source)
+    valid = bytes(grid.valid)
+    planes = []
+    for plane in (grid.east, grid.north, grid.height):
+        if sys.byteorder != 'little':
+            plane = array('H', plane)
+            plane.byteswap()
+        planes.append(plane.tobytes())
+
+    (columns, rows) = _tile_counts(tile_km)
+    tiles = []
+    for tile in range(columns * rows):
+        (e0, e1, n0, n1) = _tile_bounds(tile, tile_km)
+        parts = [[], [], [], []]
+        for n in range(n0, n1):
+            (start, stop) = (n*GRID_WIDTH + e0, n*GRID_WIDTH + e1)
+            for k in range(3):
+                parts[k].append(planes[k][2*start:2*stop])
+            parts[3].append(valid[start:stop])
+        if b'\x01' not in b''.join(parts[3]):
+            tiles.append(b'')
+        else:
+            tiles.append(zlib.compress(b''.join(b''.join(p) for p in parts), 9))
+
+    size, crc = _source_fingerprint(source)
+    header = TILED_HEADER.pack(
+        TILED_MAGIC, TILED_VERSION, GRID_WIDTH, GRID_HEIGHT, tile_km, size, crc)
+    offset = TILED_HEADER_SIZE + COVERAGE_BYTES + TILED_INDEX.size * len(tiles)
+    index = []
+    for data in tiles:
+        index.append(TILED_INDEX.pack(offset, len(data), zlib.crc32(data) & 0xffffffff))
+        offset += len(data)
+    tmp = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(tmp, 'wb') as fo:
+        fo.write(header.ljust(TILED_HEADER_SIZE, b'\0'))
+        fo.write(coverage_mask(valid))
+        fo.write(b''.join(index))
+        fo.write(b''.join(tiles))
+    os.replace(tmp, path)
+    return path
+
+def _bbox_cells(bbox):
+    #Big integer with a bit set for every cell within one cell of bbox, laid
+    #out as the coverage mask. The margin lets the inverse, which looks up
+    #the shifts some way from the point it is given, work up to the edges.
+    (min_x, min_y, max_x, max_y) = bbox
+    e0 = max(int(math.floor(min_x/1000.)) - 1, 0)
+    e1 = min(int(math.floor(max_x/1000.)) + 2, GRID_WIDTH-1)
+    n0 = max(int(math.floor(min_y/1000.)) - 1, 0)
+    n1 = min(int(math.floor(max_y/1000.)) + 2, GRID_HEIGHT-1)
+    cells = 0
+    if e0 < e1:
+        row = ((1 << (e1-e0)) - 1) << e0
+        for n in range(n0, n1):
+            cells |= row << (n*GRID_WIDTH)
+    return cells
+
+class TiledGrid(ShiftGrid):
+    """A ShiftGrid read a tile at a time from a file written by
+    compile_tiled_grid().
+
+    The planes start out as zeroed anonymous memory, which takes no
+    resident memory until written, and each tile is inflated into them the
+    first time one of its cells is needed. With a bbox (min_x, min_y,
+    max_x, max_y) in metres, cells outside it (with a 1 km margin) are
+    treated as having no data, so no tiles beyond it are ever loaded.
+    Use open_tiled_grid() rather than making one directly.
+    """
+
+    def __init__(self, mm, tile_km, coverage, index, bbox=None):
+        plane_size = 2 * GRID_SIZE
+        self._memory = mmap.mmap(-1, 3 * plane_size + GRID_SIZE)
+        view = memoryview(self._memory)
+        super(TiledGrid, self).__init__(view[0:plane_size].cast('H'),
+                                        view[plane_size:2*plane_size].cast('H'),
+                                        view[2*plane_size:3*plane_size].cast('H'),
+                                        view[3*plane_size:])
+        self._raw = view
+        self.mmap = mm
+        self.tile_km = tile_km
+        self.bbox = bbox
+        (self.tile_columns, self.tile_rows) = _tile_counts(tile_km)
+        self._index = index
+        #1 for each tile that has been read
+        self.loaded = bytearray(len(index))
+        self._lock = threading.Lock()
+        if bbox is not None:
+            coverage = int.from_bytes(coverage, 'little') & _bbox_cells(bbox)
+            coverage = coverage.to_bytes(COVERAGE_BYTES, 'little')
+        self._coverage = coverage
+
+    def tiles_loaded(self):
+        """Number of tiles read so far."""
+        return sum(self.loaded)
+
+    def _load(self, tile):
+        with self._lock:
+            if self.loaded[tile]:
+                return
+            (offset, length, crc) = self._index[tile]
+            if length:
+                data = self.mmap[offset:offset+length]
+                if zlib.crc32(data) & 0xffffffff != crc:
+                    raise ValueError("Tile {0} of the OSTN02 tiled grid is damaged".format(tile))
+                data = zlib.decompress(data)
+                (e0, e1, n0, n1) = _tile_bounds(tile, self.tile_km)
+                width = e1 - e0
+                start = 0
+                for k, itemsize in ((0, 2), (1, 2), (2, 2), (3, 1)):
+                    base = k * 2 * GRID_SIZE
+                    for n in range(n0, n1):
+                        i = base + itemsize*(n*GRID_WIDTH + e0)
+                        self._raw[i:i+itemsize*width] = data[start:start+itemsize*width]
+                        start += itemsize*width
+            self.loaded[tile] = 1
+
+    def load_tiles(self, tiles):
+        """Make sure the given tiles are loaded."""
+        for tile in tiles:
+            if not self.loaded[tile]:
+                self._load(tile)
+
+    def require(self, i0):
+        """Load the tiles holding the four corners of cell i0."""
+        (n, e) = divmod(i0, GRID_WIDTH)
+        size = self.tile_km
+        (c0, c1) = (e // size, (e+1) // size)
+        for row in set((n // size, (n+1) // size)):
+            for tile in (row*self.tile_columns + c0, row*self.tile_columns + c1):
+                if not self.loaded[tile]:
+                    self._load(tile)
+
+    def preload(self):
+        """Load every tile with a covered cell, e.g. before forking workers."""
+        for byte, bits in enumerate(self.coverage):
+            for bit in range(8):
+                if (bits >> bit) & 1:
+                    self.require(8*byte + bit)
+
+    def node(self, e_index, n_index):
+        i = self.index(e_index, n_index)
+        if i is not None:
+            self.load_tiles([(n_index // self.tile_km)*self.tile_columns + e_index // self.tile_km])
+        return super(TiledGrid, self).node(e_index, n_index)
+
+def open_tiled_grid(path=None, source=DEFAULT_SOURCE, bbox=None):
+    """Open a file written by compile_tiled_grid as a TiledGrid, optionally
+    restricted to bbox. Returns None if the file is missing or was built
+    from a different source file."""
+    if path is None:
+        path = default_tiled_path()
+    if sys.byteorder != 'little':
+        return None
+    try:
+        fi = open(path, 'rb')
+    except (IOError, OSError):
+        return None
+    try:
+        mm = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, mmap.error):
+        return None
+    finally:
+        fi.close()
+
+    if len(mm) < TILED_HEADER_SIZE + COVERAGE_BYTES:
+        mm.close()
+        return None
+    magic, version, width, height, tile_km, size, crc = TILED_HEADER.unpack_from(mm, 0)
+    if (magic != TILED_MAGIC or version != TILED_VERSION
+            or width != GRID_WIDTH or height != GRID_HEIGHT or tile_km == 0
+            or (size, crc) != _source_fingerprint(source)):
+        mm.close()
+        return None
+    (columns, rows) = _tile_counts(tile_km)
+    start = TILED_HEADER_SIZE + COVERAGE_BYTES
+    if len(mm) < start + TILED_INDEX.size * columns * rows:
+        mm.close()
+        return None
+    coverage = mm[TILED_HEADER_SIZE:start]
+    index = [TILED_INDEX.unpack_from(mm, start + TILED_INDEX.size*t)
+             for t in range(columns * rows)]
+    return TiledGrid(mm, tile_km, coverage, index, bbox)
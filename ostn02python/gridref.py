@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+#OSTN02 for Python
+#=================
+
+#Bulk grid reference codec. Turns many references such as "TR143599" into
+#OSGB36 eastings and northings, and back, using 2-D tables indexed by the
+#two letters (parsing) or by the 100 km square (formatting), with the digit
+#arithmetic done on whole arrays. References may have any even number of
+#digits, from 2 (10 km) up to 2*MAX_DIGITS, and may contain spaces.
+#Malformed references are reported per row in an ok mask rather than
+#raising or printing.
+#The OSTN02 transform is Crown Copyright (C) 2002
+#See COPYING for redistribution terms
+
+import math
+
+import numpy as np
+
+from ostn02python import instrument
+from ostn02python.OSGB import Big_off, Small_off, BIG_SQUARE, SQUARE
+
+#Most digits per coordinate; 8 resolves to a hundredth of a millimetre
+MAX_DIGITS = 8
+
+def _square_tables():
+    #_SQUARE_EAST/_SQUARE_NORTH[first letter, second letter] give the 100 km
+    #square of a letter pair, counted from the false origin, or -1 where
+    #the pair is not a grid square. _SQUARE_LETTERS[east + _EAST_OFFSET,
+    #north] gives the letter pair back as two ASCII codes.
+    east = np.full((26, 26), -1, dtype=np.int64)
+    north = np.full((26, 26), -1, dtype=np.int64)
+    squares = {}
+    for big, (be, bn) in Big_off.items():
+        for small, (se, sn) in Small_off.items():
+            e = (be*BIG_SQUARE + se*SQUARE) // SQUARE
+            n = (bn*BIG_SQUARE + sn*SQUARE) // SQUARE
+            squares[(e, n)] = big + small
+    east_offset = -min(e for e, n in squares)
+    letters = np.zeros((max(e for e, n in squares) + east_offset + 1,
+                        max(n for e, n in squares) + 1, 2), dtype=np.uint8)
+    known = np.zeros(letters.shape[:2], dtype=bool)
+    for (e, n), pair in squares.items():
+        (i, j) = (ord(pair[0]) - 65, ord(pair[1]) - 65)
+        #Offsets are stored shifted so that -1 can mean "no such square"
+        east[i, j] = e + east_offset
+        north[i, j] = n
+        letters[e + east_offset, n] = (ord(pair[0]), ord(pair[1]))
+        known[e + east_offset, n] = True
+    return (east, north, east_offset, letters, known)
+
+(_SQUARE_EAST, _SQUARE_NORTH, _EAST_OFFSET, _SQUARE_LETTERS, _SQUARE_KNOWN) = _square_tables()
+
+#Characters dropped from references: tab, newline, carriage return, space
+_WHITESPACE = (9, 10, 13, 32)
+
+def _encode(refs):
+    #References as an (n, width) matrix of upper case character codes with
+    #whitespace taken out, zero padded, and the length of each
+    text = np.ascontiguousarray(np.asarray(refs, dtype=str).ravel())
+    width = max(text.dtype.itemsize // 4, 2)
+    if text.dtype.itemsize // 4 < width:
+        text = text.astype('U{0}'.format(width))
+    codes = text.view(np.uint32).reshape(text.size, width).copy()
+
+    space = np.isin(codes, _WHITESPACE)
+    spaced = np.flatnonzero(space.any(axis=1))
+    if spaced.size:
+        #Move the whitespace to the end of each row and blank it
+        order = np.argsort(space[spaced], axis=1, kind='stable')
+        codes[spaced] = np.take_along_axis(codes[spaced], order, axis=1)
+        codes[spaced] *= ~np.take_along_axis(space[spaced], order, axis=1)
+
+    lower = (codes >= 97) & (codes <= 122)
+    codes[lower] -= 32
+    lengths = np.count_nonzero(codes, axis=1)
+    return (codes, lengths)
+
+def parse_gridref_array(refs):
+    """Parse a sequence of grid references.
+
+    Returns (east, north, ok): OSGB36 eastings and northings in metres of
+    the south west corner of each referenced square, and a boolean mask
+    which is False for references that could not be parsed. Their east and
+    north are NaN.
+    """
+    if instrument.enabled:
+        instrument.count('array_points', len(refs))
+        return instrument.timed('gridref_array', _parse_gridref_array, refs)
+    return _parse_gridref_array(refs)
+
+def _parse_gridref_array(refs):
+
+    (matrix, lengths) = _encode(refs)
+    count = len(lengths)
+    east = np.full(count, np.nan)
+    north = np.full(count, np.nan)
+    ok = np.zeros(count, dtype=bool)
+
+    letters = matrix[:, :2].astype(np.intp) - 65
+    letters_ok = ((letters >= 0) & (letters < 26)).all(axis=1)
+    letters = np.where(letters_ok[:, None], letters, 0)
+    square_e = _SQUARE_EAST[letters[:, 0], letters[:, 1]]
+    square_n = _SQUARE_NORTH[letters[:, 0], letters[:, 1]]
+    letters_ok &= square_e >= 0
+
+    #Rows are grouped by length so each group's digits form a rectangle
+    digits = (lengths - 2) // 2
+    well_formed = letters_ok & (lengths % 2 == 0) & (digits >= 1) & (digits <= MAX_DIGITS)
+    for k in np.unique(digits[well_formed]):
+        rows = np.flatnonzero(well_formed & (digits == k))
+        values = matrix[rows, 2:2+2*k].astype(np.int64) - 48
+        good = ((values >= 0) & (values <= 9)).all(axis=1)
+        rows = rows[good]
+        values = values[good]
+        powers = 10 ** np.arange(k - 1, -1, -1, dtype=np.int64)
+        scale = 10.0 ** (5 - k)
+        east[rows] = (square_e[rows] - _EAST_OFFSET) * SQUARE + values[:, :k].dot(powers) * scale
+        north[rows] = square_n[rows] * SQUARE + values[:, k:].dot(powers) * scale
+        ok[rows] = True
+
+    return (east, north, ok)
+
+def format_gridref_array(east, north, digits=6):
+    """Format OSGB36 eastings and northings as grid references.
+
+    digits is the total number of digits after the letters, an even number
+    from 2 to 2*MAX_DIGITS; 6 gives "TR143599" (100 m), 10 gives metres.
+    Coordinates are truncated, so each reference names the square the point
+    lies in. Returns (refs, ok): an array of strings and a boolean mask
+    which is False, with an empty string, for points outside the lettered
+    squares (or NaN).
+    """
+    if instrument.enabled:
+        instrument.count('array_points', np.size(east))
+        return instrument.timed('gridref_array', _format_gridref_array, east, north, digits)
+    return _format_gridref_array(east, north, digits)
+
+def _format_gridref_array(east, north, digits=6):
+
+    if digits % 2 or not 2 <= digits <= 2*MAX_DIGITS:
+        raise ValueError("digits must be even, from 2 to {0}".format(2*MAX_DIGITS))
+    k = digits // 2
+    east, north = np.broadcast_arrays(np.asarray(east, dtype=np.float64),
+                                      np.asarray(north, dtype=np.float64))
+    shape = east.shape
+    east = east.ravel()
+    north = north.ravel()
+
+    with np.errstate(invalid='ignore'):
+        square_e = np.floor(east / SQUARE) + _EAST_OFFSET
+        square_n = np.floor(north / SQUARE)
+        ok = ((square_e >= 0) & (square_e < _SQUARE_LETTERS.shape[0])
+              & (square_n >= 0) & (square_n < _SQUARE_LETTERS.shape[1]))
+    i = np.where(ok, square_e, 0).astype(np.intp)
+    j = np.where(ok, square_n, 0).astype(np.intp)
+    ok &= _SQUARE_KNOWN[i, j]
+
+    #Digits within the square, truncated to the requested resolution
+    scale = 10.0 ** (k - 5)
+    e_digits = np.where(ok, np.floor((east - (i - _EAST_OFFSET) * SQUARE) * scale), 0).astype(np.int64)
+    n_digits = np.where(ok, np.floor((north - j * SQUARE) * scale), 0).astype(np.int64)
+    #Rounding in the scale can push a value on to the next square
+    limit = 10 ** k - 1
+    np.minimum(e_digits, limit, out=e_digits)
+    np.minimum(n_digits, limit, out=n_digits)
+
+    matrix = np.empty((east.size, 2 + 2*k), dtype=np.uint8)
+    matrix[:, :2] = _SQUARE_LETTERS[i, j]
+    powers = 10 ** np.arange(k - 1, -1, -1, dtype=np.int64)
+    matrix[:, 2:2+k] = (e_digits[:, None] // powers) % 10 + 48
+    matrix[:, 2+k:] = (n_digits[:, None] // powers) % 10 + 48
+    matrix[~ok] = 0
+
+    refs = matrix.view('S{0}'.format(2 + 2*k)).ravel().astype(str)
+    return (refs.reshape(shape), ok.reshape(shape))
+
+#OS Street View tiles are 5 km squares named by the 10 km reference they
+#lie in and a quarter of it, e.g. "SJ46NW". A tile number counts tiles from
+#the west edge of the lettered squares, then north within each column.
+TILE = 5000
+_TILES_PER_SQUARE = SQUARE // TILE
+_TILE_COLUMN = _SQUARE_LETTERS.shape[1] * _TILES_PER_SQUARE
+#Quarter letters by (east, north) half of the 10 km square
+_QUARTERS = np.array([[b'SW', b'NW'], [b'SE', b'NE']]).view(np.uint8).reshape(2, 2, 2)
+
+def _tile_numbers(east, north):
+    #Tile number of each point and whether it lies in a lettered square
+    east = np.asarray(east, dtype=np.float64).ravel()
+    north = np.asarray(north, dtype=np.float64).ravel()
+    with np.errstate(invalid='ignore'):
+        te = np.floor(east / TILE) + _EAST_OFFSET * _TILES_PER_SQUARE
+        tn = np.floor(north / TILE)
+        ok = ((te >= 0) & (te < _SQUARE_LETTERS.shape[0] * _TILES_PER_SQUARE)
+              & (tn >= 0) & (tn < _TILE_COLUMN))
+    te = np.where(ok, te, 0).astype(np.intp)
+    tn = np.where(ok, tn, 0).astype(np.intp)
+    ok &= _SQUARE_KNOWN[te // _TILES_PER_SQUARE, tn // _TILES_PER_SQUARE]
+    return (te * _TILE_COLUMN + tn, ok)
+
+def _tile_names(numbers):
+    #Names of valid tile numbers, built as character matrices
+    (te, tn) = np.divmod(np.asarray(numbers, dtype=np.intp), _TILE_COLUMN)
+    (se, sn) = (te % _TILES_PER_SQUARE, tn % _TILES_PER_SQUARE)
+    matrix = np.empty((te.size, 6), dtype=np.uint8)
+    matrix[:, :2] = _SQUARE_LETTERS[te // _TILES_PER_SQUARE, tn // _TILES_PER_SQUARE]
+    matrix[:, 2] = se // 2 + 48
+    matrix[:, 3] = sn // 2 + 48
+    matrix[:, 4:] = _QUARTERS[se % 2, sn % 2]
+    return matrix.view('S6').ravel().astype(str)
+
+def _tile_corners(numbers):
+    #South west corner of each tile, in metres
+    (te, tn) = np.divmod(np.asarray(numbers, dtype=np.intp), _TILE_COLUMN)
+    return ((te - _EAST_OFFSET * _TILES_PER_SQUARE) * float(TILE), tn * float(TILE))
+
+def grid_to_os_streetview_tile_array(east, north):
+    """OSGB.grid_to_os_streetview_tile over arrays of OSGB36 eastings and
+    northings. Returns (tiles, ok): tile names such as "SJ46NW", and a mask
+    which is False, with an empty name, for points outside the lettered
+    squares (or NaN). Each distinct tile is only named once."""
+    if instrument.enabled:
+        instrument.count('array_points', np.size(east))
+        return instrument.timed('gridref_array', _grid_to_os_streetview_tile_array, east, north)
+    return _grid_to_os_streetview_tile_array(east, north)
+
+def _grid_to_os_streetview_tile_array(east, north):
+    (east, north) = np.broadcast_arrays(np.asarray(east, dtype=np.float64),
+                                        np.asarray(north, dtype=np.float64))
+    shape = east.shape
+    (numbers, ok) = _tile_numbers(east, north)
+    tiles = np.full(numbers.size, '', dtype='U6')
+    if ok.any():
+        (unique, inverse) = np.unique(numbers[ok], return_inverse=True)
+        tiles[ok] = _tile_names(unique)[inverse]
+    return (tiles.reshape(shape), ok.reshape(shape))
+
+def bin_os_streetview_tiles(east, north, groups=False):
+    """Count points of OSGB36 eastings and northings per Street View tile.
+
+    Returns (tiles, counts): the names of the tiles holding at least one
+    point, in tile number order, and how many points each holds. Points
+    outside the lettered squares are left out. With groups=True a third
+    item is returned, a list with an array of the indices (into the
+    flattened input) of the points in each tile, in input order.
+    """
+    if instrument.enabled:
+        instrument.count('array_points', np.size(east))
+        return instrument.timed('gridref_array', _bin_os_streetview_tiles, east, north, groups)
+    return _bin_os_streetview_tiles(east, north, groups)
+
+def _bin_os_streetview_tiles(east, north, groups=False):
+    (east, north) = np.broadcast_arrays(np.asarray(east, dtype=np.float64),
+                                        np.asarray(north, dtype=np.float64))
+    (numbers, ok) = _tile_numbers(east, north)
+    if groups:
+        index = np.flatnonzero(ok)
+        #One stable sort both finds the tiles and keeps each tile's points
+        #in input order
+        order = np.argsort(numbers[index], kind='stable')
+        ordered = numbers[index][order]
+        if not ordered.size:
+            return (_tile_names(ordered), np.zeros(0, dtype=np.int64), [])
+        starts = np.flatnonzero(np.diff(ordered)) + 1
+        counts = np.diff(np.concatenate(([0], starts, [ordered.size])))
+        unique = ordered[np.concatenate(([0], starts))]
+        return (_tile_names(unique), counts, np.split(index[order], starts))
+    (unique, counts) = np.unique(numbers[ok], return_counts=True)
+    return (_tile_names(unique), counts)
+
+def os_streetview_tiles_in_bbox(bbox):
+    """The Street View tiles meeting a bounding box (min_e, min_n, max_e,
+    max_n) in metres, west to east then south to north within each column.
+    Returns (tiles, east, north): the names and the south west corner of
+    each tile, as OSGB.os_streetview_tile_to_grid gives for the name. Tiles
+    outside the lettered squares are left out."""
+    (min_e, min_n, max_e, max_n) = bbox
+    if min_e > max_e or min_n > max_n:
+        raise ValueError("bbox must be (min_e, min_n, max_e, max_n)")
+    #Tiles whose interior meets the box; a box edge on a tile edge does not
+    #take in the tile beyond it
+    (e0, n0) = (math.floor(min_e / TILE), math.floor(min_n / TILE))
+    e1 = max(e0 + 1, math.ceil(max_e / TILE))
+    n1 = max(n0 + 1, math.ceil(max_n / TILE))
+    (e, n) = np.meshgrid(np.arange(e0, e1) * float(TILE), np.arange(n0, n1) * float(TILE),
+                         indexing='ij')
+    (numbers, ok) = _tile_numbers(e, n)
+    numbers = numbers[ok]
+    (east, north) = _tile_corners(numbers)
+    return (_tile_names(numbers), east, north)
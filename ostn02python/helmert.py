@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+#OSTN02 for Python
+#=================
+
+#The metre accuracy tier: ETRS89 to OSGB36 by the Ordnance Survey's
+#published 7-parameter Helmert transformation between the two datums,
+#without the OSTN02 grid. Points are unprojected onto their ellipsoid,
+#taken to Earth centred cartesian coordinates, moved by the Helmert
+#transformation and projected again on the other ellipsoid. It never
+#touches the grid, so the grid is never loaded: this tier is for saving
+#the memory and start up time of the grid, not for speed, as once the
+#grid is loaded the two projections here cost more per point than the
+#OSTN02 bilinear lookup. Heights are ellipsoidal
+#heights on the target ellipsoid rather than the OSGM02 geoid heights the
+#grid gives, hence the larger height error.
+#The OSTN02 transform is Crown Copyright (C) 2002
+#See COPYING for redistribution terms
+
+import math
+
+from ostn02python.OSGB import ellipsoid_shapes, RAD, DAR
+from ostn02python.projection import projection_for
+
+#ETRS89 to OSGB36: translations in metres, rotations in arc seconds and
+#scale in parts per million, from "A guide to coordinate systems in Great
+#Britain", Ordnance Survey
+TX = -446.448
+TY =  125.157
+TZ = -542.060
+RX = -0.1502
+RY = -0.2470
+RZ = -0.8421
+S  =  20.4894
+
+#Largest differences from the OSTN02 transform over the OSTN02 coverage,
+#rounded up: horizontal distance and height, in metres. Measured at the
+#corners and centre of every covered cell in both directions, where the
+#worst were 5.16 m and 3.14 m.
+MAX_HORIZONTAL_ERROR = 5.5
+MAX_HEIGHT_ERROR = 3.5
+
+_MATH = (math.sin, math.cos, math.sqrt, math.atan2)
+
+def _numpy_functions():
+    import numpy as np
+    return (np.sin, np.cos, np.sqrt, np.arctan2)
+
+def _forward():
+    #The transformation as x' = t + m.x, with m = (1+s)I plus the small
+    #rotation matrix, in metres and radians
+    seconds = RAD / 3600
+    (rx, ry, rz, s) = (RX*seconds, RY*seconds, RZ*seconds, 1 + S*1e-6)
+    return ((TX, TY, TZ), ((s, -rz, ry), (rz, s, -rx), (-ry, rx, s)))
+
+def _reverse(translation, m):
+    #x = m^-1.(x' - t), with m inverted exactly rather than by negating
+    #the parameters, which would leave a few millimetres of round trip error
+    (a, b, c), (d, e, f), (g, h, i) = m
+    det = a*(e*i - f*h) - b*(d*i - f*g) + c*(d*h - e*g)
+    inverse = (((e*i - f*h)/det, (c*h - b*i)/det, (b*f - c*e)/det),
+               ((f*g - d*i)/det, (a*i - c*g)/det, (c*d - a*f)/det),
+               ((d*h - e*g)/det, (b*g - a*h)/det, (a*e - b*d)/det))
+    return (tuple(-sum(row[k]*translation[k] for k in range(3)) for row in inverse), inverse)
+
+_ETRS89_TO_OSGB36 = _forward()
+_OSGB36_TO_ETRS89 = _reverse(*_ETRS89_TO_OSGB36)
+
+def _change_datum(lat, lon, h, source, target, helmert, functions):
+    #Geodetic (lat, lon) in degrees and ellipsoidal height on the source
+    #ellipsoid to the same on the target ellipsoid. Works on floats or
+    #arrays depending on functions.
+    (sin, cos, sqrt, atan2) = functions
+    (a, b) = ellipsoid_shapes[source]
+    e2 = 1 - (b*b)/(a*a)
+    (phi, lam) = (lat*RAD, lon*RAD)
+    (sp, cp) = (sin(phi), cos(phi))
+    nu = a / sqrt(1 - e2*sp*sp)
+    x = (nu + h) * cp * cos(lam)
+    y = (nu + h) * cp * sin(lam)
+    z = ((1 - e2)*nu + h) * sp
+
+    ((tx, ty, tz), ((m00, m01, m02), (m10, m11, m12), (m20, m21, m22))) = helmert
+    (x, y, z) = (tx + m00*x + m01*y + m02*z,
+                 ty + m10*x + m11*y + m12*z,
+                 tz + m20*x + m21*y + m22*z)
+
+    #Back to geodetic on the target ellipsoid (Bowring's formula)
+    (a, b) = ellipsoid_shapes[target]
+    e2 = 1 - (b*b)/(a*a)
+    ep2 = (a*a)/(b*b) - 1
+    p = sqrt(x*x + y*y)
+    theta = atan2(z*a, p*b)
+    (st, ct) = (sin(theta), cos(theta))
+    phi = atan2(z + ep2*b*st*st*st, p - e2*a*ct*ct*ct)
+    lam = atan2(y, x)
+    sp = sin(phi)
+    nu = a / sqrt(1 - e2*sp*sp)
+    h = p/cos(phi) - nu
+    return (phi*DAR, lam*DAR, h)
+
+def ETRS89_to_OSGB36(x, y, z=0.0):
+    """ETRS89 to OSGB36 eastings, northings and height to within
+    MAX_HORIZONTAL_ERROR and MAX_HEIGHT_ERROR of the OSTN02 result."""
+    (lat, lon) = projection_for('ETRS89').to_ll(x, y)
+    (lat, lon, h) = _change_datum(lat, lon, z, 'ETRS89', 'OSGB36', _ETRS89_TO_OSGB36, _MATH)
+    (e, n) = projection_for('OSGB36').to_grid(lat, lon)
+    return (e, n, h)
+
+def OSGB36_to_ETRS89(x, y, z=0.0):
+    """The reverse of ETRS89_to_OSGB36, with the same error bounds."""
+    (lat, lon) = projection_for('OSGB36').to_ll(x, y)
+    (lat, lon, h) = _change_datum(lat, lon, z, 'OSGB36', 'ETRS89', _OSGB36_TO_ETRS89, _MATH)
+    (e, n) = projection_for('ETRS89').to_grid(lat, lon)
+    return (e, n, h)
+
+def ETRS89_to_OSGB36_array(x, y, z=0.0):
+    """ETRS89_to_OSGB36 over NumPy arrays; returns (x, y, z) arrays."""
+    (lat, lon) = projection_for('ETRS89').to_ll_array(x, y)
+    (lat, lon, h) = _change_datum(lat, lon, z, 'ETRS89', 'OSGB36', _ETRS89_TO_OSGB36, _numpy_functions())
+    (e, n) = projection_for('OSGB36').to_grid_array(lat, lon)
+    return (e, n, h)
+
+def OSGB36_to_ETRS89_array(x, y, z=0.0):
+    """OSGB36_to_ETRS89 over NumPy arrays; returns (x, y, z) arrays."""
+    (lat, lon) = projection_for('OSGB36').to_ll_array(x, y)
+    (lat, lon, h) = _change_datum(lat, lon, z, 'OSGB36', 'ETRS89', _OSGB36_TO_ETRS89, _numpy_functions())
+    (e, n) = projection_for('ETRS89').to_grid_array(lat, lon)
+    return (e, n, h)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+#OSTN02 for Python
+#=================
+
+#Opt-in counters and timers for the transform hot path. While disabled the
+#transforms only test the enabled flag. Once enabled they record:
+#  timers   - calls and total seconds per stage: gridref (parsing grid
+#             references), projection (ll_to_grid, grid_to_ll), shift
+#             (ETRS89_to_OSGB36), inverse (OSGB36_to_ETRS89) and helmert
+#             (both with accuracy='m'), plus the same with an _array
+#             suffix for the batch functions
+#  counters - points, inverse_lookups, out_of_coverage
+#Callbacks added with add_callback(func) are called as func(kind, name,
+#value) for every sample, kind being 'time' or 'count', so the numbers can
+#be passed on to a metrics system as they happen.
+#The OSTN02 transform is Crown Copyright (C) 2002
+#See COPYING for redistribution terms
+
+import threading
+from time import perf_counter
+
+enabled = False
+
+_lock = threading.Lock()
+_counters = {}
+_timers = {}
+_callbacks = []
+
+def enable(callback=None):
+    """Start recording, optionally adding a callback at the same time."""
+    global enabled
+    if callback is not None:
+        add_callback(callback)
+    enabled = True
+
+def disable():
+    """Stop recording. What has been recorded so far is kept."""
+    global enabled
+    enabled = False
+
+def reset():
+    """Clear all counters and timers."""
+    with _lock:
+        _counters.clear()
+        _timers.clear()
+
+def add_callback(callback):
+    with _lock:
+        _callbacks.append(callback)
+
+def remove_callback(callback):
+    with _lock:
+        _callbacks.remove(callback)
+
+def count(name, n=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+        callbacks = list(_callbacks)
+    for callback in callbacks:
+        callback('count', name, n)
+
+def record_time(stage, seconds):
+    with _lock:
+        timer = _timers.get(stage)
+        if timer is None:
+            timer = _timers[stage] = [0, 0.0]
+        timer[0] += 1
+        timer[1] += seconds
+        callbacks = list(_callbacks)
+    for callback in callbacks:
+        callback('time', stage, seconds)
+
+def timed(stage, func, *args, **kwargs):
+    """Call func(*args, **kwargs), recording the time taken against stage."""
+    start = perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        record_time(stage, perf_counter() - start)
+
+def snapshot():
+    """Everything recorded so far, plus the cell cache statistics, as a dict:
+    {'counters': {name: n}, 'timers': {stage: {'calls': n, 'seconds': s}},
+    'cell_cache': {...}}"""
+    from ostn02python.OSTN02 import cell_cache_stats
+    with _lock:
+        counters = dict(_counters)
+        timers = dict((stage, {'calls': calls, 'seconds': seconds})
+                      for stage, (calls, seconds) in _timers.items())
+    return {'counters': counters, 'timers': timers, 'cell_cache': cell_cache_stats()}
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+#OSTN02 for Python
+#=================
+
+#OSTN02 transforms of every node of a regular lattice, e.g. to warp a
+#raster. Node (i, j) is at (x0 + j*dx, y0 + i*dy). Each lattice column
+#falls in one column of OSTN02 cells and each lattice row in one row of
+#cells, so the cell lookups and bilinear weights are worked out once per
+#column and once per row, and the coefficients once per cell row, rather
+#than for every node. The results are bit for bit those of the scalar
+#functions; nodes outside OSTN02 coverage come back as NaN.
+#The OSTN02 transform is Crown Copyright (C) 2002
+#See COPYING for redistribution terms
+
+import numpy as np
+
+from ostn02python import instrument
+from ostn02python.grid import GRID_WIDTH, GRID_HEIGHT
+from ostn02python.OSTN02 import MAX_EASTING, MAX_NORTHING
+from ostn02python.batch import (_cell_coefficients_array, _covered_cells,
+                                _find_inverse_shifts_array, _round_to_nearest_mm_array)
+
+def lattice_nodes(origin, spacing, shape):
+    """(x, y) arrays of the given (rows, columns) shape holding the
+    coordinates of every node."""
+    (x, y) = _axes(origin, spacing, shape)
+    return np.broadcast_arrays(x[None, :], y[:, None])
+
+def _axes(origin, spacing, shape):
+    (x0, y0) = origin
+    (dx, dy) = spacing
+    (rows, columns) = shape
+    return (x0 + np.arange(columns)*float(dx), y0 + np.arange(rows)*float(dy))
+
+def _cells(v, size):
+    #Cell index and weight along one axis, as _find_OSTN02_cell does them,
+    #and whether the index is inside the grid
+    index = np.trunc(v/1000.)
+    ok = (index >= 0) & (index < size-1)
+    w = (v - index*1000)/1000
+    return (np.where(ok, index, 0).astype(np.intp), w, ok)
+
+def _lattice_shifts(x, y):
+    #Shifts at every node of the lattice with axes x (columns) and y (rows),
+    #as (se, sn, sg, ok) arrays of shape (len(y), len(x))
+    (e_index, t, e_ok) = _cells(x, GRID_WIDTH)
+    (n_index, u, n_ok) = _cells(y, GRID_HEIGHT)
+
+    out = [np.empty((y.size, x.size)) for _ in range(3)]
+    ok = np.zeros((y.size, x.size), dtype=bool)
+
+    #Rows are taken a run of rows in the same row of cells at a time: the
+    #coefficients for every column are gathered once for the run
+    starts = np.flatnonzero(np.concatenate(([True], n_index[1:] != n_index[:-1])))
+    for start, stop in zip(starts, np.append(starts[1:], y.size)):
+        i0 = n_index[start] * GRID_WIDTH + e_index
+        cell_ok = e_ok & _covered_cells(i0)
+        c = _cell_coefficients_array(i0)
+        uu = u[start:stop, None]
+        tu = t*uu
+        for k in range(3):
+            out[k][start:stop] = c[4*k] + c[4*k+1]*t + c[4*k+2]*uu + c[4*k+3]*tu
+        ok[start:stop] = cell_ok & n_ok[start:stop, None]
+
+    return (out[0], out[1], out[2], ok)
+
+def ETRS89_to_OSGB36_lattice(origin, spacing, shape, z=0.0):
+    """ETRS89_to_OSGB36 at every node of a lattice.
+
+    origin is the ETRS89 (x0, y0) of node (0, 0), spacing the (dx, dy)
+    between columns and between rows (either may be negative) and shape the
+    (rows, columns). z is a height for every node, or an array of shape.
+    Returns ((x, y, z), ok): arrays of shape, NaN where OSTN02 is not
+    defined, and the boolean mask of nodes that were transformed.
+    """
+    if instrument.enabled:
+        instrument.count('array_points', shape[0]*shape[1])
+        return instrument.timed('shift_array', _ETRS89_to_OSGB36_lattice, origin, spacing, shape, z)
+    return _ETRS89_to_OSGB36_lattice(origin, spacing, shape, z)
+
+def _ETRS89_to_OSGB36_lattice(origin, spacing, shape, z=0.0):
+
+    (x, y) = _axes(origin, spacing, shape)
+    (dx, dy, dz, ok) = _lattice_shifts(x, y)
+    ok &= ((0 <= x) & (x <= MAX_EASTING))[None, :] & ((0 <= y) & (y <= MAX_NORTHING))[:, None]
+
+    (xs, ys) = np.broadcast_arrays(x[None, :], y[:, None])
+    out = _round_to_nearest_mm_array(xs+dx, ys+dy, np.broadcast_to(z, ok.shape)-dz)
+    for values in out:
+        values[~ok] = np.nan
+    return (out, ok)
+
+def OSGB36_to_ETRS89_lattice(origin, spacing, shape, z=0.0):
+    """OSGB36_to_ETRS89 at every node of a lattice, with the same arguments
+    and results as ETRS89_to_OSGB36_lattice. The first inverse lookup, the
+    plain shift at each node, is taken from the lattice; the Newton steps
+    after it run on the covered nodes as a batch."""
+    if instrument.enabled:
+        instrument.count('array_points', shape[0]*shape[1])
+        return instrument.timed('inverse_array', _OSGB36_to_ETRS89_lattice, origin, spacing, shape, z)
+    return _OSGB36_to_ETRS89_lattice(origin, spacing, shape, z)
+
+def _OSGB36_to_ETRS89_lattice(origin, spacing, shape, z=0.0):
+
+    (x, y) = _axes(origin, spacing, shape)
+    (se, sn, sg, ok) = _lattice_shifts(x, y)
+    (xs, ys) = lattice_nodes(origin, spacing, shape)
+    zs = np.broadcast_to(np.asarray(z, dtype=np.float64), ok.shape)
+
+    out = [np.full(ok.shape, np.nan) for _ in range(3)]
+    (dx, dy, dz, lookups, residual, good) = _find_inverse_shifts_array(
+        xs[ok], ys[ok], first=(se[ok], sn[ok], sg[ok]), masked=True)
+    values = _round_to_nearest_mm_array(xs[ok]-dx, ys[ok]-dy, zs[ok]+dz)
+    #Nodes whose Newton steps left coverage are dropped
+    values = [v[good] for v in values]
+    ok[ok] = good
+    for k in range(3):
+        out[k][ok] = values[k]
+    return (tuple(out), ok)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+#OSTN02 for Python
+#=================
+
+#Memoisation of conversions for workloads that see the same inputs again
+#and again, such as nightly runs over the same postcode centroids. Results
+#are kept in a bounded in-memory LRU and, optionally, an SQLite file that
+#persists between runs. The file records the library version and a
+#fingerprint of the grid data, and drops its results when either changes.
+#The OSTN02 transform is Crown Copyright (C) 2002
+#See COPYING for redistribution terms
+
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import ostn02python
+from ostn02python.grid import DEFAULT_SOURCE, _source_fingerprint
+
+DEFAULT_MEMO_ENTRIES = 100000
+
+#Writes to the file are committed in batches of this many
+COMMIT_EVERY = 1000
+
+def normalise_gridref(ref):
+    """Key for a grid reference: upper case with whitespace removed, so
+    "tr 143 599" and "TR143599" share one entry and are both converted as
+    "TR143599"."""
+    return ''.join(ref.split()).upper()
+
+def coordinate_key(*values):
+    """Key for numeric arguments, e.g. an easting and northing, as floats."""
+    return tuple(float(v) for v in values)
+
+def data_version(source=DEFAULT_SOURCE):
+    """The library version and grid data fingerprint stored with results."""
+    size, crc = _source_fingerprint(source)
+    return "{0}:{1}:{2:08x}".format(ostn02python.__version__, size, crc)
+
+class Memo(object):
+    """Remember the results of func, a function returning a tuple of numbers.
+
+    key(*args) gives the canonical arguments: a tuple of them, or any other
+    value for a single one. Calling the Memo calls func with the canonical
+    arguments only if they have not been seen before, so func only ever
+    sees the normalised form. Up to max_entries results are kept in memory, least recently
+    used first out. With a path, results are also stored in an SQLite
+    file under name (by default func's module and name), so later runs
+    start with them; results stored with a different version (by default
+    data_version()) are discarded when the file is opened. Exceptions
+    raised by func are not remembered. Call close() (or use a with block)
+    to commit the last results to the file.
+    """
+
+    def __init__(self, func, path=None, key=coordinate_key, max_entries=DEFAULT_MEMO_ENTRIES,
+                 name=None, version=None):
+        self.func = func
+        self.key = key
+        self.max_entries = max_entries
+        self.name = name or "{0}.{1}".format(func.__module__, func.__name__)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._pending = 0
+        self._db = None
+        if path is not None:
+            self._open(path, version or data_version())
+
+    def _open(self, path, version):
+        db = sqlite3.connect(path, check_same_thread=False)
+        db.execute("CREATE TABLE IF NOT EXISTS versions (name TEXT PRIMARY KEY, version TEXT)")
+        db.execute("CREATE TABLE IF NOT EXISTS results (name TEXT, key TEXT, value TEXT, "
+                   "PRIMARY KEY (name, key))")
+        row = db.execute("SELECT version FROM versions WHERE name = ?", (self.name,)).fetchone()
+        if row is None or row[0] != version:
+            db.execute("DELETE FROM results WHERE name = ?", (self.name,))
+            db.execute("INSERT OR REPLACE INTO versions VALUES (?, ?)", (self.name, version))
+        db.commit()
+        self._db = db
+
+    def __call__(self, *args):
+        args = self.key(*args)
+        if not isinstance(args, tuple):
+            args = (args,)
+        key = repr(args)
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            if self._db is not None:
+                row = self._db.execute("SELECT value FROM results WHERE name = ? AND key = ?",
+                                       (self.name, key)).fetchone()
+                if row is not None:
+                    value = tuple(json.loads(row[0]))
+                    self._remember(key, value)
+                    self.hits += 1
+                    return value
+            self.misses += 1
+
+        value = tuple(self.func(*args))
+        with self._lock:
+            self._remember(key, value)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+                                 (self.name, key, json.dumps(value)))
+                self._pending += 1
+                if self._pending >= COMMIT_EVERY:
+                    self._db.commit()
+                    self._pending = 0
+        return value
+
+    def _remember(self, key, value):
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = value
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def flush(self):
+        """Commit results not yet written to the file."""
+        with self._lock:
+            if self._db is not None and self._pending:
+                self._db.commit()
+                self._pending = 0
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+#OSTN02 for Python
+#=================
+
+#Multi-process batch transforms. The shift grid is copied once into a
+#multiprocessing.shared_memory block which every worker maps, rather than
+#each worker loading its own copy. The block holds the parent's coverage
+#mask too, so workers accept exactly the points the parent does, including
+#any region set with OSTN02.use_region().
+#The OSTN02 transform is Crown Copyright (C) 2002
+#See COPYING for redistribution terms
+
+import time
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from ostn02python import OSTN02
+from ostn02python.grid import ShiftGrid, GRID_SIZE, COVERAGE_BYTES
+from ostn02python.batch import TRANSFORMS, transform_with_mask
+
+DEFAULT_CHUNK_SIZE = 100000
+
+_PLANE_BYTES = 2 * GRID_SIZE
+_VALID_END = 3 * _PLANE_BYTES + GRID_SIZE
+_SHARED_BYTES = _VALID_END + COVERAGE_BYTES
+
+def _grid_from_buffer(buf):
+    view = memoryview(buf)
+    return ShiftGrid(view[0:_PLANE_BYTES].cast('H'),
+                     view[_PLANE_BYTES:2*_PLANE_BYTES].cast('H'),
+                     view[2*_PLANE_BYTES:3*_PLANE_BYTES].cast('H'),
+                     view[3*_PLANE_BYTES:_VALID_END],
+                     view[_VALID_END:_SHARED_BYTES])
+
+def share_grid():
+    """Copy the loaded OSTN02 grid into a new SharedMemory block.
+    The caller owns the block and should close() and unlink() it."""
+    grid = OSTN02._get_ostn_data()
+    if grid.tile_km:
+        grid.preload()
+    shm = shared_memory.SharedMemory(create=True, size=_SHARED_BYTES)
+    buf = np.frombuffer(shm.buf, dtype=np.uint8, count=_SHARED_BYTES)
+    offset = 0
+    for plane in (grid.east, grid.north, grid.height, grid.valid, grid.coverage):
+        data = np.frombuffer(plane, dtype=np.uint8)
+        buf[offset:offset+data.size] = data
+        offset += data.size
+    del buf, data
+    return shm
+
+_worker_shm = None
+
+def _attach_worker(name):
+    #Pool initializer: map the shared block and use it as this process's grid
+    global _worker_shm
+    #Pool workers share the parent's resource tracker, so attaching (which
+    #registers the block again before Python 3.13) does not get it unlinked
+    #when a worker exits; the parent unlinks it in BatchExecutor.close()
+    try:
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+    _worker_shm = shm
+    OSTN02.set_grid(_grid_from_buffer(shm.buf))
+
+def _run_chunk(task):
+    (transform, columns) = task
+    return transform_with_mask(transform, *columns)
+
+class BatchExecutor(object):
+    """Process pool for large batch transforms.
+
+    The grid is placed in shared memory once when the executor starts.
+    map() splits its input into chunks, transforms them on all the workers
+    and returns the results in input order, as (outputs, ok) from
+    transform_with_mask. Use as a context manager, or call close().
+    """
+
+    def __init__(self, processes=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.chunk_size = chunk_size
+        self._shm = share_grid()
+        try:
+            self._pool = multiprocessing.Pool(self.processes, initializer=_attach_worker,
+                                              initargs=(self._shm.name,))
+        except BaseException:
+            #No executor to close() later, so the block would outlive us
+            self._shm.close()
+            self._shm.unlink()
+            raise
+
+    def map(self, transform, *columns):
+        if transform not in TRANSFORMS:
+            raise ValueError("Unknown transform {0!r}".format(transform))
+        columns = np.broadcast_arrays(*[np.asarray(c, dtype=np.float64).ravel() for c in columns])
+        n = columns[0].size
+        tasks = [(transform, [c[i:i+self.chunk_size] for c in columns])
+                 for i in range(0, n, self.chunk_size)]
+        results = self._pool.map(_run_chunk, tasks, chunksize=1)
+        if not results:
+            width = TRANSFORMS[transform][1]
+            return (tuple(np.zeros(0) for _ in range(width)), np.zeros(0, dtype=bool))
+        outputs = tuple(np.concatenate([r[0][k] for r in results]) for k in range(len(results[0][0])))
+        return (outputs, np.concatenate([r[1] for r in results]))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def scaling(points=1000000, max_processes=None, transform='OSGB36_to_ETRS89', seed=0):
+    """Time transform on random in-coverage points with 1 to max_processes
+    workers. Returns a list of (processes, seconds, points per second)."""
+    rng = np.random.default_rng(seed)
+    #The Midlands, which OSTN02 covers completely
+    x = rng.uniform(400000, 500000, points)
+    y = rng.uniform(200000, 300000, points)
+    if transform in ('ll_to_grid', 'grid_to_ll'):
+        columns = (x, y)
+    else:
+        columns = (x, y, np.zeros(points))
+    OSTN02.preload()
+    out = []
+    for n in range(1, (max_processes or multiprocessing.cpu_count()) + 1):
+        with BatchExecutor(n, chunk_size=max(1, points // (4 * n))) as executor:
+            start = time.time()
+            executor.map(transform, *columns)
+            seconds = time.time() - start
+        out.append((n, seconds, points / seconds))
+    return out
+
+if __name__ == "__main__":
+    print("processes  seconds  points/s")
+    for (n, seconds, rate) in scaling():
+        print("{0:9d}  {1:7.3f}  {2:8.0f}".format(n, seconds, rate))
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+#OSTN02 for Python
+#=================
+
+#Transverse Mercator projection for the National Grid using Krüger's
+#n-series (as given by Karney, "Transverse Mercator with an accuracy of a
+#few nanometers", J. Geodesy 85, 2011) to sixth order. Both directions are
+#closed form, with no iteration, and are accurate to far better than a
+#millimetre over the whole OSTN02 extent.
+#The OSTN02 transform is Crown Copyright (C) 2002
+#See COPYING for redistribution terms
+
+import math
+import cmath
+
+from ostn02python.OSGB import ellipsoid_shapes, RAD, DAR, LAM0, PHI0, E0, N0, F0
+
+def _clenshaw_sin(coefficients, x, cos2x, sin2x):
+    #Sum of c[j-1]*sin(2*j*x) for j = 1..len(c), real or complex x
+    y = 2*cos2x
+    b1 = b2 = 0
+    for c in reversed(coefficients):
+        (b1, b2) = (c + y*b1 - b2, b1)
+    return b1*sin2x
+
+class Projection(object):
+    """The National Grid projection on one ellipsoid.
+
+    All the series coefficients are worked out when the object is made, so
+    to_grid and to_ll are a fixed sequence of operations per point. The
+    _array methods do the same over NumPy arrays.
+    """
+
+    def __init__(self, a, b, k0=F0, lat0=PHI0, lon0=LAM0, e0=E0, n0=N0):
+        self.a = a
+        self.b = b
+        self.k0 = k0
+        self.lon0 = lon0
+        self.e0 = e0
+        self.n0 = n0
+
+        n = (a-b)/(a+b)
+        self.e = math.sqrt((a*a-b*b)/(a*a))
+
+        n2 = n*n
+        n3 = n2*n
+        n4 = n3*n
+        n5 = n4*n
+        n6 = n5*n
+
+        #Rectifying radius
+        self.A = a/(1+n) * (1 + n2/4. + n4/64. + n6/256.)
+        self.kA = k0*self.A
+
+        #Conformal to rectifying (forward)
+        self.alpha = (
+            n/2. - 2*n2/3. + 5*n3/16. + 41*n4/180. - 127*n5/288. + 7891*n6/37800.,
+            13*n2/48. - 3*n3/5. + 557*n4/1440. + 281*n5/630. - 1983433*n6/1935360.,
+            61*n3/240. - 103*n4/140. + 15061*n5/26880. + 167603*n6/181440.,
+            49561*n4/161280. - 179*n5/168. + 6601661*n6/7257600.,
+            34729*n5/80640. - 3418889*n6/1995840.,
+            212378941*n6/319334400.)
+
+        #Rectifying to conformal (inverse)
+        self.beta = (
+            n/2. - 2*n2/3. + 37*n3/96. - n4/360. - 81*n5/512. + 96199*n6/604800.,
+            n2/48. + n3/15. - 437*n4/1440. + 46*n5/105. - 1118711*n6/3870720.,
+            17*n3/480. - 37*n4/840. - 209*n5/4480. + 5569*n6/90720.,
+            4397*n4/161280. - 11*n5/504. - 830251*n6/7257600.,
+            4583*n5/161280. - 108847*n6/3991680.,
+            20648693*n6/638668800.)
+
+        #Conformal to geodetic latitude
+        self.delta = (
+            2*n - 2*n2/3. - 2*n3 + 116*n4/45. + 26*n5/45. - 2854*n6/675.,
+            7*n2/3. - 8*n3/5. - 227*n4/45. + 2704*n5/315. + 2323*n6/945.,
+            56*n3/15. - 136*n4/35. - 1262*n5/105. + 73814*n6/2835.,
+            4279*n4/630. - 332*n5/35. - 399572*n6/14175.,
+            4174*n5/315. - 144838*n6/6237.,
+            601676*n6/22275.)
+
+        #Rectifying latitude of the true origin
+        chi0 = math.atan(self._conformal(math.sin(lat0)))
+        self.xi0 = chi0 + _clenshaw_sin(self.alpha, chi0, math.cos(2*chi0), math.sin(2*chi0))
+
+    def _conformal(self, sp):
+        #tan of the conformal latitude, given sin of the geodetic latitude.
+        #At the poles (and within 1e-8 degrees of them, where sin rounds to
+        #1) it is infinite, as in to_grid_array, and atan2 then gives the
+        #pole exactly.
+        if abs(sp) >= 1:
+            return math.copysign(float('inf'), sp)
+        e = self.e
+        return math.sinh(math.atanh(sp) - e*math.atanh(e*sp))
+
+    def to_grid(self, lat, lon):
+        """(easting, northing) in metres from latitude and longitude in degrees."""
+        phi = RAD * lat
+        l = RAD * lon - self.lon0
+
+        t = self._conformal(math.sin(phi))
+        cl = math.cos(l)
+        xi = math.atan2(t, cl)
+        eta = math.asinh(math.sin(l) / math.hypot(t, cl))
+
+        z = complex(xi, eta)
+        z2 = 2*z
+        z = z + _clenshaw_sin(self.alpha, z, cmath.cos(z2), cmath.sin(z2))
+
+        east = self.e0 + self.kA * z.imag
+        north = self.n0 + self.kA * (z.real - self.xi0)
+        return (east, north)
+
+    def to_ll(self, E, N):
+        """(latitude, longitude) in degrees from easting and northing in metres."""
+        z = complex((N - self.n0)/self.kA + self.xi0, (E - self.e0)/self.kA)
+        z2 = 2*z
+        z = z - _clenshaw_sin(self.beta, z, cmath.cos(z2), cmath.sin(z2))
+        (xi, eta) = (z.real, z.imag)
+
+        chi = math.asin(math.sin(xi) / math.cosh(eta))
+        lam = self.lon0 + math.atan2(math.sinh(eta), math.cos(xi))
+        phi = chi + _clenshaw_sin(self.delta, chi, math.cos(2*chi), math.sin(2*chi))
+
+        return (phi * DAR, lam * DAR)
+
+    def to_grid_array(self, lat, lon):
+        """to_grid over NumPy arrays; returns (east, north) arrays."""
+        import numpy as np
+        phi = RAD * np.asarray(lat, dtype=np.float64)
+        l = RAD * np.asarray(lon, dtype=np.float64) - self.lon0
+
+        e = self.e
+        sp = np.sin(phi)
+        #Infinite at the poles, as in _conformal
+        with np.errstate(divide='ignore'):
+            t = np.sinh(np.arctanh(sp) - e*np.arctanh(e*sp))
+        cl = np.cos(l)
+        xi = np.arctan2(t, cl)
+        eta = np.arcsinh(np.sin(l) / np.hypot(t, cl))
+
+        z = xi + 1j*eta
+        z2 = 2*z
+        z = z + _clenshaw_sin(self.alpha, z, np.cos(z2), np.sin(z2))
+
+        east = self.e0 + self.kA * z.imag
+        north = self.n0 + self.kA * (z.real - self.xi0)
+        return (east, north)
+
+    def to_ll_array(self, E, N):
+        """to_ll over NumPy arrays; returns (lat, lon) arrays in degrees."""
+        import numpy as np
+        E = np.asarray(E, dtype=np.float64)
+        N = np.asarray(N, dtype=np.float64)
+
+        z = ((N - self.n0)/self.kA + self.xi0) + 1j*((E - self.e0)/self.kA)
+        z2 = 2*z
+        z = z - _clenshaw_sin(self.beta, z, np.cos(z2), np.sin(z2))
+        (xi, eta) = (z.real, z.imag)
+
+        chi = np.arcsin(np.sin(xi) / np.cosh(eta))
+        lam = self.lon0 + np.arctan2(np.sinh(eta), np.cos(xi))
+        phi = chi + _clenshaw_sin(self.delta, chi, np.cos(2*chi), np.sin(2*chi))
+
+        return (phi * DAR, lam * DAR)
+
+_projections = {}
+
+def projection_for(shape):
+    """The Projection for a name in OSGB.ellipsoid_shapes, made once per shape."""
+    try:
+        return _projections[shape]
+    except KeyError:
+        (a, b) = ellipsoid_shapes[shape]
+        projection = _projections[shape] = Projection(a, b)
+        return projection
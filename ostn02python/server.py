@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+#OSTN02 for Python
+#=================
+
+#Local HTTP transform service. Concurrent single point requests are
+#collected into micro-batches and run through the array functions in an
+#executor, so the per-request Python overhead is shared across the batch.
+#Run with python -m ostn02python.server
+#The OSTN02 transform is Crown Copyright (C) 2002
+#See COPYING for redistribution terms
+
+import time
+import json
+import asyncio
+import argparse
+from collections import deque, Counter
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+
+from ostn02python import OSTN02
+from ostn02python.batch import TRANSFORMS, transform_with_mask
+
+#Query parameters taken by each transform, in argument order. Trailing
+#parameters with a default may be left out.
+PARAMETERS = {
+    'ETRS89_to_OSGB36' : (('x', None), ('y', None), ('z', 0.0)),
+    'OSGB36_to_ETRS89' : (('x', None), ('y', None), ('z', 0.0)),
+    'll_to_grid'       : (('lat', None), ('lon', None)),
+    'grid_to_ll'       : (('e', None), ('n', None)),
+}
+
+#Accepted range of each parameter. Anything else, including NaN and
+#infinities, gets a 400 response rather than being queued. Grid coordinates
+#may lie outside OSTN02 coverage (that is a 422) but not far outside the
+#National Grid, where the projection means nothing.
+LIMITS = {
+    'x'   : (-1000000.0, 2000000.0),
+    'y'   : (-1000000.0, 2000000.0),
+    'e'   : (-1000000.0, 2000000.0),
+    'n'   : (-1000000.0, 2000000.0),
+    'z'   : (-10000.0, 10000.0),
+    'lat' : (-90.0, 90.0),
+    'lon' : (-180.0, 180.0),
+}
+
+DEFAULT_MAX_DELAY = 0.002
+DEFAULT_MAX_BATCH = 4096
+
+class MicroBatcher(object):
+    """Gathers single point transforms into batches.
+
+    submit() queues a point and returns its result once the batch it joined
+    has run. A batch runs when max_batch points are waiting or max_delay
+    seconds after its first point arrived, whichever is sooner. Batches run
+    on the event loop's default executor (or the one given).
+    """
+
+    def __init__(self, max_delay=DEFAULT_MAX_DELAY, max_batch=DEFAULT_MAX_BATCH,
+                 executor=None, history=100000):
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.executor = executor
+        self._pending = {}
+        self._timers = {}
+        #The event loop only keeps weak references to tasks, so running
+        #batches are held here until they finish
+        self._tasks = set()
+        self.latencies = deque(maxlen=history)
+        self.batch_sizes = Counter()
+
+    async def submit(self, transform, *values):
+        """Transform one point; returns a tuple of floats, or None if the
+        point could not be transformed."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        start = time.perf_counter()
+        pending = self._pending.setdefault(transform, [])
+        pending.append((values, future))
+        if len(pending) >= self.max_batch:
+            self._flush(transform)
+        elif transform not in self._timers:
+            self._timers[transform] = loop.call_later(self.max_delay, self._flush, transform)
+        try:
+            return await future
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+    def _flush(self, transform):
+        timer = self._timers.pop(transform, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(transform, [])
+        if batch:
+            task = asyncio.ensure_future(self._run(transform, batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, transform, batch):
+        self.batch_sizes[_bucket(len(batch))] += 1
+        columns = [np.array(column, dtype=np.float64) for column in zip(*[values for values, _ in batch])]
+        loop = asyncio.get_running_loop()
+        try:
+            (outputs, ok) = await loop.run_in_executor(self.executor, transform_with_mask,
+                                                       transform, *columns)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for i, (_, future) in enumerate(batch):
+            if not future.done():
+                future.set_result(tuple(float(o[i]) for o in outputs) if ok[i] else None)
+
+    def stats(self):
+        """Latency percentiles (in seconds) and the batch size histogram,
+        keyed by the upper bound of each power of two bucket."""
+        latencies = sorted(self.latencies)
+        def percentile(p):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(p / 100.0 * len(latencies)))]
+        return {'requests': len(latencies),
+                'p50': percentile(50), 'p99': percentile(99),
+                'batch_sizes': dict(sorted(self.batch_sizes.items()))}
+
+def _bucket(n):
+    bucket = 1
+    while bucket < n:
+        bucket *= 2
+    return bucket
+
+def _parse_request(target):
+    #Turns "/OSGB36_to_ETRS89?x=1&y=2" into (transform, values)
+    url = urlsplit(target)
+    transform = url.path.strip('/')
+    if transform not in TRANSFORMS:
+        raise KeyError(transform)
+    query = parse_qs(url.query)
+    values = []
+    for name, default in PARAMETERS[transform]:
+        if name in query:
+            value = float(query[name][0])
+            (low, high) = LIMITS[name]
+            #Also false for NaN
+            if not low <= value <= high:
+                raise ValueError("Parameter {0} must be between {1:g} and {2:g}".format(name, low, high))
+            values.append(value)
+        elif default is not None:
+            values.append(default)
+        else:
+            raise ValueError("Missing parameter " + name)
+    return (transform, values)
+
+class TransformServer(object):
+    """Minimal HTTP/1.1 front end for a MicroBatcher.
+
+    GET /<transform>?<parameters> returns a JSON list of the transformed
+    values, GET /stats returns MicroBatcher.stats(). Missing, non-finite or
+    out of range (see LIMITS) parameters get a 400 response and points
+    without OSTN02 coverage a 422.
+    """
+
+    def __init__(self, batcher=None, host='127.0.0.1', port=8002):
+        self.batcher = batcher or MicroBatcher()
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        OSTN02.preload()
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.server
+
+    async def _respond(self, target):
+        if urlsplit(target).path == '/stats':
+            return (200, self.batcher.stats())
+        try:
+            (transform, values) = _parse_request(target)
+        except KeyError:
+            return (404, {'error': 'unknown transform'})
+        except ValueError as e:
+            return (400, {'error': str(e)})
+        result = await self.batcher.submit(transform, *values)
+        if result is None:
+            return (422, {'error': 'OSTN02 is not defined at this point'})
+        return (200, list(result))
+
+    async def _handle(self, reader, writer):
+        reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+                   405: 'Method Not Allowed', 422: 'Unprocessable Entity'}
+        try:
+            while True:
+                request = await reader.readline()
+                if not request:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                parts = request.decode('latin-1').split()
+                if len(parts) != 3:
+                    break
+                (method, target, version) = parts
+                if method != 'GET':
+                    (status, body) = (405, {'error': 'only GET is supported'})
+                else:
+                    (status, body) = await self._respond(target)
+                payload = json.dumps(body).encode('utf-8')
+                close = (headers.get('connection', '').lower() == 'close'
+                         or version == 'HTTP/1.0')
+                writer.write("HTTP/1.1 {0} {1}\r\nContent-Type: application/json\r\n"
+                             "Content-Length: {2}\r\n{3}\r\n".format(
+                                 status, reasons[status], len(payload),
+                                 "Connection: close\r\n" if close else "").encode('latin-1'))
+                writer.write(payload)
+                await writer.drain()
+                if close:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m ostn02python.server',
+        description="Serve OSTN02 transforms over HTTP on localhost, batching concurrent requests.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8002)
+    parser.add_argument('--max-delay', type=float, default=DEFAULT_MAX_DELAY,
+                        help="seconds a request may wait for its batch to fill (default {0})".format(DEFAULT_MAX_DELAY))
+    parser.add_argument('--max-batch', type=int, default=DEFAULT_MAX_BATCH,
+                        help="largest batch (default {0})".format(DEFAULT_MAX_BATCH))
+    args = parser.parse_args(argv)
+    server = TransformServer(MicroBatcher(args.max_delay, args.max_batch), args.host, args.port)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    main()
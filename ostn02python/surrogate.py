@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+#OSTN02 for Python
+#=================
+
+#Fused ETRS89 latitude/longitude to OSGB36 easting/northing. The National
+#Grid projection of ETRS89 positions is replaced by a table of polynomials,
+#one per BLOCK_DEGREES square of latitude and longitude, fitted when the
+#table is compiled; evaluating one is a few dozen multiply-adds instead of
+#the trigonometric and hyperbolic functions of the exact series. The OSTN02
+#shift is then the usual bilinear interpolation in the cell the projected
+#point falls in. The shift itself cannot be folded into the polynomials:
+#it is only piecewise bilinear, with a kink at every 1 km cell edge, and
+#no smooth fit over a larger area comes within a millimetre of it.
+#Run python -m ostn02python.surrogate --compile to write the table and
+#--validate to measure it against the exact path.
+#The OSTN02 transform is Crown Copyright (C) 2002
+#See COPYING for redistribution terms
+
+import os
+import sys
+import math
+import struct
+import zlib
+import argparse
+
+import numpy as np
+
+from ostn02python.projection import projection_for
+from ostn02python.batch import ETRS89_to_OSGB36_array
+from ostn02python.OSTN02 import ETRS89_to_OSGB36
+
+DEFAULT_SURROGATE = os.path.join(os.path.dirname(__file__), 'ostn02data.surrogate')
+
+#Table extent, covering the whole OSTN02 grid, block size and total degree
+#of the polynomials
+LAT0 = 49.5
+LON0 = -9.5
+LAT1 = 61.5
+LON1 = 4.0
+BLOCK_DEGREES = 0.5
+DEGREE = 4
+
+#Largest distance between the polynomial and the exact projection, in
+#metres, that validate() accepts; the fit is normally within a micrometre.
+#After rounding to the millimetre, results then match the exact path
+#except where the exact value is within TOLERANCE of a rounding boundary,
+#where they can differ by one millimetre.
+TOLERANCE = 0.00001
+
+#File header: magic, format version, degree, rows, columns, payload crc32,
+#then lat0, lon0 and block size as doubles. The payload is the little
+#endian float64 coefficients, for each block the x then the y polynomial.
+SURROGATE_MAGIC = b'OSTN02SG'
+SURROGATE_VERSION = 1
+SURROGATE_HEADER = struct.Struct('<8sIIIII3d')
+
+def default_surrogate_path():
+    return os.environ.get('OSTN02_SURROGATE', DEFAULT_SURROGATE)
+
+def _terms(degree):
+    #Exponents (i, j) of s**i * t**j, grouped by i for Horner's rule
+    return [(i, j) for i in range(degree+1) for j in range(degree+1-i)]
+
+class Surrogate(object):
+    """Polynomials giving the ETRS89 National Grid (x, y) of a latitude and
+    longitude. coefficients has shape (rows*columns, 2, terms); within a
+    block the polynomial is in s and t, the latitude and longitude scaled
+    to -1..1 across the block."""
+
+    def __init__(self, coefficients, degree, lat0, lon0, rows, columns, block):
+        self.coefficients = coefficients
+        self.degree = degree
+        self.lat0 = lat0
+        self.lon0 = lon0
+        self.rows = rows
+        self.columns = columns
+        self.block = block
+        self.terms = _terms(degree)
+        #Per term arrays, so evaluation gathers one float per point per term
+        self._x = [np.ascontiguousarray(coefficients[:, 0, k]) for k in range(len(self.terms))]
+        self._y = [np.ascontiguousarray(coefficients[:, 1, k]) for k in range(len(self.terms))]
+
+    def _locate(self, lat, lon):
+        #Block index, local coordinates and whether inside the table
+        r = (lat - self.lat0) / self.block
+        c = (lon - self.lon0) / self.block
+        with np.errstate(invalid='ignore'):
+            inside = (r >= 0) & (r < self.rows) & (c >= 0) & (c < self.columns)
+        row = np.where(inside, np.floor(r), 0).astype(np.intp)
+        column = np.where(inside, np.floor(c), 0).astype(np.intp)
+        return (row*self.columns + column, 2*(r - row) - 1, 2*(c - column) - 1, inside)
+
+    def _evaluate(self, blocks, s, t):
+        #Horner's rule in s of polynomials in t, in place to save on
+        #temporaries
+        out = []
+        for table in (self._x, self._y):
+            total = None
+            k = len(self.terms)
+            for i in range(self.degree, -1, -1):
+                k -= self.degree + 1 - i
+                inner = table[k + self.degree - i][blocks]
+                for j in range(self.degree - i - 1, -1, -1):
+                    inner *= t
+                    inner += table[k+j][blocks]
+                if total is None:
+                    total = inner
+                else:
+                    total *= s
+                    total += inner
+            out.append(total)
+        return out
+
+    def to_grid_array(self, lat, lon):
+        """(x, y) arrays from latitude and longitude arrays, with the exact
+        projection used for any points outside the table."""
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        (blocks, s, t, inside) = self._locate(lat, lon)
+        (x, y) = self._evaluate(blocks, s, t)
+        if not inside.all():
+            (ex, ey) = projection_for('ETRS89').to_grid_array(lat[~inside], lon[~inside])
+            x[~inside] = ex
+            y[~inside] = ey
+        return (x, y)
+
+def fit_surrogate(degree=DEGREE, block=BLOCK_DEGREES, samples=16):
+    """Fit the polynomials by least squares to the exact projection at
+    samples x samples Chebyshev points in each block."""
+    rows = int(math.ceil((LAT1 - LAT0) / block))
+    columns = int(math.ceil((LON1 - LON0) / block))
+    nodes = np.cos(np.pi * (np.arange(samples) + 0.5) / samples)
+    (s, t) = [v.ravel() for v in np.meshgrid(nodes, nodes, indexing='ij')]
+    terms = _terms(degree)
+    design = np.stack([s**i * t**j for (i, j) in terms], axis=1)
+    pinv = np.linalg.pinv(design)
+
+    blocks = np.arange(rows * columns)
+    (row, column) = np.divmod(blocks, columns)
+    lat = LAT0 + (row[:, None] + (s + 1)/2) * block
+    lon = LON0 + (column[:, None] + (t + 1)/2) * block
+    (x, y) = projection_for('ETRS89').to_grid_array(lat, lon)
+    coefficients = np.stack([x.dot(pinv.T), y.dot(pinv.T)], axis=1)
+    return Surrogate(coefficients, degree, LAT0, LON0, rows, columns, block)
+
+def compile_surrogate(path=None, degree=DEGREE, block=BLOCK_DEGREES):
+    """Fit the table and write it to path. Written to a temporary name and
+    renamed into place, as grid.compile_grid_cache(). Returns the path."""
+    if path is None:
+        path = default_surrogate_path()
+    surrogate = fit_surrogate(degree, block)
+    payload = surrogate.coefficients.astype('<f8').tobytes()
+    header = SURROGATE_HEADER.pack(SURROGATE_MAGIC, SURROGATE_VERSION, degree,
+                                   surrogate.rows, surrogate.columns,
+                                   zlib.crc32(payload) & 0xffffffff, LAT0, LON0, block)
+    tmp = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(tmp, 'wb') as fo:
+        fo.write(header)
+        fo.write(payload)
+    os.replace(tmp, path)
+    return path
+
+def open_surrogate(path=None):
+    """Read a table written by compile_surrogate, or None if it is missing
+    or damaged."""
+    if path is None:
+        path = default_surrogate_path()
+    try:
+        with open(path, 'rb') as fi:
+            data = fi.read()
+    except (IOError, OSError):
+        return None
+    if len(data) < SURROGATE_HEADER.size:
+        return None
+    (magic, version, degree, rows, columns, crc, lat0, lon0, block) = \
+        SURROGATE_HEADER.unpack_from(data, 0)
+    payload = data[SURROGATE_HEADER.size:]
+    terms = len(_terms(degree))
+    if (magic != SURROGATE_MAGIC or version != SURROGATE_VERSION
+            or len(payload) != rows * columns * 2 * terms * 8
+            or zlib.crc32(payload) & 0xffffffff != crc):
+        return None
+    coefficients = np.frombuffer(payload, dtype='<f8').reshape(rows * columns, 2, terms)
+    return Surrogate(coefficients.astype(np.float64), degree, lat0, lon0, rows, columns, block)
+
+_surrogate = None
+
+def load_surrogate():
+    """The compiled table if it is usable, otherwise a fit made now (which
+    takes a fraction of a second). Kept for the life of the process."""
+    global _surrogate
+    surrogate = _surrogate
+    if surrogate is None:
+        surrogate = open_surrogate()
+        if surrogate is None:
+            surrogate = fit_surrogate()
+        _surrogate = surrogate
+    return surrogate
+
+def ETRS89_ll_to_OSGB36(lat, lon, h=0.0):
+    """ETRS89 latitude, longitude (degrees) and height straight to OSGB36
+    (easting, northing, height), as ll_to_grid then ETRS89_to_OSGB36.
+    For one point in plain Python the exact series is already quicker
+    than a polynomial evaluation, so only the array version uses the
+    table."""
+    (x, y) = projection_for('ETRS89').to_grid(lat, lon)
+    return ETRS89_to_OSGB36(x, y, h)
+
+def ETRS89_ll_to_OSGB36_array(lat, lon, h=None, masked=False):
+    """ETRS89_ll_to_OSGB36 over arrays, with masked as for
+    batch.ETRS89_to_OSGB36_array."""
+    (x, y) = load_surrogate().to_grid_array(lat, lon)
+    return ETRS89_to_OSGB36_array(x, y, h, masked=masked)
+
+def validate(points=1000000, seed=0, surrogate=None):
+    """Compare the table with the exact path at random points over the
+    OSTN02 coverage. Returns a dict with the largest projection error in
+    metres and how many rounded OSGB36 results differ, and by how much."""
+    if surrogate is None:
+        surrogate = load_surrogate()
+    rng = np.random.default_rng(seed)
+    #Random ETRS89 grid positions, so the sample follows the grid's area
+    x = rng.uniform(0, 700000, points)
+    y = rng.uniform(0, 1250000, points)
+    (lat, lon) = projection_for('ETRS89').to_ll_array(x, y)
+    (ex, ey) = projection_for('ETRS89').to_grid_array(lat, lon)
+    (sx, sy) = surrogate.to_grid_array(lat, lon)
+    ((x0, y0, z0), ok) = ETRS89_to_OSGB36_array(ex, ey, masked=True)
+    ((x1, y1, z1), ok1) = ETRS89_to_OSGB36_array(sx, sy, masked=True)
+    ok &= ok1
+    projection_error = np.hypot(sx - ex, sy - ey)
+    result_error = np.maximum(abs(x1 - x0), abs(y1 - y0))[ok]
+    return {'points': int(ok.sum()),
+            'max_projection_error': float(projection_error.max()),
+            'differing_results': int(np.count_nonzero(result_error)),
+            'max_result_difference': float(result_error.max()) if result_error.size else 0.0}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m ostn02python.surrogate',
+        description="Compile or validate the lat/lon to OSGB36 polynomial table.")
+    parser.add_argument('--compile', action='store_true', help="fit the table and write it")
+    parser.add_argument('--validate', action='store_true', help="measure the table against the exact path")
+    parser.add_argument('--path', default=None, help="table file (default {0})".format(DEFAULT_SURROGATE))
+    parser.add_argument('--points', type=int, default=1000000, help="points to validate with")
+    args = parser.parse_args(argv)
+
+    if args.compile:
+        print("Wrote {0}".format(compile_surrogate(args.path)))
+    if args.validate:
+        surrogate = open_surrogate(args.path) if args.path else load_surrogate()
+        if surrogate is None:
+            print("No usable table at {0}".format(args.path))
+            return 1
+        report = validate(args.points, surrogate=surrogate)
+        for key in ('points', 'max_projection_error', 'differing_results', 'max_result_difference'):
+            print("{0:22s} {1}".format(key, report[key]))
+        if report['max_projection_error'] > TOLERANCE:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,7 +6,7 @@ from ostn02python.OSGB import (parse_grid, grid_to_ll, ll_to_grid,
                                grid_to_os_streetview_tile)
 
 from ostn02python.OSTN02 import OSGB36_to_ETRS89, ETRS89_to_OSGB36
-from ostn02python.transform import OSGB36GridRefToETRS89
+from ostn02python.transform import OSGB36GridRefToETRS89, OSGB36GridRefToGrid
 
 from nose.tools import assert_equal, assert_almost_equal, raises
 # from OSTN02 import *
@@ -96,4 +96,823 @@ def test_grid_to_os_streetview_tile3():
     northing = 1189906
 
     gridref = grid_to_os_streetview_tile((easting, northing))
-    print(gridref)
\ No newline at end of file
+    print(gridref)
+
+def test_grid_loaded_lazily():
+    import subprocess, sys
+    code = ("import ostn02python.OSTN02 as m; "
+            "print(m._ostn_data is None); "
+            "m.preload(); print(m._ostn_data is not None)")
+    out = subprocess.check_output([sys.executable, "-c", code])
+    assert_equal(out.split(), [b"True", b"True"])
+
+def test_shift_grid_nodes():
+    from ostn02python.OSTN02 import _get_ostn_data, _get_ostn_ref
+    grid = _get_ostn_data()
+    assert_equal(len(grid), 309798)
+    #First line of the data file is 00004f15ed000023f2
+    assert_equal(grid.node(0x4f, 0), (0x15ed, 0x0000, 0x23f2))
+    assert_equal(grid.node(0, 0), None)
+    assert_equal(_get_ostn_ref(0x4f, 0), (0x15ed/1000.0 + 86.275, -81.603, 0x23f2/1000.0 + 43.982))
+
+def test_grid_cache_round_trip():
+    import bz2, os, tempfile
+    from ostn02python.grid import compile_grid_cache, open_grid_cache, load_grid
+    tmp = tempfile.mkdtemp()
+    source = os.path.join(tmp, "small.txt.bz2")
+    with bz2.BZ2File(source, "wb") as fo:
+        fo.write(b"00004f15ed000023f2\r\n00005015fc000623ec\r\n")
+    cache = compile_grid_cache(os.path.join(tmp, "small.bin"), source)
+
+    grid = open_grid_cache(cache, source)
+    assert grid.mmap is not None
+    assert_equal(len(grid), 2)
+    assert_equal(grid.node(0x50, 0), (0x15fc, 0x0006, 0x23ec))
+
+    #A different source makes the cache stale, so load_grid parses the text
+    with bz2.BZ2File(source, "wb") as fo:
+        fo.write(b"00004f15ed000023f2\r\n")
+    assert_equal(open_grid_cache(cache, source), None)
+    grid = load_grid(cache, source)
+    assert_equal(grid.mmap, None)
+    assert_equal(len(grid), 1)
+
+    #As does a damaged payload
+    compile_grid_cache(cache, source)
+    with open(cache, "r+b") as fo:
+        fo.seek(-1, 2)
+        fo.write(b"\x07")
+    assert_equal(open_grid_cache(cache, source), None)
+
+def test_batch_matches_scalar():
+    import numpy as np
+    from ostn02python.batch import ETRS89_to_OSGB36_array, OSGB36_to_ETRS89_array
+    xs = [614300.0, 346200.0, 300000.5, 436612.0, 393720.25]
+    ys = [159900.0, 575400.0, 100000.5, 1189906.0, 399001.75]
+    zs = [0.0, 10.0, -3.5, 44.621, 100.0]
+
+    (x, y, z) = OSGB36_to_ETRS89_array(xs, ys, zs)
+    for i in range(len(xs)):
+        assert_equal(OSGB36_to_ETRS89(xs[i], ys[i], zs[i]), (x[i], y[i], z[i]))
+
+    (x2, y2, z2) = ETRS89_to_OSGB36_array(np.array(x), np.array(y))
+    for i in range(len(xs)):
+        assert_equal(ETRS89_to_OSGB36(x[i], y[i]), (x2[i], y2[i], z2[i]))
+
+@raises(Exception)
+def test_batch_out_of_bounds_exception():
+    from ostn02python.batch import OSGB36_to_ETRS89_array
+    OSGB36_to_ETRS89_array([614300, 622129], [159900, 185038])
+
+def test_batch_projection_matches_scalar():
+    from ostn02python.batch import ll_to_grid_array, grid_to_ll_array
+    lats = [51.297880, 54.5, 60.8, 49.95]
+    lons = [1.072628, -3.2, -1.1, -6.3]
+    for shape in ("WGS84", "OSGB36"):
+        (east, north) = ll_to_grid_array(lats, lons, shape)
+        (lat, lon) = grid_to_ll_array(east, north, shape)
+        for i in range(len(lats)):
+            (e, n) = ll_to_grid(lats[i], lons[i], shape=shape)
+            assert_almost_equal(east[i], e, places=6)
+            assert_almost_equal(north[i], n, places=6)
+            (la, lo) = grid_to_ll(e, n, shape=shape)
+            assert_almost_equal(lat[i], la, places=10)
+            assert_almost_equal(lon[i], lo, places=10)
+
+def test_newton_inverse_matches_fixed_point():
+    import random
+    from ostn02python.OSTN02 import (_OSGB36_to_ETRS89_fixed_point,
+                                     OSGB36_to_ETRS89_report, MAX_INVERSE_LOOKUPS)
+    rng = random.Random(6)
+    checked = 0
+    while checked < 2000:
+        x = rng.uniform(0, 700000)
+        y = rng.uniform(0, 1250000)
+        try:
+            expected = _OSGB36_to_ETRS89_fixed_point(x, y, 10.0)
+        except Exception:
+            continue
+        (result, lookups, residual) = OSGB36_to_ETRS89_report(x, y, 10.0)
+        assert_equal(result, expected)
+        assert_equal(OSGB36_to_ETRS89(x, y, 10.0), expected)
+        assert lookups <= MAX_INVERSE_LOOKUPS
+        assert residual < 0.05
+        checked += 1
+
+def test_newton_inverse_report_array():
+    from ostn02python.OSTN02 import OSGB36_to_ETRS89_report
+    from ostn02python.batch import OSGB36_to_ETRS89_report_array
+    ((x, y, z), lookups, residual) = OSGB36_to_ETRS89_report_array([614300], [159900])
+    assert_equal(((x[0], y[0], z[0]), lookups[0], residual[0]),
+                 OSGB36_to_ETRS89_report(614300, 159900))
+
+def test_cell_cache_lru():
+    from ostn02python.cellcache import CellCache, CELL_ENTRY_BYTES
+    cache = CellCache(3 * CELL_ENTRY_BYTES)
+    computed = []
+    def compute(key):
+        computed.append(key)
+        return (key,)
+    for key in (1, 2, 3, 1, 4, 2):
+        assert_equal(cache.get(key, compute), (key,))
+    #1 was used again before 4 arrived, so 2 was the one evicted
+    assert_equal(computed, [1, 2, 3, 4, 2])
+    stats = cache.stats()
+    assert_equal((stats['hits'], stats['misses'], stats['evictions'], stats['cells']),
+                 (1, 5, 2, 3))
+    cache.resize(0)
+    assert_equal(len(cache), 0)
+
+def test_cell_cache_does_not_change_results():
+    from ostn02python import OSTN02
+    expected = OSGB36_to_ETRS89(614300, 159900)
+    OSTN02.configure_cell_cache(0)
+    try:
+        assert_equal(OSGB36_to_ETRS89(614300, 159900), expected)
+        assert_equal(OSTN02.cell_cache_stats()['cells'], 0)
+    finally:
+        OSTN02.configure_cell_cache(OSTN02.DEFAULT_CELL_CACHE_BYTES)
+
+def test_cli_transform_rows():
+    from ostn02python.cli import transform_rows, parse_chain
+    rows = [{"ref": "TR143599"}, {"ref": "TR"}, {"ref": "TR143599"}]
+    out = list(transform_rows(rows, parse_chain("gridref,osgb36,etrs89,latlon"),
+                              columns=["ref"], chunk_size=2, on_error="blank"))
+    assert_equal(len(out), 3)
+    assert_almost_equal(out[0]["lat"], 51.297880, places=6)
+    assert_almost_equal(out[2]["lon"], 1.072628, places=6)
+    assert_equal(out[1]["lat"], None)
+    rows = [{"ref": "TR143599"}, {"ref": "XX123"}, {"ref": "TG514131"}]
+    out = list(transform_rows(rows, parse_chain("gridref,osgb36"), columns=["ref"], on_error="skip"))
+    assert_equal([(r["ref"], r["osgb36_e"]) for r in out], [("TR143599", 614300.0), ("TG514131", 651400.0)])
+    try:
+        list(transform_rows(rows, parse_chain("gridref,osgb36"), columns=["ref"]))
+    except ValueError as e:
+        assert "XX123" in str(e)
+    else:
+        assert False, "malformed reference accepted"
+
+    rows = [{"e": "614300", "n": "159900"}, {"e": "622129", "n": "185038"}]
+    out = list(transform_rows(rows, parse_chain("osgb36,etrs89"), columns=["e", "n"],
+                              on_error="skip"))
+    assert_equal(out, [{"e": "614300", "n": "159900",
+                        "etrs89_e": 614199.522, "etrs89_n": 159979.837}])
+    #Unparsable and out of coverage rows are blanked without failing the chunk
+    rows = [{"e": "614300", "n": "159900"}, {"e": "x", "n": "1"}, {"e": "inf", "n": "1"}, {"n": "3"}]
+    out = list(transform_rows(rows, parse_chain("osgb36,etrs89,latlon"), columns=["e", "n"],
+                              on_error="blank"))
+    assert_almost_equal(out[0]["lat"], 51.297880, places=6)
+    assert_equal([r["lat"] for r in out[1:]], [None, None, None])
+
+def test_cli_main():
+    import os, tempfile
+    from ostn02python.cli import main
+    tmp = tempfile.mkdtemp()
+    source = os.path.join(tmp, "in.csv")
+    dest = os.path.join(tmp, "out.csv")
+    with open(source, "w") as fo:
+        fo.write("lat,lon,h\n51.297880,1.072628,44.621\n")
+    main([source, "-o", dest, "-c", "latlon,etrs89,osgb36", "--height", "h",
+          "--output", "e,n"])
+    with open(dest) as fi:
+        lines = fi.read().splitlines()
+    assert_equal(lines[0], "lat,lon,h,e,n")
+    (lat, lon, h, e, n) = [float(v) for v in lines[1].split(",")]
+    assert_almost_equal(e, 614300, places=1)
+    assert_almost_equal(n, 159900, places=1)
+    assert_almost_equal(h, 0, places=1)
+
+    #A bad row in 'fail' mode is an error message and exit status, not a traceback
+    with open(source, "w") as fo:
+        fo.write("ref\nTR143599\nZZ9\n")
+    try:
+        main([source, "-o", dest, "--columns", "ref"])
+    except SystemExit as e:
+        assert_equal(e.code, 1)
+    else:
+        assert False, "bad row accepted"
+
+@raises(ValueError)
+def test_cli_bad_chain():
+    from ostn02python.cli import parse_chain
+    parse_chain("latlon,osgb36")
+
+def test_cli_chunk_size():
+    import sys, io
+    from ostn02python.cli import transform_rows, parse_chain, main
+    for size in (0, -1):
+        rows = transform_rows([{"e": "614300", "n": "159900"}], parse_chain("osgb36,etrs89"),
+                              columns=["e", "n"], chunk_size=size)
+        raises(ValueError)(lambda: list(rows))()
+    stderr = sys.stderr
+    sys.stderr = io.StringIO()
+    try:
+        main(["--chunk-size", "0"])
+    except SystemExit as e:
+        assert_equal(e.code, 2)
+        assert "--chunk-size" in sys.stderr.getvalue()
+    else:
+        assert False, "--chunk-size 0 accepted"
+    finally:
+        sys.stderr = stderr
+
+def test_cli_missing_height():
+    from ostn02python.cli import transform_rows, parse_chain
+    chain = parse_chain("osgb36,etrs89")
+    rows = [{"e": "614300", "n": "159900", "h": "10"}, {"e": "614300", "n": "159900"},
+            {"e": "614300", "n": "159900", "h": ""}]
+    out = list(transform_rows(rows, chain, columns=["e", "n"], height="h", on_error="blank"))
+    assert_equal([r["etrs89_e"] for r in out], [614199.522, None, None])
+    assert_almost_equal(out[0]["h"], 54.622, places=3)
+    try:
+        list(transform_rows([{"e": "614300", "n": "159900"}], chain, columns=["e", "n"],
+                            height="height"))
+    except ValueError as e:
+        assert "height=None" in str(e)
+    else:
+        assert False, "missing height column accepted"
+
+def test_parallel_executor():
+    import numpy as np
+    from ostn02python.parallel import BatchExecutor
+    x = np.array([614300, 622129, 346200, 300000.5, 614300])
+    y = np.array([159900, 185038, 575400, 100000.5, 159900])
+    with BatchExecutor(2, chunk_size=2) as executor:
+        ((ex, ey, ez), ok) = executor.map("OSGB36_to_ETRS89", x, y, 0.0)
+    assert_equal(list(ok), [True, False, True, True, True])
+    assert np.isnan(ex[1])
+    for i in (0, 2, 3, 4):
+        assert_equal(OSGB36_to_ETRS89(x[i], y[i]), (ex[i], ey[i], ez[i]))
+
+def test_parallel_executor_failed_start():
+    from multiprocessing import shared_memory
+    from ostn02python import parallel
+    shared = []
+    def share_grid():
+        shared.append(original())
+        return shared[-1]
+    original = parallel.share_grid
+    parallel.share_grid = share_grid
+    try:
+        raises(ValueError)(lambda: parallel.BatchExecutor(-1))()
+    finally:
+        parallel.share_grid = original
+    #The shared block made for the pool is gone again
+    raises(FileNotFoundError)(lambda: shared_memory.SharedMemory(shared[0].name))()
+
+def test_micro_batching_server():
+    import asyncio, json
+    from ostn02python.server import MicroBatcher, TransformServer
+
+    async def get(port, target):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(("GET " + target + " HTTP/1.1\r\nConnection: close\r\n\r\n").encode())
+        response = await reader.read()
+        writer.close()
+        head, _, body = response.partition(b"\r\n\r\n")
+        return int(head.split()[1]), json.loads(body)
+
+    async def run():
+        server = TransformServer(MicroBatcher(max_delay=0.05), port=0)
+        await server.start()
+        requests = [get(server.port, "/OSGB36_to_ETRS89?x=614300&y=159900") for i in range(8)]
+        requests.append(get(server.port, "/OSGB36_to_ETRS89?x=622129&y=185038"))
+        requests.append(get(server.port, "/grid_to_ll?e=614199.522&n=159979.837"))
+        results = await asyncio.gather(*requests)
+        #Non-finite and out of range values are refused before queueing
+        for target in ("/grid_to_ll?e=nan&n=1", "/ll_to_grid?lat=1e308&lon=0",
+                       "/OSGB36_to_ETRS89?x=inf&y=1", "/ETRS89_to_OSGB36?x=1&y=2&z=-inf"):
+            assert_equal((await get(server.port, target))[0], 400)
+        stats = (await get(server.port, "/stats"))[1]
+        server.server.close()
+        await server.server.wait_closed()
+        return results, stats
+
+    results, stats = asyncio.run(run())
+    for status, body in results[:8]:
+        assert_equal((status, body), (200, [614199.522, 159979.837, 44.622]))
+    assert_equal(results[8][0], 422)
+    assert_almost_equal(results[9][1][0], 51.297880, places=6)
+    assert_equal(stats["requests"], 10)
+    #The nine OSGB36_to_ETRS89 requests share one batch
+    assert_equal(stats["batch_sizes"], {"1": 1, "16": 1})
+
+def test_instrumentation():
+    from ostn02python import instrument
+    from ostn02python.batch import OSGB36_to_ETRS89_array
+    events = []
+    def callback(kind, name, value):
+        events.append((kind, name))
+    instrument.reset()
+    instrument.enable(callback)
+    try:
+        OSGB36GridRefToETRS89("TR143599")
+        OSGB36_to_ETRS89_array([614300, 346200], [159900, 575400])
+        try:
+            OSGB36_to_ETRS89(622129, 185038)
+        except Exception:
+            pass
+    finally:
+        instrument.disable()
+        instrument.remove_callback(callback)
+    OSGB36_to_ETRS89(614300, 159900)
+
+    stats = instrument.snapshot()
+    timers = stats["timers"]
+    assert_equal(timers["gridref"]["calls"], 1)
+    assert_equal(timers["projection"]["calls"], 1)
+    assert_equal(timers["inverse"]["calls"], 2)
+    assert_equal(timers["inverse_array"]["calls"], 1)
+    counters = stats["counters"]
+    assert_equal(counters["array_points"], 2)
+    assert_equal(counters["out_of_coverage"], 1)
+    assert counters["inverse_lookups"] >= 4
+    assert "hits" in stats["cell_cache"]
+    assert ("time", "gridref") in events
+    assert ("count", "out_of_coverage") in events
+
+def test_projection_worked_example_and_round_trip():
+    import random
+    from ostn02python.projection import projection_for
+    #The worked example in the OS guide to coordinate systems (Airy 1830)
+    (e, n) = ll_to_grid(52 + 39/60. + 27.2531/3600, 1 + 43/60. + 4.5177/3600, shape="OSGB36")
+    assert_almost_equal(e, 651409.903, places=3)
+    assert_almost_equal(n, 313177.270, places=3)
+    assert projection_for("OSGB36") is projection_for("OSGB36")
+    rng = random.Random(13)
+    for i in range(2000):
+        shape = ("WGS84", "OSGB36")[i % 2]
+        (x, y) = (rng.uniform(0, 700000), rng.uniform(0, 1250000))
+        (lat, lon) = grid_to_ll(x, y, shape=shape)
+        (e, n) = ll_to_grid(lat, lon, shape=shape)
+        assert abs(e - x) < 1e-6 and abs(n - y) < 1e-6
+
+def test_projection_at_the_poles():
+    import numpy as np
+    from ostn02python.batch import ll_to_grid_array
+    (east, north) = ll_to_grid_array([90, -90], [0, 0])
+    for (i, lat) in enumerate((90, -90)):
+        for lon in (0, 5):
+            assert_equal(ll_to_grid(lat, lon), (400000.0, north[i]))
+    assert np.isfinite(north).all()
+    #Within 1e-8 degrees the sine of the latitude rounds to 1
+    assert_equal(ll_to_grid(89.9999999, 0), ll_to_grid(90, 0))
+    assert_almost_equal(grid_to_ll(*ll_to_grid(90, 0))[0], 90, places=9)
+
+def test_gridref_codec():
+    from ostn02python.gridref import parse_gridref_array, format_gridref_array
+    refs = ["TR143599", "nY 462 754", "TR14359", "XX1234", "TR12a4", "TR", "SV0000000000"]
+    (east, north, ok) = parse_gridref_array(refs)
+    assert_equal(list(ok), [True, True, False, False, False, False, True])
+    assert_equal((east[0], north[0]), OSGB36GridRefToGrid("TR143599"))
+    assert_equal((east[1], north[1]), (346200, 575400))
+    assert_equal((east[6], north[6]), (0, 0))
+    (refs, ok) = format_gridref_array([614399.9, 651409.9, -600000], [159999.9, 313177.2, 0], 6)
+    assert_equal(list(refs), ["TR143599", "TG514131", ""])
+    assert_equal(list(ok), [True, True, False])
+    (refs, ok) = format_gridref_array([651409.9], [313177.2], 10)
+    assert_equal(parse_gridref_array(refs)[0][0], 651409)
+
+def test_cell_ordered_batch():
+    import numpy as np
+    from ostn02python.batch import cell_order, transform_with_mask, _find_OSTN02_shifts_array
+    rng = np.random.RandomState(15)
+    x = np.concatenate([rng.uniform(400000, 405000, 500), [622129, 614300]])
+    y = np.concatenate([rng.uniform(300000, 305000, 500), [185038, 159900]])
+    order = cell_order(x, y)
+    assert_equal(sorted(order), list(range(x.size)))
+    cells = (np.trunc(x[order]/1000)*10000 + np.trunc(y[order]/1000))
+    #Every cell's points are next to each other
+    assert_equal(np.count_nonzero(np.diff(cells)) + 1, np.unique(cells).size)
+    #Repeated cells give the same shifts as a plain gather
+    shifts = _find_OSTN02_shifts_array(x[order], y[order])
+    for (a, b) in zip(_find_OSTN02_shifts_array(x, y), shifts):
+        assert (a[order] == b).all()
+    for transform in ("ETRS89_to_OSGB36", "OSGB36_to_ETRS89"):
+        (plain, ok) = transform_with_mask(transform, x, y, 0)
+        (ordered, ok2) = transform_with_mask(transform, x, y, 0, ordered=True)
+        assert (ok == ok2).all() and not ok[-2] and ok[-1]
+        for (a, b) in zip(plain, ordered):
+            assert (a[ok] == b[ok]).all()
+
+def test_geojson_stream():
+    import io, json
+    from ostn02python.geojson import FeatureReader, transform_collection
+    square = [[1.07, 51.29], [1.08, 51.29], [1.08, 51.30], [1.07, 51.29]]
+    doc = {"type": "FeatureCollection", "name": "test", "features": [
+        {"type": "Feature", "id": 1, "properties": {}, "bbox": [0, 0, 1, 1],
+         "geometry": {"type": "Polygon", "coordinates": [square]}},
+        {"type": "Feature", "id": 2, "properties": {},
+         "geometry": {"type": "Point", "coordinates": [1.072628, 51.297880, 44.621]}},
+        {"type": "Feature", "id": 3, "properties": {},
+         "geometry": {"type": "Point", "coordinates": [-20.0, 40.0]}}], "extra": 1}
+    text = json.dumps(doc)
+    reader = FeatureReader(io.StringIO(text), buffer_size=5)
+    assert_equal([f["id"] for f in reader], [1, 2, 3])
+    assert_equal((reader.members["name"], reader.trailing), ("test", {"extra": 1}))
+
+    out = io.StringIO()
+    transform_collection(io.StringIO(text), out, "osgb36", on_error="skip", chunk_size=2)
+    result = json.loads(out.getvalue())
+    assert_equal([f["id"] for f in result["features"]], [1, 2])
+    assert "bbox" not in result["features"][0]
+    ring = result["features"][0]["geometry"]["coordinates"][0]
+    assert_equal(ring[0], ring[3])
+    (e, n) = ll_to_grid(51.29, 1.07)
+    assert_equal(ring[0], list(ETRS89_to_OSGB36(e, n)[:2]))
+    (x, y, h) = result["features"][1]["geometry"]["coordinates"]
+    assert_almost_equal(x, 614300, places=1)
+    assert_almost_equal(y, 159900, places=1)
+
+    back = io.StringIO()
+    transform_collection(io.StringIO(out.getvalue()), back, "latlon")
+    (lon, lat) = json.loads(back.getvalue())["features"][0]["geometry"]["coordinates"][0][0]
+    assert_almost_equal(lon, 1.07, places=6)
+    assert_almost_equal(lat, 51.29, places=6)
+
+def test_geojson_large_feature():
+    import io, json
+    from ostn02python.geojson import FeatureReader
+    ring = [[1.0 + i*1e-6, 51.0 + i*1e-6] for i in range(150000)]
+    doc = json.dumps({"type": "FeatureCollection", "features": [
+        {"type": "Feature", "properties": {}, "geometry": {"type": "Polygon", "coordinates": [ring]}}]})
+    assert len(doc) > 3000000
+    class Counting(io.StringIO):
+        reads = 0
+        def read(self, size=-1):
+            Counting.reads += 1
+            return io.StringIO.read(self, size)
+    features = list(FeatureReader(Counting(doc)))
+    assert_equal(features[0]["geometry"]["coordinates"][0], ring)
+    #Reads grow while one value is incomplete, rather than 64 KB at a time
+    assert Counting.reads < 20
+
+def test_geojson_not_a_collection():
+    import io, json
+    from ostn02python.geojson import FeatureReader
+    point = {"type": "Point", "coordinates": [1.07, 51.29]}
+    for doc in ({"type": "Feature", "geometry": point, "properties": {}}, {}, point):
+        try:
+            list(FeatureReader(io.StringIO(json.dumps(doc))))
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("{0} was read as a FeatureCollection".format(doc))
+    #"type" may follow the features
+    text = '{"features": [{"type": "Feature", "id": 1}], "type": "FeatureCollection"}'
+    assert_equal([f["id"] for f in FeatureReader(io.StringIO(text))], [1])
+    reader = FeatureReader(io.StringIO('{"features": [], "type": "Feature"}'))
+    try:
+        list(reader)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("a trailing type was not checked")
+
+def test_geojson_main_errors():
+    import os, json, tempfile
+    from ostn02python.geojson import main, OutsideOSTN02Error, transform_features
+    feature = {"type": "Feature", "id": 7, "properties": {},
+               "geometry": {"type": "Point", "coordinates": [-20.0, 40.0]}}
+    raises(OutsideOSTN02Error)(lambda: list(transform_features([feature])))()
+    folder = tempfile.mkdtemp()
+    (source, target) = (os.path.join(folder, "in.geojson"), os.path.join(folder, "out.geojson"))
+    with open(source, "w") as fo:
+        json.dump({"type": "FeatureCollection", "features": [feature]}, fo)
+    try:
+        main([source, "-o", target])
+    except SystemExit as e:
+        assert_equal(e.code, 1)
+    else:
+        raise AssertionError("main did not fail")
+    #Neither the output nor its temporary file is left behind
+    assert_equal(os.listdir(folder), ["in.geojson"])
+    assert_equal(main([source, "-o", target, "--on-error", "blank"]), 0)
+    with open(target) as fi:
+        assert_equal(json.load(fi)["features"][0]["geometry"], None)
+    assert_equal(sorted(os.listdir(folder)), ["in.geojson", "out.geojson"])
+
+def test_lattice_matches_scalar():
+    import numpy as np
+    from ostn02python.lattice import (ETRS89_to_OSGB36_lattice, OSGB36_to_ETRS89_lattice,
+                                      lattice_nodes)
+    #Runs off the coast near Dover, so some nodes are not covered
+    args = ((600000, 200000), (1375.5, -2350.25), (20, 15))
+    (xs, ys) = lattice_nodes(*args)
+    for (lattice, scalar) in ((ETRS89_to_OSGB36_lattice, ETRS89_to_OSGB36),
+                              (OSGB36_to_ETRS89_lattice, OSGB36_to_ETRS89)):
+        ((x, y, z), ok) = lattice(*args, z=5.0)
+        assert 0 < ok.sum() < ok.size
+        for i in range(xs.shape[0]):
+            for j in range(xs.shape[1]):
+                try:
+                    expected = scalar(xs[i, j], ys[i, j], 5.0)
+                except Exception:
+                    assert not ok[i, j] and np.isnan(x[i, j])
+                else:
+                    assert_equal((x[i, j], y[i, j], z[i, j]), expected)
+
+def test_coverage_mask_and_masked_batch():
+    import numpy as np
+    from ostn02python.OSTN02 import is_covered
+    from ostn02python.batch import (is_covered_array, ETRS89_to_OSGB36_array,
+                                    OSGB36_to_ETRS89_array, transform_with_mask)
+    xs = [614300.0, 622129.0, -5.0, 346200.0, float('nan'), 393720.25]
+    ys = [159900.0, 185038.0, 100.0, 575400.0, 1000.0, 1300000.0]
+    covered = [True, False, False, True, False, False]
+    for i in range(len(xs)):
+        assert_equal(is_covered(xs[i], ys[i]), covered[i])
+    assert_equal(is_covered_array(xs, ys).tolist(), covered)
+
+    ((x, y, z), ok) = ETRS89_to_OSGB36_array(xs, ys, masked=True)
+    assert_equal(ok.tolist(), covered)
+    assert_equal(np.isnan(x).tolist(), [not c for c in covered])
+    assert_equal(ETRS89_to_OSGB36(xs[0], ys[0]), (x[0], y[0], z[0]))
+
+    ((x, y, z), ok) = OSGB36_to_ETRS89_array(xs, ys, masked=True)
+    assert_equal(ok.tolist(), covered)
+    assert_equal(OSGB36_to_ETRS89(xs[3], ys[3]), (x[3], y[3], z[3]))
+    (values, ok) = transform_with_mask('OSGB36_to_ETRS89', xs, ys)
+    assert_equal(ok.tolist(), covered)
+
+def test_tiled_grid():
+    import bz2, os, tempfile
+    from ostn02python import OSTN02
+    from ostn02python.grid import compile_tiled_grid, open_tiled_grid, read_ostn02_text
+    from ostn02python.batch import ETRS89_to_OSGB36_array
+    tmp = tempfile.mkdtemp()
+    source = os.path.join(tmp, "small.txt.bz2")
+    with bz2.BZ2File(source, "wb") as fo:
+        fo.write(b"00004f15ed000023f2\r\n00005015fc000623ec\r\n"
+                 b"00104f15f0000323f0\r\n00105015f8000823e8\r\n")
+    #Cell (0x4f, 0) straddles the tiles with columns 64-79 and 80-95
+    path = compile_tiled_grid(os.path.join(tmp, "small.tiles"), source, tile_km=16)
+    grid = open_tiled_grid(path, source)
+    assert_equal(grid.tiles_loaded(), 0)
+    assert grid.covers(0x4f)
+    assert not grid.covers(0x50)
+    assert_equal(grid.node(0x50, 0), (0x15fc, 0x0006, 0x23ec))
+    assert_equal(grid.tiles_loaded(), 1)
+
+    old = OSTN02._get_ostn_data()
+    try:
+        OSTN02.set_grid(read_ostn02_text(source))
+        expected = OSTN02.ETRS89_to_OSGB36(79500.0, 500.0)
+        OSTN02.set_grid(open_tiled_grid(path, source))
+        assert_equal(OSTN02.ETRS89_to_OSGB36(79500.0, 500.0), expected)
+        assert_equal(OSTN02._get_ostn_data().tiles_loaded(), 2)
+        OSTN02.set_grid(open_tiled_grid(path, source))
+        (x, y, z) = ETRS89_to_OSGB36_array([79500.0], [500.0])
+        assert_equal((x[0], y[0], z[0]), expected)
+
+        #Outside the bbox nothing is covered and no tiles are read
+        OSTN02.set_grid(open_tiled_grid(path, source, bbox=(300000, 100000, 350000, 150000)))
+        assert not OSTN02.is_covered(79500.0, 500.0)
+        assert_equal(OSTN02._get_ostn_data().tiles_loaded(), 0)
+    finally:
+        OSTN02.set_grid(old)
+
+    #A different source makes the tiles stale
+    with bz2.BZ2File(source, "wb") as fo:
+        fo.write(b"00004f15ed000023f2\r\n")
+    assert_equal(open_tiled_grid(path, source), None)
+
+def test_parallel_executor_region():
+    import numpy as np
+    from ostn02python import OSTN02
+    from ostn02python.grid import ShiftGrid, GRID_WIDTH
+    from ostn02python.parallel import BatchExecutor
+    #Workers use the parent's coverage, not one worked out again from valid
+    grid = OSTN02._get_ostn_data()
+    coverage = bytearray(grid.coverage)
+    i0 = 159 * GRID_WIDTH + 614
+    coverage[i0 >> 3] &= ~(1 << (i0 & 7)) & 0xff
+    OSTN02.set_grid(ShiftGrid(grid.east, grid.north, grid.height, grid.valid, bytes(coverage)))
+    try:
+        with BatchExecutor(2, chunk_size=1) as executor:
+            ((ex, ey, ez), ok) = executor.map("ETRS89_to_OSGB36", [614500.0, 346200.0], [159500.0, 575400.0])
+    finally:
+        OSTN02.set_grid(grid)
+    assert_equal(list(ok), [False, True])
+
+def test_transformer():
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+    from ostn02python.transformer import Transformer, default_transformer
+    from ostn02python.batch import transform_with_mask
+    transformer = default_transformer()
+    assert default_transformer() is transformer
+    for (x, y) in ((614300.0, 159900.0), (346200.0, 575400.0), (300000.5, 100000.5)):
+        assert_equal(transformer.ETRS89_to_OSGB36(x, y, 10.0), ETRS89_to_OSGB36(x, y, 10.0))
+        assert_equal(transformer.OSGB36_to_ETRS89(x, y, 10.0), OSGB36_to_ETRS89(x, y, 10.0))
+
+    xs = np.linspace(0, 700000, 2001)
+    ys = np.linspace(0, 1250000, 2001)
+    (expected, expected_ok) = transform_with_mask('OSGB36_to_ETRS89', xs, ys)
+    with ThreadPoolExecutor(3) as pool:
+        (out, ok) = transformer.map('OSGB36_to_ETRS89', xs, ys, chunk_size=150, executor=pool)
+    assert_equal(ok.tolist(), expected_ok.tolist())
+    for k in range(3):
+        assert np.array_equal(out[k], expected[k], equal_nan=True)
+
+    try:
+        transformer.grid = None
+        assert False
+    except AttributeError:
+        pass
+
+def test_transformer_shared_cell_cache():
+    import random
+    from concurrent.futures import ThreadPoolExecutor
+    from ostn02python.cellcache import CELL_ENTRY_BYTES
+    from ostn02python.transformer import Transformer
+    #A budget of four cells, so threads keep clearing the dict under each other
+    transformer = Transformer(cell_cache_bytes=4 * CELL_ENTRY_BYTES)
+    rng = random.Random(20)
+    points = [(rng.uniform(600000, 620000), rng.uniform(150000, 170000)) for i in range(4000)]
+    def run(part):
+        return [transformer.ETRS89_to_OSGB36(x, y) for (x, y) in part]
+    with ThreadPoolExecutor(4) as pool:
+        results = sum(pool.map(run, [points[i::4] for i in range(4)]), [])
+    expected = sum([[ETRS89_to_OSGB36(x, y) for (x, y) in points[i::4]] for i in range(4)], [])
+    assert_equal(results, expected)
+    assert len(transformer._cells) <= 4
+
+def test_memo():
+    import os, tempfile
+    from ostn02python.memo import Memo, normalise_gridref
+    calls = []
+    def convert(ref):
+        calls.append(ref)
+        return OSGB36GridRefToETRS89(ref)
+    path = os.path.join(tempfile.mkdtemp(), "memo.sqlite")
+    with Memo(convert, path, key=normalise_gridref, max_entries=1, version="a") as memo:
+        first = memo("TR143599")
+        assert_equal(memo("tr 143 599"), first)
+        memo("NY462754")
+        assert_equal(memo("TR143599"), first)
+    assert_equal(calls, ["TR143599", "NY462754"])
+    #A later run reads the file, until the version changes
+    with Memo(convert, path, key=normalise_gridref, version="a") as memo:
+        assert_equal(memo("TR143599"), first)
+    assert_equal(len(calls), 2)
+    with Memo(convert, path, key=normalise_gridref, version="b") as memo:
+        assert_equal(memo("TR143599"), first)
+    assert_equal(len(calls), 3)
+
+def test_memo_calls_func_with_normalised_arguments():
+    from ostn02python.memo import Memo, normalise_gridref, coordinate_key
+    #The spaced form comes first, so it is the one that reaches func
+    memo = Memo(OSGB36GridRefToETRS89, key=normalise_gridref)
+    (lat, lon) = memo("NY 462 754")
+    assert_almost_equal(lat, 55.070, 3)
+    assert_almost_equal(lon, -2.844, 3)
+    assert_equal(memo("NY462754"), tuple(OSGB36GridRefToETRS89("NY462754")))
+    assert_equal(memo.misses, 1)
+    calls = []
+    def shift(x, y):
+        calls.append((x, y))
+        return OSGB36_to_ETRS89(x, y)
+    memo = Memo(shift)
+    assert_equal(memo(614300, 159900), memo(614300.0, 159900.0))
+    assert_equal(calls, [(614300.0, 159900.0)])
+    assert_equal(coordinate_key(1, "2"), (1.0, 2.0))
+
+def test_metre_accuracy_tier():
+    import subprocess, sys
+    import numpy as np
+    from ostn02python import helmert
+    from ostn02python.batch import ETRS89_to_OSGB36_array, OSGB36_to_ETRS89_array, is_covered_array
+    #Every covered point of a 5 km lattice over the whole grid
+    (x, y) = np.meshgrid(np.arange(2500.0, 700000, 5000), np.arange(2500.0, 1250000, 5000))
+    covered = is_covered_array(x, y)
+    (x, y) = (x[covered], y[covered])
+    z = np.full(x.shape, 100.0)
+    for transform in (ETRS89_to_OSGB36_array, OSGB36_to_ETRS89_array):
+        ((ex, ey, ez), ok) = transform(x, y, z, masked=True)
+        (mx, my, mz) = transform(x, y, z, accuracy='m')
+        assert np.hypot(mx-ex, my-ey)[ok].max() < helmert.MAX_HORIZONTAL_ERROR
+        assert abs(mz-ez)[ok].max() < helmert.MAX_HEIGHT_ERROR
+
+    (mx, my, mz) = ETRS89_to_OSGB36_array(x[:50], y[:50], z[:50], accuracy='m')
+    for i in range(50):
+        assert_equal(ETRS89_to_OSGB36(x[i], y[i], z[i], accuracy='m'), (mx[i], my[i], mz[i]))
+        back = OSGB36_to_ETRS89(mx[i], my[i], mz[i], accuracy='m')
+        assert_almost_equal(back[0], x[i], places=2)
+        assert_almost_equal(back[1], y[i], places=2)
+
+    #The metre tier never loads the grid
+    code = ("import ostn02python.OSTN02 as m; "
+            "m.OSGB36_to_ETRS89(400000, 300000, accuracy='m'); print(m._ostn_data is None)")
+    assert_equal(subprocess.check_output([sys.executable, "-c", code]).split(), [b"True"])
+
+@raises(ValueError)
+def test_unknown_accuracy():
+    ETRS89_to_OSGB36(400000, 300000, accuracy='mm')
+
+def test_surrogate():
+    import os, tempfile
+    import numpy as np
+    from ostn02python import surrogate
+    from ostn02python.batch import ETRS89_to_OSGB36_array
+    from ostn02python.projection import projection_for
+    etrs89 = projection_for("ETRS89")
+    path = os.path.join(tempfile.mkdtemp(), "ostn02data.surrogate")
+    surrogate.compile_surrogate(path)
+    table = surrogate.open_surrogate(path)
+    assert_equal(table.coefficients.shape, surrogate.fit_surrogate().coefficients.shape)
+    assert surrogate.validate(20000, surrogate=table)["max_projection_error"] < surrogate.TOLERANCE
+    with open(path, "r+b") as f:
+        f.seek(-1, 2)
+        f.write(b"\0")
+    assert surrogate.open_surrogate(path) is None
+
+    lat = np.array([51.297880, 54.589097, 52.658007, 50.5])
+    lon = np.array([1.092021, -2.947906, 1.716073, -4.0])
+    ((x, y, z), ok) = surrogate.ETRS89_ll_to_OSGB36_array(lat, lon, masked=True)
+    ((ex, ey, ez), eok) = ETRS89_to_OSGB36_array(*etrs89.to_grid_array(lat, lon), masked=True)
+    assert_equal(list(ok), list(eok))
+    assert abs(x - ex)[ok].max() <= 0.001 and abs(y - ey)[ok].max() <= 0.001
+    for i in range(len(lat)):
+        if ok[i]:
+            assert_equal(surrogate.ETRS89_ll_to_OSGB36(lat[i], lon[i]),
+                         ETRS89_to_OSGB36(*etrs89.to_grid(lat[i], lon[i])))
+
+def test_streetview_tiles_array():
+    import numpy as np
+    from ostn02python.OSGB import os_streetview_tile_to_grid
+    from ostn02python.gridref import (grid_to_os_streetview_tile_array, bin_os_streetview_tiles,
+                                      os_streetview_tiles_in_bbox)
+    east = np.array([340430.0, 393720, 436612, 344999, -1e6, np.nan, 340000])
+    north = np.array([366629.0, 399001, 1189906, 369999, 0, 0, 365000])
+    (tiles, ok) = grid_to_os_streetview_tile_array(east, north)
+    assert_equal(list(tiles), ["SJ46NW", "SJ99NW", "HU38NE", "SJ46NW", "", "", "SJ46NW"])
+    assert_equal(list(ok), [True, True, True, True, False, False, True])
+    assert_equal(grid_to_os_streetview_tile((east[0], north[0]))[0], "SJ46NW")
+
+    (names, counts, groups) = bin_os_streetview_tiles(east, north, groups=True)
+    assert_equal(list(names), ["SJ46NW", "SJ99NW", "HU38NE"])
+    assert_equal(list(counts), [3, 1, 1])
+    assert_equal([list(g) for g in groups], [[0, 3, 6], [1], [2]])
+
+    (names, e, n) = os_streetview_tiles_in_bbox((338000, 360000, 345000, 370000))
+    assert_equal(list(names), ["SJ36SE", "SJ36NE", "SJ46SW", "SJ46NW"])
+    for i in range(len(names)):
+        assert_equal(os_streetview_tile_to_grid(names[i]), (e[i], n[i]))
+
+def test_dataframe_accessor():
+    from nose.plugins.skip import SkipTest
+    try:
+        import pandas as pd
+    except ImportError:
+        raise SkipTest("pandas is not installed")
+    from ostn02python.dataframe import register_accessor
+    register_accessor()
+    register_accessor()
+    frame = pd.DataFrame({"e": [614300.0, 622129.0, 346200.0], "n": [159900.0, 185038.0, 575400.0]},
+                         index=[5, 6, 7])
+    (out, ok) = frame.ostn.to_etrs89(x="e", y="n")
+    assert_equal(list(out.columns), ["etrs89_e", "etrs89_n", "etrs89_h"])
+    assert_equal(list(ok.index), [5, 6, 7])
+    assert_equal(list(ok), [True, False, True])
+    assert_equal(tuple(out.loc[5]), (614199.522, 159979.837, 44.622))
+    assert out.loc[6].isna().all()
+    (ll, ok) = frame.ostn.to_latlon("e", "n", names=("a", "b", "c"))
+    assert_almost_equal(ll.loc[5, "a"], 51.297880, places=6)
+
+def test_arrow_columns():
+    from nose.plugins.skip import SkipTest
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise SkipTest("pyarrow is not installed")
+    import numpy as np
+    from ostn02python.dataframe import transform_arrow, _arrow_values
+    east = pa.array([614300.0, 622129.0, None])
+    north = pa.chunked_array([[159900.0], [185038.0, 159900.0]])
+    ((x, y, z), ok) = transform_arrow("to_etrs89", east, north)
+    assert_equal(ok.to_pylist(), [True, False, False])
+    assert_equal(x.to_pylist(), [614199.522, None, None])
+    assert_equal(z.null_count, 2)
+    #Float64 columns without nulls are used in place
+    column = pa.array([1.0, 2.0])
+    assert np.shares_memory(_arrow_values(column), column.to_numpy())
+
+def test_track_transformer():
+    from ostn02python.track import TrackTransformer, transform_track
+    #A straight track with 7 m between fixes, crossing two cell edges
+    track = [(613990.0 + 7*i, 159985.0 + 7*i, 10.0) for i in range(40)]
+    transformer = TrackTransformer()
+    forward = list(transformer.transform(track))
+    assert_equal(forward, [ETRS89_to_OSGB36(*p) for p in track])
+    assert_equal(transformer.cells_read, 3)
+    inverse = list(transform_track(forward, "OSGB36_to_ETRS89"))
+    assert_equal(inverse, [OSGB36_to_ETRS89(*p) for p in forward])
+
+    transformer = TrackTransformer()
+    list(transformer.transform(forward, "OSGB36_to_ETRS89"))
+    #The first point needs two lookups, then one each from the last shift
+    assert transformer.lookups < len(forward) + 3
+    points = [(614300, 159900), (622129, 185038), (614310, 159910)]
+    assert_equal(list(transform_track(points, "OSGB36_to_ETRS89", on_error="blank"))[1], None)
+    assert_equal(len(list(transform_track(points, "OSGB36_to_ETRS89", on_error="skip"))), 2)
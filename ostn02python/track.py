@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+#OSTN02 for Python
+#=================
+
+#Streaming transforms for GPS tracks. Consecutive fixes of a track are
+#metres apart, so nearly all of them fall in the same 1 km cell as the one
+#before. A TrackTransformer keeps the bilinear coefficients of the last
+#cell it used and only goes back to the grid when a fix leaves it. The
+#OSGB36_to_ETRS89 inverse starts from the previous fix's shift, which is
+#already within a millimetre or so of the answer, so the Newton iteration
+#usually finishes after one lookup instead of two.
+#The OSTN02 transform is Crown Copyright (C) 2002
+#See COPYING for redistribution terms
+
+from ostn02python import OSTN02
+from ostn02python.grid import GRID_WIDTH, GRID_HEIGHT
+from ostn02python.OSTN02 import (MAX_EASTING, MAX_NORTHING, INVERSE_TOLERANCE,
+                                 MAX_INVERSE_LOOKUPS, _cell_coefficients,
+                                 _round_to_nearest_mm, _not_defined)
+
+#The previous shift is only used as the starting point of the inverse when
+#the previous fix is within this many metres; further away the shift at
+#the point itself is the better guess
+WARM_START_DISTANCE = 1000.0
+
+TRACK_TRANSFORMS = ('ETRS89_to_OSGB36', 'OSGB36_to_ETRS89')
+
+class TrackTransformer(object):
+    """OSTN02 transforms of one stream of nearby points at a time, on grid
+    (a grid.ShiftGrid, by default the one the module functions use).
+
+    Results are the same as OSTN02.ETRS89_to_OSGB36 and OSGB36_to_ETRS89.
+    A TrackTransformer remembers the last cell and shift, so it should not
+    be shared between threads; make one per track or per thread.
+    """
+
+    def __init__(self, grid=None):
+        if grid is None:
+            grid = OSTN02._get_ostn_data()
+        self.grid = grid
+        self.coverage = grid.coverage
+        self.reset()
+
+    def reset(self):
+        """Forget the last cell and shift, e.g. before a new track."""
+        (self._e, self._n, self._c) = (-1, -1, None)
+        self._last = None
+        self.cells_read = 0
+        self.lookups = 0
+
+    def _move(self, e_index, n_index, x, y):
+        #Make (e_index, n_index) the current cell
+        if not (0 <= e_index < GRID_WIDTH-1 and 0 <= n_index < GRID_HEIGHT-1):
+            raise _not_defined(x, y)
+        i0 = n_index * GRID_WIDTH + e_index
+        if not (self.coverage[i0 >> 3] >> (i0 & 7)) & 1:
+            raise _not_defined(x, y)
+        self._c = _cell_coefficients(i0, self.grid)
+        (self._e, self._n) = (e_index, n_index)
+        self.cells_read += 1
+
+    def _shifts_and_slopes(self, x, y):
+        #OSTN02._find_OSTN02_shifts_and_slopes_at in the current cell
+        (e_index, n_index) = (int(x/1000.), int(y/1000.))
+        if e_index != self._e or n_index != self._n:
+            self._move(e_index, n_index, x, y)
+        c = self._c
+        t = (x - e_index*1000)/1000
+        u = (y - n_index*1000)/1000
+        tu = t*u
+        self.lookups += 1
+        return (c[0] + c[1]*t + c[2]*u + c[3]*tu,
+                c[4] + c[5]*t + c[6]*u + c[7]*tu,
+                c[8] + c[9]*t + c[10]*u + c[11]*tu,
+                (c[1] + c[3]*u)/1000.0, (c[2] + c[3]*t)/1000.0,
+                (c[5] + c[7]*u)/1000.0, (c[6] + c[7]*t)/1000.0,
+                (c[9] + c[11]*u)/1000.0, (c[10] + c[11]*t)/1000.0)
+
+    def ETRS89_to_OSGB36(self, x, y, z=0.0):
+        """OSTN02.ETRS89_to_OSGB36 for the next point of the track."""
+        if not (0 <= x <= MAX_EASTING and 0 <= y <= MAX_NORTHING):
+            raise _not_defined(x, y)
+        (e_index, n_index) = (int(x/1000.), int(y/1000.))
+        if e_index != self._e or n_index != self._n:
+            self._move(e_index, n_index, x, y)
+        c = self._c
+        t = (x - e_index*1000)/1000
+        u = (y - n_index*1000)/1000
+        tu = t*u
+        self.lookups += 1
+        return _round_to_nearest_mm(x + (c[0] + c[1]*t + c[2]*u + c[3]*tu),
+                                    y + (c[4] + c[5]*t + c[6]*u + c[7]*tu),
+                                    z - (c[8] + c[9]*t + c[10]*u + c[11]*tu))
+
+    def OSGB36_to_ETRS89(self, x0, y0, z0=0.0):
+        """OSTN02.OSGB36_to_ETRS89 for the next point of the track."""
+        if not (0 <= x0 <= MAX_EASTING and 0 <= y0 <= MAX_NORTHING):
+            raise _not_defined(x0, y0)
+        last = self._last
+        lookups = MAX_INVERSE_LOOKUPS
+        if (last is not None and abs(x0 - last[0]) < WARM_START_DISTANCE
+                and abs(y0 - last[1]) < WARM_START_DISTANCE):
+            (x, y) = (x0 - last[2], y0 - last[3])
+        else:
+            (dx, dy) = self._shifts_and_slopes(x0, y0)[:2]
+            (x, y) = (x0 - dx, y0 - dy)
+            lookups -= 1
+
+        #Newton's method as OSTN02._find_inverse_shifts_at
+        for attempt in range(lookups):
+            (se, sn, sg, se_x, se_y, sn_x, sn_y, sg_x, sg_y) = self._shifts_and_slopes(x, y)
+            fx = x + se - x0
+            fy = y + sn - y0
+            det = (1+se_x)*(1+sn_y) - se_y*sn_x
+            step_x = ((1+sn_y)*fx - se_y*fy)/det
+            step_y = ((1+se_x)*fy - sn_x*fx)/det
+            (last_x, last_y) = (x, y)
+            (x, y) = (x - step_x, y - step_y)
+            if (abs(fx) < INVERSE_TOLERANCE and abs(fy) < INVERSE_TOLERANCE
+                    and int(x/1000.) == int(last_x/1000.) and int(y/1000.) == int(last_y/1000.)):
+                dz = sg - sg_x*step_x - sg_y*step_y
+                self._last = (x0, y0, x0 - x, y0 - y)
+                return _round_to_nearest_mm(x, y, z0 + dz)
+
+        self._last = None
+        raise Exception("[OSTN02 inverse did not converge at ("+str(x0)+","+str(y0)+")]")
+
+    def transform(self, points, transform='ETRS89_to_OSGB36', on_error='fail'):
+        """Iterator of (x, y, z) for each (x, y) or (x, y, z) in points,
+        in order, with transform one of TRACK_TRANSFORMS. on_error is
+        'fail' to raise at a point that cannot be transformed, 'blank' to
+        yield None for it or 'skip' to leave it out."""
+        if transform not in TRACK_TRANSFORMS:
+            raise ValueError("Unknown transform {0!r}, expected one of {1}".format(
+                transform, ", ".join(TRACK_TRANSFORMS)))
+        if on_error not in ('fail', 'blank', 'skip'):
+            raise ValueError("on_error must be 'fail', 'blank' or 'skip'")
+        return self._run(points, getattr(self, transform), on_error)
+
+    def _run(self, points, func, on_error):
+        #The generator itself, so that bad arguments raise straight away
+        for point in points:
+            try:
+                result = func(*point)
+            except Exception:
+                if on_error == 'fail':
+                    raise
+                if on_error == 'skip':
+                    continue
+                result = None
+            yield result
+
+def transform_track(points, transform='ETRS89_to_OSGB36', grid=None, on_error='fail'):
+    """TrackTransformer(grid).transform(points, transform, on_error)."""
+    return TrackTransformer(grid).transform(points, transform, on_error)
@@ -3,10 +3,18 @@
 
 from ostn02python.OSGB import parse_grid, grid_to_ll
 from ostn02python.OSTN02 import OSGB36_to_ETRS89
+from ostn02python import instrument
 
 import six
 
-def OSGB36GridRefToETRS89(mapRef):
+def OSGB36GridRefToGrid(mapRef):
+	"""Convert a grid reference such as "TR143599" to OSGB36 (easting, northing)."""
+
+	if instrument.enabled:
+		return instrument.timed('gridref', _OSGB36GridRefToGrid, mapRef)
+	return _OSGB36GridRefToGrid(mapRef)
+
+def _OSGB36GridRefToGrid(mapRef):
 
 	if len(mapRef) < 4:
 		raise ValueError("Map ref too short")
@@ -18,7 +26,11 @@ def OSGB36GridRefToETRS89(mapRef):
 	east = int(mapRef[2:2+coordLen])*pow(10,5-coordLen)
 	nrth = int(mapRef[2+coordLen:])*pow(10,5-coordLen)
 
-	x1, y1 = parse_grid(code, east, nrth)
+	return parse_grid(code, east, nrth)
+
+def OSGB36GridRefToETRS89(mapRef):
+
+	x1, y1 = OSGB36GridRefToGrid(mapRef)
 
 	(x,y,h) = OSGB36_to_ETRS89 (x1, y1)
 	(gla, glo) = grid_to_ll(x, y)
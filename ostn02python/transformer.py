@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+#OSTN02 for Python
+#=================
+
+#OSTN02 transforms bound to one shift grid. A Transformer never changes
+#after it is made and reads its grid without taking any locks (only its
+#small cache of cell coefficients has one), so one instance can be shared by every thread of a web server (with or without
+#the GIL). map() splits a large batch over a thread pool; the NumPy kernels
+#doing the work release the GIL, so several cores are used in one process.
+#The OSTN02 transform is Crown Copyright (C) 2002
+#See COPYING for redistribution terms
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from ostn02python import OSTN02
+from ostn02python import instrument
+from ostn02python.grid import GRID_WIDTH, GRID_HEIGHT
+from ostn02python.cellcache import CELL_ENTRY_BYTES, DEFAULT_CELL_CACHE_BYTES
+from ostn02python.OSTN02 import (MAX_EASTING, MAX_NORTHING, _cell_coefficients,
+                                 _find_OSTN02_shifts_at, _find_inverse_shifts_at,
+                                 _round_to_nearest_mm, _not_defined)
+
+DEFAULT_CHUNK_SIZE = 100000
+
+class Transformer(object):
+    """The OSTN02 transforms on a given grid.ShiftGrid, by default the one
+    the module level functions use.
+
+    Attributes cannot be set after the object is made. Cell coefficients
+    for the scalar methods are remembered in a dict which is cleared when
+    it reaches its budget. The dict is only read or changed under a lock,
+    so it is safe to share without the GIL too; coefficients are worked
+    out outside the lock, and two threads missing the same cell at once
+    just store equal values.
+    """
+
+    __slots__ = ('grid', 'coverage', '_cells', '_max_cells', '_lock')
+
+    def __init__(self, grid=None, cell_cache_bytes=DEFAULT_CELL_CACHE_BYTES):
+        if grid is None:
+            grid = OSTN02._get_ostn_data()
+        set_ = super(Transformer, self).__setattr__
+        set_('grid', grid)
+        set_('coverage', grid.coverage)
+        set_('_cells', {})
+        set_('_max_cells', max(0, int(cell_cache_bytes // CELL_ENTRY_BYTES)))
+        set_('_lock', threading.Lock())
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Transformer is immutable")
+
+    def _find_cell(self, x, y):
+        #_find_OSTN02_cell on this transformer's grid
+        e_index = int(x/1000.)
+        n_index = int(y/1000.)
+        if not (0 <= e_index < GRID_WIDTH-1 and 0 <= n_index < GRID_HEIGHT-1):
+            raise _not_defined(x, y)
+        i0 = n_index * GRID_WIDTH + e_index
+        if not (self.coverage[i0 >> 3] >> (i0 & 7)) & 1:
+            raise _not_defined(x, y)
+
+        with self._lock:
+            c = self._cells.get(i0)
+        if c is None:
+            c = _cell_coefficients(i0, self.grid)
+            if self._max_cells:
+                with self._lock:
+                    if len(self._cells) >= self._max_cells:
+                        self._cells.clear()
+                    self._cells[i0] = c
+        return (c, (x - e_index*1000)/1000, (y - n_index*1000)/1000)
+
+    def is_covered(self, x, y):
+        """OSTN02.is_covered on this grid."""
+        if not (0 <= x <= MAX_EASTING and 0 <= y <= MAX_NORTHING):
+            return False
+        (e_index, n_index) = (int(x/1000.), int(y/1000.))
+        if e_index >= GRID_WIDTH-1 or n_index >= GRID_HEIGHT-1:
+            return False
+        i0 = n_index * GRID_WIDTH + e_index
+        return (self.coverage[i0 >> 3] >> (i0 & 7)) & 1 == 1
+
+    def ETRS89_to_OSGB36(self, x, y, z=0.0):
+        """OSTN02.ETRS89_to_OSGB36 on this grid."""
+        if not (0 <= x <= MAX_EASTING and 0 <= y <= MAX_NORTHING):
+            if instrument.enabled:
+                instrument.count('out_of_coverage')
+            raise Exception('OSTN02 is not defined at '+str(x)+', '+str(y)+')')
+        (dx, dy, dz) = _find_OSTN02_shifts_at(x, y, self._find_cell)
+        return _round_to_nearest_mm(x+dx, y+dy, z-dz)
+
+    def OSGB36_to_ETRS89(self, x0, y0, z0=0.0):
+        """OSTN02.OSGB36_to_ETRS89 on this grid."""
+        (dx, dy, dz, lookups, residual) = _find_inverse_shifts_at(x0, y0, self._find_cell)
+        return _round_to_nearest_mm(x0-dx, y0-dy, z0+dz)
+
+    def ETRS89_to_OSGB36_array(self, x, y, z=None, masked=False):
+        """batch.ETRS89_to_OSGB36_array on this grid."""
+        from ostn02python.batch import _instrumented, _ETRS89_to_OSGB36_array
+        if instrument.enabled:
+            return _instrumented('shift_array', _ETRS89_to_OSGB36_array, x, y, z, masked, self.grid)
+        return _ETRS89_to_OSGB36_array(x, y, z, masked, self.grid)
+
+    def OSGB36_to_ETRS89_array(self, x0, y0, z0=None, masked=False):
+        """batch.OSGB36_to_ETRS89_array on this grid."""
+        from ostn02python.batch import _instrumented, _OSGB36_to_ETRS89_array
+        if instrument.enabled:
+            return _instrumented('inverse_array', _OSGB36_to_ETRS89_array, x0, y0, z0, masked, self.grid)
+        return _OSGB36_to_ETRS89_array(x0, y0, z0, masked, self.grid)
+
+    def transform_with_mask(self, transform, *columns):
+        """batch.transform_with_mask on this grid."""
+        from ostn02python import batch
+        if transform == 'ETRS89_to_OSGB36':
+            (out, ok) = self.ETRS89_to_OSGB36_array(*columns, masked=True)
+        elif transform == 'OSGB36_to_ETRS89':
+            (out, ok) = self.OSGB36_to_ETRS89_array(*columns, masked=True)
+        else:
+            return batch.transform_with_mask(transform, *columns)
+        return (tuple(out), ok)
+
+    def map(self, transform, *columns, chunk_size=DEFAULT_CHUNK_SIZE, workers=None, executor=None):
+        """Run one of batch.TRANSFORMS over large arrays on a thread pool.
+
+        The arrays are split into chunks of chunk_size points which are
+        transformed concurrently and joined back in input order. Returns
+        (outputs, ok) as transform_with_mask. executor may be an existing
+        concurrent.futures executor to use; otherwise a pool of workers
+        threads (by default one per CPU) is made for the call.
+        """
+        import numpy as np
+        from ostn02python.batch import TRANSFORMS
+        if transform not in TRANSFORMS:
+            raise ValueError("Unknown transform {0!r}".format(transform))
+
+        columns = np.broadcast_arrays(*[np.asarray(c, dtype=np.float64) for c in columns])
+        shape = columns[0].shape
+        columns = [c.ravel() for c in columns]
+        starts = range(0, columns[0].size, chunk_size)
+        if len(starts) <= 1:
+            (outputs, ok) = self.transform_with_mask(transform, *columns)
+            return (tuple(o.reshape(shape) for o in outputs), ok.reshape(shape))
+
+        def run(start):
+            return self.transform_with_mask(transform, *[c[start:start+chunk_size] for c in columns])
+        if executor is None:
+            with ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+                results = list(pool.map(run, starts))
+        else:
+            results = list(executor.map(run, starts))
+        outputs = tuple(np.concatenate([r[0][k] for r in results]).reshape(shape)
+                        for k in range(len(results[0][0])))
+        return (outputs, np.concatenate([r[1] for r in results]).reshape(shape))
+
+_default = None
+
+def default_transformer():
+    """A Transformer on the grid the module level functions use, made again
+    if that grid is replaced with OSTN02.set_grid()."""
+    global _default
+    transformer = _default
+    grid = OSTN02._get_ostn_data()
+    if transformer is None or transformer.grid is not grid:
+        transformer = _default = Transformer(grid)
+    return transformer
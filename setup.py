@@ -25,7 +25,8 @@ conf = dict(
     namespace_packages=[],
     include_package_data=False,
     zip_safe=False,
-    install_requires=[],
+    install_requires=['six', 'numpy'],
+    extras_require={'pandas': ['pandas'], 'arrow': ['pyarrow']},
     tests_require=[],
     entry_points={}
     )